@@ -2,16 +2,13 @@ import os
 import sys
 import argparse
 import logging
-import re
 from pathlib import Path
-import logging
-from src.preprocessing import preprocess
-from src.config import load_genome_config, load_docker_config
-from src.map import align_reads
-from src.quantification import apply_featureCounts
-
-main_dir = os.path.dirname(os.path.abspath(__file__))
-sys.path.append(main_dir+"/src")
+from src.discovery import create_samples
+from src.quicklook import get_subsample_dir
+from src.config import load_genome_config, load_docker_config,\
+    wait_image_validation
+from src.scheduler import run_samples, get_required_images
+from src.batch import DEMUX_MAX_THREADS
 
 def parse_args():
     '''
@@ -27,6 +24,81 @@ def parse_args():
         type=str, required=True)
     parser.add_argument("-t", "--threads", type=int, default=4,
         help="Num. of CPU threads to operate", dest='threads')
+    parser.add_argument("--sample_threads", type=int, default=None,
+        help="Num. of CPU threads given to each sample, divided between its tools"
+        " (default: --threads divided between the samples running at once)",
+        dest='sample_threads')
+    parser.add_argument("--max_memory", type=int, default=None,
+        help="Max. memory in MB used by concurrent tools. By default the host"
+        " available memory or the cgroup limit", dest='max_memory')
+    parser.add_argument("--hash_inputs", action="store_true",
+        help="Fingerprint step inputs with sha256, besides size and mtime, to"
+        " decide which steps must be run again on resume", dest='hash_inputs')
+    parser.add_argument("--cache_dir", type=str, default=None,
+        help="Shared cache directory. Trimmed fastq, BAM and count files are"
+        " reused from it by runs with the same inputs and parameters", dest='cache_dir')
+    parser.add_argument("--cache_size", type=float, default=500,
+        help="Max. size of the shared cache in GB (default: 500)", dest='cache_size')
+    parser.add_argument("--backend", type=str, default="auto",
+        choices=['auto', 'docker', 'native'],
+        help="Run FastQC and featureCounts natively or from docker images. auto"
+        " runs them natively when installed with the configured version"
+        " (default: auto)", dest='backend')
+    parser.add_argument("--stream", action="store_true",
+        help="Hand trimmed reads from fastp to Hisat2 through named pipes"
+        " instead of writing trimmed fastq files", dest='stream')
+    parser.add_argument("--keep_trimmed", action="store_true",
+        help="With --stream, also save gzipped trimmed fastq files",
+        dest='keep_trimmed')
+    parser.add_argument("--qc", type=str, default="fastqc",
+        choices=['fastqc', 'native'],
+        help="Raw fastq QC with FastQC, or with the built-in NumPy module that"
+        " writes FastQC-compatible reports (default: fastqc)", dest='qc')
+    parser.add_argument("--recursive", action="store_true",
+        help="Also look for fastq files in sub-folders of the fastq folder",
+        dest='recursive')
+    parser.add_argument("--sample_sheet", type=str,
+        help="bcl2fastq or BCL Convert SampleSheet.csv of the run. Only the"
+        " fastq files of its samples are processed, found without scanning"
+        " the whole fastq folder", dest='sample_sheet')
+    parser.add_argument("--validate", action="store_true",
+        help="Check that raw fastq pairs are consistent (mate names, read"
+        " counts, SEQ and QUAL lengths) before trimming them", dest='validate')
+    parser.add_argument("--index_cache_dir", type=str,
+        help="Folder of the pyfastx indexes of the fastq files, shared by all"
+        " runs. --subsample fetches reads through them when they are all there"
+        " and streams the files otherwise (default:"
+        " ~/.cache/rna_seq_pipeline/fastq_index)",
+        dest='index_cache_dir')
+    parser.add_argument("--index_fastqs", action="store_true",
+        help="With --subsample, first build the missing pyfastx indexes of the"
+        " raw fastq files in --index_cache_dir, so that reads are fetched at"
+        " random, and later quick looks of the same files reuse them",
+        dest='index_fastqs')
+    parser.add_argument("--subsample", type=int,
+        help="Quick look: process only N random read pairs per sample, into"
+        " <output_dir>/subsample_<N>, and report mapping rate, strandedness,"
+        " duplication and top genes", dest='subsample')
+    parser.add_argument("--chunks", type=int, default=1,
+        help="Scatter-gather alignment: split the trimmed reads of each sample"
+        " into N chunks aligned as independent jobs, then merged (default: 1)."
+        " Ignored with --stream", dest='chunks')
+    parser.add_argument("--lane_mode", type=str, default="merge",
+        choices=['merge', 'split'],
+        help="Samples sequenced on several lanes: merge concatenates the lanes"
+        " before trimming, split trims and aligns each lane with its own read"
+        " group and merges the BAM files (default: merge)", dest='lane_mode')
+    parser.add_argument("--shared_index", action="store_true",
+        help="Hisat2 loads its index memory-mapped (--mm), read into the page"
+        " cache once per node, so that concurrent alignments share one copy"
+        " of it", dest='shared_index')
+    parser.add_argument("--batch_size", type=int, default=1,
+        help="Batch alignment: align the reads of up to N samples with a single"
+        " Hisat2 process, loading the index once per batch, and split them into"
+        " one BAM file per sample (default: 1). A batch runs at most {} Hisat2"
+        " threads, as many as its single demultiplexing process keeps up with."
+        " Ignored with --stream and --chunks".format(DEMUX_MAX_THREADS),
+        dest='batch_size')
     parser.add_argument("-r", "--reference", required=True, type=str,
         choices=['hg19', 'hg38'])
 
@@ -38,20 +110,34 @@ if __name__== "__main__":
     logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 
     args = parse_args()
+    # Absolute paths, so that commands run the same inside containers
+    args.fastq_dir  = os.path.abspath(args.fastq_dir)
+    args.output_dir = os.path.abspath(args.output_dir)
+    # A quick look has an output tree of its own
+    if args.subsample:
+        args.output_dir = get_subsample_dir(args.output_dir, args.subsample)
     fastq_dir  = args.fastq_dir
     output_dir = args.output_dir
 
     Path(output_dir).mkdir(parents=True, exist_ok=True)
 
     config_dict = load_genome_config(args.config_yaml)
-    docker_dict = load_docker_config(args.docker_yaml)
+    # Docker images are validated while samples are discovered
+    docker_dict = load_docker_config(args.docker_yaml, wait=False)
 
     args_dict = vars(args)
     config_dict = {**config_dict, **args_dict}
 
-    # Fastq preprocessing
-    sample_list = preprocess(fastq_dir, output_dir, config_dict, docker_dict)
-
-    sample_list = align_reads(sample_list, config_dict, docker_dict)
+    sample_list = create_samples(fastq_dir, output_dir, args.recursive,
+        args.sample_sheet)
+    missing_images = wait_image_validation()
+    missing_images = [image for image in get_required_images(config_dict, docker_dict)
+        if image in missing_images]
+    if missing_images:
+        msg = (" ERROR: Missing docker images {}. Pull them or run the tools"
+            " natively (--backend native)").format(", ".join(missing_images))
+        logging.error(msg)
+        sys.exit(1)
 
-    sample_list = apply_featureCounts(sample_list, config_dict, docker_dict)
+    # Fastq preprocessing, mapping and quantification as a task graph
+    sample_list = run_samples(sample_list, config_dict, docker_dict)
@@ -0,0 +1,218 @@
+import os
+import sys
+import shutil
+import logging
+from src.utils import atomic_outputs
+from src.runner import run_group, get_log_prefix
+from src.tools import get_tool_path
+from src.map import InvalidBAM
+from src.stream import STREAM_DIR, make_fifos
+
+logger = logging.getLogger(__name__)
+
+# Folder of the output directory with the Hisat2 outputs of every batch
+BATCH_FOLDER = "BATCH_FOLDER"
+# Folder of a batch folder where samtools split writes the sample BAM files
+SPLIT_STAGING_DIR = ".split"
+
+# Hisat2 threads of a batch at most: every alignment goes through a single
+# demultiplexer awk process, which drains the output of about this many
+# Hisat2 threads before it holds them back
+DEMUX_MAX_THREADS = 12
+# Read names are prefixed by the sample number within the batch, e.g.
+# @0_A00123:8:H7:1:1101:1000:1000. The demultiplexer strips the prefix and
+# tags the alignment with the read group of the sample
+FEEDER_AWK = 'NR % 4 == 1 { $0 = "@" p substr($0, 2) } 1'
+# It also writes the alignment summary of every sample, as Hisat2 does for
+# a whole run, from the primary alignment of each mate: pairs are counted
+# from their first mate as concordant (0x2), discordant (both mates aligned)
+# or neither, whose mates are counted one by one. Unique and multiple
+# alignments are told apart by the NH tag
+DEMUX_AWK = r'''function pct(count, total) { return total ? 100 * count / total : 0 }
+BEGIN { FS = OFS = "\t"; n = split(ids, id, ","); split(summaries, summary, ",") }
+/^@/ { print; next }
+!header { print rgs; header = 1 }
+{
+    p = index($1, "_"); u = substr($1, 1, p - 1) + 1; $1 = substr($1, p + 1)
+    print $0, "RG:Z:" id[u]
+    flag = $2
+    if (int(flag / 256) % 2 || int(flag / 2048) % 2) next
+    hits = 1
+    for (i = 12; i <= NF; i++) if (substr($i, 1, 5) == "NH:i:") hits = substr($i, 6) + 0
+    concordant = int(flag / 2) % 2
+    both = int(flag / 4) % 2 == 0 && int(flag / 8) % 2 == 0
+    if (int(flag / 64) % 2) {
+        pairs[u]++
+        if (concordant) { if (hits > 1) conc_multi[u]++; else conc_unique[u]++ }
+        else if (both) discordant[u]++
+    }
+    if (concordant || both) { if (int(flag / 4) % 2 == 0) aligned[u]++ }
+    else if (int(flag / 4) % 2) mate_none[u]++
+    else { aligned[u]++; if (hits > 1) mate_multi[u]++; else mate_unique[u]++ }
+}
+END {
+    if (!header) print rgs
+    for (u = 1; u <= n; u++) {
+        total = pairs[u] + 0
+        conc = conc_unique[u] + conc_multi[u]
+        conc_none = total - conc
+        neither = conc_none - discordant[u]
+        mates = mate_none[u] + mate_unique[u] + mate_multi[u]
+        out = summary[u]
+        printf "%d reads; of these:\n", total > out
+        printf "  %d (%.2f%%) were paired; of these:\n", total, pct(total, total) > out
+        printf "    %d (%.2f%%) aligned concordantly 0 times\n", conc_none, pct(conc_none, total) > out
+        printf "    %d (%.2f%%) aligned concordantly exactly 1 time\n", conc_unique[u], pct(conc_unique[u], total) > out
+        printf "    %d (%.2f%%) aligned concordantly >1 times\n", conc_multi[u], pct(conc_multi[u], total) > out
+        printf "    ----\n" > out
+        printf "    %d pairs aligned concordantly 0 times; of these:\n", conc_none > out
+        printf "      %d (%.2f%%) aligned discordantly 1 time\n", discordant[u], pct(discordant[u], conc_none) > out
+        printf "    ----\n" > out
+        printf "    %d pairs aligned 0 times concordantly or discordantly; of these:\n", neither > out
+        printf "      %d mates make up the pairs; of these:\n", mates > out
+        printf "        %d (%.2f%%) aligned 0 times\n", mate_none[u], pct(mate_none[u], mates) > out
+        printf "        %d (%.2f%%) aligned exactly 1 time\n", mate_unique[u], pct(mate_unique[u], mates) > out
+        printf "        %d (%.2f%%) aligned >1 times\n", mate_multi[u], pct(mate_multi[u], mates) > out
+        printf "%.2f%% overall alignment rate\n", pct(aligned[u], 2 * total) > out
+        close(out)
+    }
+}'''
+
+
+def get_batch_dir(output_dir, batch) -> str:
+    '''
+        Folder of a batch of samples aligned together
+    '''
+    return os.path.join(output_dir, BATCH_FOLDER, "batch{:03d}".format(batch))
+
+def get_batches(aligners, batch_size) -> list:
+    '''
+        Aligners grouped in batches of at most batch_size, in order
+    '''
+    return [aligners[idx:idx + batch_size] for idx in range(0, len(aligners), batch_size)]
+
+def get_batch_fifos(batch_dir) -> list:
+    '''
+        Named pipes through which the reads of a batch are fed to Hisat2
+    '''
+    return [os.path.join(batch_dir, STREAM_DIR, "R{}.fq".format(read)) for read in (1, 2)]
+
+def get_unsorted_bam(hisat2, batch_dir) -> str:
+    '''
+        BAM file of a sample of a batch, as split from the batch output
+    '''
+    return os.path.join(batch_dir, hisat2.name + ".unsorted.bam")
+
+def get_batch_summary(batch_dir) -> str:
+    '''
+        Hisat2 alignment summary of a whole batch
+    '''
+    return os.path.join(batch_dir, "batch.summary.alignment.txt")
+
+def get_batch_outputs(aligners, batch_dir) -> list:
+    '''
+        Files written by a batch: the unsorted BAM of every sample, then the
+        alignment summary of every sample and of the batch
+    '''
+    return [get_unsorted_bam(hisat2, batch_dir) for hisat2 in aligners] + \
+        [hisat2.summary_file for hisat2 in aligners] + [get_batch_summary(batch_dir)]
+
+def get_feeder_cmd(fastqs, fifo) -> str:
+    '''
+        Command line writing the reads of several samples into a named pipe,
+        one sample after the other, with read names prefixed by the sample
+        number. Any failure ends the command
+    '''
+    feeders = ["gzip -cd {} | awk -v p={}_ '{}'".format(fq, idx, FEEDER_AWK)
+        for idx, fq in enumerate(fastqs)]
+    return "{{ {}; }} > {}".format(" && ".join(feeders), fifo)
+
+def get_batch_align_cmd(aligners, batch_dir, summaries, batch_summary, threads) -> str:
+    '''
+        Command line of a batch: a single Hisat2 process reading the named
+        pipes, its output demultiplexed by read group and split into one
+        BAM file per sample by samtools split
+
+        :param list aligners: Hisat2 aligner of every sample of the batch
+        :param str batch_dir: folder of the batch
+        :param list summaries: alignment summary of every sample
+        :param str batch_summary: alignment summary of the batch
+        :param int threads: Hisat2 threads
+        :rtype: str
+    '''
+    hisat2 = aligners[0]
+    fifos = get_batch_fifos(batch_dir)
+    split_dir = os.path.join(batch_dir, SPLIT_STAGING_DIR)
+    mm = "--mm " if hisat2.memory_mapped else ""
+    read_groups = "\\n".join("@RG\\tID:{}\\t{}".format(aligner.read_group_id,
+        "\\t".join(aligner.read_group)) for aligner in aligners)
+    ids = ",".join(aligner.read_group_id for aligner in aligners)
+
+    # samtools split writes each read group as <ID>.bam, lightly compressed
+    # as the BAM files are sorted next
+    cmd = ('{} {}-x {} -1 {} -2 {} -p {} --summary-file {} --rna-strandness RF'
+        ' | awk -v ids=\'{}\' -v summaries=\'{}\' -v rgs=\'{}\' \'{}\''
+        ' | {} split --output-fmt bam,level=1 -f \'{}/%!.%.\' -')\
+        .format(get_tool_path("hisat2"), mm, hisat2.genome_index, fifos[0], fifos[1],
+        threads, batch_summary, ids, ",".join(summaries), read_groups, DEMUX_AWK,
+        get_tool_path("samtools"), split_dir)
+    return cmd
+
+def batch_align(aligners, batch_dir, threads) -> list:
+    '''
+        Align the reads of several samples with a single Hisat2 process, so
+        that the index is loaded once per batch instead of once per sample.
+        Reads are fed through named pipes tagged with their sample and the
+        alignments are split into one unsorted BAM file per sample, with
+        its read group
+
+        :param list aligners: Hisat2 aligner of every sample of the batch
+        :param str batch_dir: folder of the batch
+        :param int threads: Hisat2 threads
+        :returns: the unsorted BAM of every sample
+        :rtype: list
+        :raises InvalidBAM: if Hisat2, the demultiplexer or samtools failed
+    '''
+    msg = (" INFO: Mapping {} samples in a single Hisat2 batch: {}").format(
+        len(aligners), ", ".join(hisat2.name for hisat2 in aligners))
+    logging.info(msg)
+
+    fifos = get_batch_fifos(batch_dir)
+    split_dir = os.path.join(batch_dir, SPLIT_STAGING_DIR)
+    shutil.rmtree(split_dir, ignore_errors=True)
+    os.makedirs(split_dir)
+
+    outputs = get_batch_outputs(aligners, batch_dir)
+    try:
+        with atomic_outputs(outputs) as tmp_outputs:
+            make_fifos(fifos)
+            tmp_bams = tmp_outputs[:len(aligners)]
+            tmp_summaries = tmp_outputs[len(aligners):-1]
+            commands = [(get_feeder_cmd([hisat2.fastqs[read] for hisat2 in aligners],
+                fifos[read]), get_log_prefix(batch_dir, "feeder_R{}".format(read + 1)))
+                for read in (0, 1)]
+            commands.append((get_batch_align_cmd(aligners, batch_dir, tmp_summaries,
+                tmp_outputs[-1], threads), get_log_prefix(batch_dir, "hisat2")))
+            try:
+                results = run_group(commands, check=False)
+            finally:
+                for fifo in fifos:
+                    if os.path.exists(fifo):
+                        os.remove(fifo)
+
+            # Killed commands have no result, the failed one does
+            for result in results:
+                if result is not None and result.returncode != 0:
+                    raise InvalidBAM(result.stderr)
+
+            for hisat2, tmp_bam in zip(aligners, tmp_bams):
+                split_bam = os.path.join(split_dir, hisat2.read_group_id + ".bam")
+                if not os.path.isfile(split_bam):
+                    msg = (" ERROR: samtools split did not write {}").format(split_bam)
+                    logging.error(msg)
+                    raise InvalidBAM(msg)
+                os.replace(split_bam, tmp_bam)
+    finally:
+        shutil.rmtree(split_dir, ignore_errors=True)
+
+    return outputs[:len(aligners)]
@@ -0,0 +1,251 @@
+import os
+import sys
+import re
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+from src.manifest import file_digest
+from src.utils import get_tmp_path
+
+logger = logging.getLogger(__name__)
+
+DIGESTS_NAME = "digests.json"
+OBJECTS_DIR = "objects"
+LOCK_NAME = ".lock"
+# Options that only size the resources of a tool for the host it runs on:
+# JVM heap and GC threads, tool threads (hisat2 -p, samtools -@, fastp -w,
+# featureCounts -T) and samtools sort memory. They are left out of cache
+# keys, so that hosts with another CPU or memory budget share outputs
+RESOURCE_OPTIONS = re.compile(r'(?<!\S)(?:-Xm[sx]\d+[kKmMgG]?|-XX:ParallelGCThreads=\d+'
+    r'|(?:-p|-@|-w|-T|-m)\s+\d+[kKmMgG]?)(?!\S)')
+
+
+def strip_resource_options(cmd) -> str:
+    '''
+        Command line with its resource options replaced by a placeholder,
+        see RESOURCE_OPTIONS
+    '''
+    return RESOURCE_OPTIONS.sub("{resources}", cmd)
+
+def link_or_copy(src, dst) -> str:
+    '''
+        Materialise src as dst: hard link when both live on the same
+        filesystem, reflink (copy-on-write) when supported, plain copy otherwise
+
+        :returns: the method used, "link", "reflink" or "copy"
+        :rtype: str
+    '''
+    try:
+        os.link(src, dst)
+        return "link"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+
+    p1 = subprocess.run(["cp", "--reflink=always", src, dst],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p1.returncode == 0:
+        return "reflink"
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+class ArtifactCache():
+    '''
+        Content-addressed cache of step outputs shared between runs. Entries
+        are keyed on the content hash of the step inputs, its command line
+        with paths abstracted away and its tool version, so that the same
+        fastq files processed into a new output directory reuse trimmed
+        fastq, BAM and count files instead of recomputing them. The cache
+        size is bounded with least-recently-used eviction
+
+        :param str cache_dir: shared cache directory
+        :param float max_size_gb: max. size of the cache in GB
+    '''
+    def __init__(self, cache_dir, max_size_gb=500):
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._objects_dir = os.path.join(self._cache_dir, OBJECTS_DIR)
+        self._max_bytes = int(max_size_gb * 1024**3)
+        self._lock = threading.Lock()
+        os.makedirs(self._objects_dir, exist_ok=True)
+        self._digests = self._load_digests()
+
+    @property
+    def cache_dir(self) -> str:
+        return self._cache_dir
+
+    @contextmanager
+    def _locked(self):
+        '''
+            Exclusive lock on the cache, shared with other runs on this host
+        '''
+        with self._lock:
+            with open(os.path.join(self._cache_dir, LOCK_NAME), "w") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_digests(self) -> dict:
+        '''
+            Load the persisted content hashes, so that input files are only
+            hashed once across runs
+        '''
+        try:
+            with open(os.path.join(self._cache_dir, DIGESTS_NAME)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_digests(self) -> None:
+        '''
+        '''
+        path = os.path.join(self._cache_dir, DIGESTS_NAME)
+        tmp_path = "{}.{}".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self._digests, f)
+        os.replace(tmp_path, path)
+
+    def digest(self, path) -> str:
+        '''
+            sha256 of a file, memoised on its path, inode, size and mtime
+        '''
+        st = os.stat(path)
+        identity = "{}:{}:{}:{}".format(os.path.realpath(path), st.st_ino,
+            st.st_size, st.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(identity)
+        if digest is None:
+            digest = file_digest(path)
+            with self._locked():
+                self._digests.update(self._load_digests())
+                self._digests[identity] = digest
+                self._save_digests()
+        return digest
+
+    def key(self, task) -> str:
+        '''
+            Cache key of a task, or None if any input is missing. Input and
+            output paths (and their folders) are replaced by placeholders in
+            the command line, so that the key does not depend on where the
+            run lives. Resource options are left out as well, so that the key
+            does not depend on the host either
+        '''
+        cmd = strip_resource_options(task.cmd or "")
+        placeholders = []
+        for prefix, paths in (("output", task.outputs), ("input", task.inputs)):
+            for idx, path in enumerate(paths):
+                placeholders.append((path, "{{{}{}}}".format(prefix, idx)))
+                placeholders.append((os.path.dirname(path),
+                    "{{{}_dir{}}}".format(prefix, idx)))
+        # Longest paths first, so that folders do not clobber full paths
+        for path, placeholder in sorted(placeholders, key=lambda x: -len(x[0])):
+            if path:
+                cmd = cmd.replace(path, placeholder)
+
+        inputs = []
+        for path in task.inputs:
+            if not os.path.isfile(path):
+                return None
+            inputs.append(self.digest(path))
+
+        signature = json.dumps({'step': task.name.split(":")[0], 'cmd': cmd,
+            'version': task.version, 'inputs': inputs,
+            'outputs': [os.path.basename(path) for path in task.outputs]},
+            sort_keys=True)
+        return hashlib.sha256(signature.encode('UTF-8')).hexdigest()
+
+    def _entry_dir(self, key) -> str:
+        return os.path.join(self._objects_dir, key[:2], key)
+
+    def fetch(self, key, outputs) -> bool:
+        '''
+            Materialise the cached outputs of key into outputs
+
+            :returns: True on a cache hit
+            :rtype: bool
+        '''
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return False
+
+        with self._locked():
+            if not os.path.isdir(entry_dir):
+                return False
+            for idx, output in enumerate(outputs):
+                if not os.path.isfile(os.path.join(entry_dir, str(idx))):
+                    return False
+            for idx, output in enumerate(outputs):
+                tmp_output = get_tmp_path(output)
+                if os.path.exists(tmp_output):
+                    os.remove(tmp_output)
+                link_or_copy(os.path.join(entry_dir, str(idx)), tmp_output)
+                os.replace(tmp_output, output)
+            # Entry mtime tracks its last use for LRU eviction
+            os.utime(entry_dir)
+        return True
+
+    def store(self, key, outputs) -> None:
+        '''
+            Add the outputs of a finished task to the cache and evict least
+            recently used entries above the size limit
+        '''
+        entry_dir = self._entry_dir(key)
+        tmp_dir = "{}.{}.{}".format(entry_dir, os.getpid(), threading.get_ident())
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            size = 0
+            for idx, output in enumerate(outputs):
+                link_or_copy(output, os.path.join(tmp_dir, str(idx)))
+                size += os.path.getsize(output)
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+                json.dump({'outputs': [os.path.basename(path) for path in outputs],
+                    'size': size, 'created': time.strftime("%Y-%m-%dT%H:%M:%S")}, f)
+            with self._locked():
+                if os.path.isdir(entry_dir):
+                    shutil.rmtree(tmp_dir)
+                else:
+                    os.rename(tmp_dir, entry_dir)
+                self._evict()
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    def _evict(self) -> None:
+        '''
+            Remove least recently used entries until the cache fits max_size.
+            Must be called with the cache locked
+        '''
+        entries = []
+        total = 0
+        for prefix in os.scandir(self._objects_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                meta = os.path.join(entry.path, "meta.json")
+                if not entry.is_dir() or not os.path.isfile(meta):
+                    continue
+                try:
+                    with open(meta) as f:
+                        size = json.load(f)['size']
+                except (OSError, ValueError, KeyError):
+                    continue
+                entries.append((entry.stat().st_mtime, size, entry.path))
+                total += size
+
+        for mtime, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            msg = (" INFO: Evicting cache entry {}").format(os.path.basename(path))
+            logging.info(msg)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,188 @@
+import os
+import sys
+import re
+import shutil
+import logging
+from src.sample import Sample
+from src.utils import atomic_outputs
+from src.runner import run_cmd, get_log_prefix
+from src.preprocessing import TrimmingFailed, get_fastp_cmd, get_trimmed_fastq,\
+    get_fastp_json, get_fastp_html
+from src.map import merge_bams
+
+logger = logging.getLogger(__name__)
+
+# Folder of a fastq folder where fastp writes the chunks of a sample
+CHUNKS_STAGING_DIR = ".chunks"
+# Counts of a Hisat2 summary line: "  8823 (88.23%) aligned concordantly..."
+SUMMARY_COUNT = re.compile(r'^(?P<indent>\s*)(?P<count>\d+) (?:\((?P<pct>[\d.]+)%\) )?(?P<text>.*)$')
+SUMMARY_RATE = re.compile(r'^(?P<pct>[\d.]+)% overall alignment rate')
+
+
+def get_chunk_ids(chunks) -> list:
+    '''
+        Chunk numbers as written by fastp --split: 0001, 0002...
+    '''
+    return ["{:04d}".format(chunk) for chunk in range(1, chunks + 1)]
+
+def get_chunk_fastq(trimmed_fq, chunk) -> str:
+    '''
+        Chunk of a trimmed fastq file
+    '''
+    name = os.path.basename(trimmed_fq).replace(".fastq.gz", ".C{}.fastq.gz".format(chunk))
+    return os.path.join(os.path.dirname(trimmed_fq), name)
+
+def get_chunk_units(sample, chunks) -> list:
+    '''
+        One Sample object per chunk of the trimmed reads of a sample or of a
+        lane of a sample, to align chunks as independent jobs. Chunks keep
+        the read group of their sample or lane
+
+        :param Sample sample: sample, or lane unit from get_lane_units
+        :param int chunks: number of chunks
+        :rtype: list
+    '''
+    trimmed_fq1 = get_trimmed_fastq(sample.fq1, sample.fastq_folder)
+    trimmed_fq2 = get_trimmed_fastq(sample.fq2, sample.fastq_folder)
+    units = []
+    for chunk in get_chunk_ids(chunks):
+        unit = Sample("{}.C{}".format(sample.name, chunk))
+        unit.add("sample_folder", sample.sample_folder)
+        unit.add("fastq_folder", sample.fastq_folder)
+        unit.add("sample_name", sample.sample_name)
+        if getattr(sample, 'lane', None):
+            unit.add("lane", sample.lane)
+        unit.add("chunk", chunk)
+        unit.add("ready_fq1", get_chunk_fastq(trimmed_fq1, chunk))
+        unit.add("ready_fq2", get_chunk_fastq(trimmed_fq2, chunk))
+        units.append(unit)
+    return units
+
+def fastp_split(sample_name, output_dir, fq1, fq2, chunks, threads, fastp_exe) -> list:
+    '''
+        Trim raw FASTQ files using fastp, splitting the trimmed reads into
+        chunks of about the same size. fastp writes the chunks on a staging
+        folder, and they are renamed once it ends successfully
+
+        :param str sample_name: sample name
+        :param str output_dir: output directory
+        :param str fq1: raw fastq1 (R1)
+        :param str fq2: raw fastq2 (R2)
+        :param int chunks: number of chunks
+        :param int threads: fastp threads
+        :param str fastp_exe: fastp binary location
+        :returns: chunks of the trimmed fastq1, then of fastq2
+        :rtype: list
+        :raises TrimmingFailed: if fastp failed or wrote fewer chunks
+    '''
+    msg = (" INFO: Trimming sample {} into {} chunks").format(sample_name, chunks)
+    logging.info(msg)
+
+    trimmed_fqs = [get_trimmed_fastq(fq1, output_dir), get_trimmed_fastq(fq2, output_dir)]
+    chunk_fqs = [get_chunk_fastq(trimmed_fq, chunk) for trimmed_fq in trimmed_fqs
+        for chunk in get_chunk_ids(chunks)]
+    outputs = chunk_fqs + [get_fastp_json(output_dir), get_fastp_html(output_dir)]
+
+    staging_dir = os.path.join(output_dir, CHUNKS_STAGING_DIR)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    try:
+        with atomic_outputs(outputs) as tmp_outputs:
+            staged_fqs = [os.path.join(staging_dir, os.path.basename(trimmed_fq))
+                for trimmed_fq in trimmed_fqs]
+            cmd = get_fastp_cmd(fq1, fq2, *staged_fqs, *tmp_outputs[-2:], threads,
+                fastp_exe, split=chunks)
+            log_prefix = get_log_prefix(output_dir, "fastp." + sample_name)
+            result = run_cmd(cmd, log_prefix=log_prefix, check=False)
+            if result.returncode != 0 or re.search("error", result.stderr):
+                msg = (" ERROR: Something wrong happened with fastp trimming for sample {}")\
+                    .format(sample_name)
+                logging.error(result.stderr)
+                raise TrimmingFailed(msg)
+
+            tmp_chunks = iter(tmp_outputs)
+            for staged_fq in staged_fqs:
+                for chunk in get_chunk_ids(chunks):
+                    staged_chunk = os.path.join(staging_dir,
+                        "{}.{}".format(chunk, os.path.basename(staged_fq)))
+                    if not os.path.isfile(staged_chunk):
+                        msg = (" ERROR: fastp did not write chunk {} of sample {}")\
+                            .format(staged_chunk, sample_name)
+                        logging.error(msg)
+                        raise TrimmingFailed(msg)
+                    os.replace(staged_chunk, next(tmp_chunks))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return chunk_fqs
+
+def aggregate_alignment_summaries(summary_files, output) -> str:
+    '''
+        Write the Hisat2 alignment summary of a sample from the summaries of
+        its chunks: counts are added up and percentages recomputed against
+        the parent line, as Hisat2 does. The overall alignment rate is the
+        mean of the chunk rates weighted by their reads
+
+        :param list summary_files: Hisat2 summary of every chunk
+        :param str output: aggregated summary
+        :returns: the aggregated summary
+        :rtype: str
+    '''
+    summaries = []
+    for summary_file in summary_files:
+        with open(summary_file) as f:
+            summaries.append([line.rstrip("\n") for line in f if line.strip()])
+
+    reads = []
+    for lines in summaries:
+        match = SUMMARY_COUNT.match(lines[0]) if lines else None
+        reads.append(int(match.group('count')) if match else 0)
+
+    aggregated = []
+    # Lines of the enclosing levels, as (indent, count)
+    parents = []
+    for idx, line in enumerate(summaries[0] if summaries else []):
+        match = SUMMARY_COUNT.match(line)
+        rate = SUMMARY_RATE.match(line)
+        if match:
+            count = sum(int(SUMMARY_COUNT.match(lines[idx]).group('count'))
+                for lines in summaries)
+            indent = len(match.group('indent'))
+            while parents and parents[-1][0] >= indent:
+                parents.pop()
+            if match.group('pct') is not None:
+                total = parents[-1][1] if parents else count
+                pct = 100 * count / total if total else 0
+                line = "{}{} ({:.2f}%) {}".format(match.group('indent'), count, pct,
+                    match.group('text'))
+            else:
+                line = "{}{} {}".format(match.group('indent'), count, match.group('text'))
+            parents.append((indent, count))
+        elif rate:
+            rates = [float(SUMMARY_RATE.match(lines[idx]).group('pct'))
+                for lines in summaries]
+            pct = sum(r*n for r, n in zip(rates, reads)) / sum(reads) if sum(reads) else 0
+            line = "{:.2f}% overall alignment rate".format(pct)
+        aggregated.append(line)
+
+    with atomic_outputs([output]) as (tmp_output,):
+        with open(tmp_output, "w") as f:
+            f.write("\n".join(aggregated) + "\n")
+    return output
+
+def gather_chunks(bams, summary_files, bam_out, summary_out, threads=1) -> str:
+    '''
+        Merge the chunk BAM files of a sample with multithreaded samtools
+        merge and aggregate their alignment summaries
+
+        :param list bams: coordinate-sorted chunk BAM files
+        :param list summary_files: Hisat2 summary of every chunk
+        :param str bam_out: merged BAM
+        :param str summary_out: aggregated Hisat2 summary
+        :param int threads: samtools threads
+        :returns: the merged BAM
+        :rtype: str
+    '''
+    merge_bams(bams, bam_out, threads)
+    aggregate_alignment_summaries(summary_files, summary_out)
+    return bam_out
@@ -5,55 +5,160 @@ from yaml import SafeLoader
 import logging
 from collections import defaultdict
 import subprocess
-from src.utils import get_bin_path
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.tools import get_tool_path, ToolNotFound
 logger = logging.getLogger(__name__)
 
-main_dir = os.path.dirname(os.path.abspath(__file__))
-binaries_dir = os.path.join(main_dir, "../binaries")
-DOCKER = get_bin_path("docker")
+# Image id (digest) each docker image was last validated with, and when
+IMAGE_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME",
+    os.path.join(os.path.expanduser("~"), ".cache")), "rna_seq_pipeline",
+    "docker_images.json")
+# Seconds a validated image is trusted without listing the docker images
+IMAGE_CACHE_TTL = 6 * 3600
 
-class NGSbinaries():
-    HISAT2   = os.path.join(binaries_dir, "hisat2-2.2.1-Linux_x86_64/hisat2-2.2.1/hisat2")
-    SAMTOOLS = os.path.join(binaries_dir, "samtools/bin/samtools")
-    FASTP    = os.path.join(binaries_dir, "fastp")
-    PICARD   = os.path.join(binaries_dir, "picard.jar")
+_image_validation = None
 
-def load_docker_config(docker_yaml) -> dict():
+def load_docker_config(docker_yaml, wait=True) -> dict():
     '''
+        Load the docker images configuration and validate its images. With
+        wait=False validation runs on a background thread, concurrently with
+        the rest of startup; call wait_image_validation() to collect it
+
+        :param str docker_yaml: docker images yaml
+        :param bool wait: block until images have been validated
     '''
+    global _image_validation
     with open(docker_yaml) as f:
         docker_dict = yaml.load(f, Loader=SafeLoader)
 
-    for program in docker_dict:
-        image = docker_dict[program]['image']
-        validate_image(program, image)
+    images = [get_image_ref(program, docker_dict) for program in docker_dict]
+    executor = ThreadPoolExecutor(max_workers=1)
+    _image_validation = executor.submit(validate_images, images)
+    executor.shutdown(wait=False)
+    if wait:
+        wait_image_validation()
     return docker_dict
 
-def validate_image( program, image):
+def wait_image_validation() -> list:
+    '''
+        Wait for the image validation started by load_docker_config
+
+        :returns: images that were not found
+        :rtype: list
     '''
+    if _image_validation is None:
+        return []
+    return _image_validation.result()
+
+def get_image_ref(program, docker_dict) -> str:
+    '''
+        Image reference of a program, tagged with its configured version
     '''
+    image = docker_dict[program]['image']
+    if ":" in image.split("/")[-1]:
+        return image
+    return "{}:{}".format(image, docker_dict[program].get('version', 'latest'))
 
-    DOCKER = get_bin_path("docker")
-    cmd = '{} image ls {}'.format(DOCKER, image)
+def list_docker_images() -> dict:
+    '''
+        All local images with a single docker call
+
+        :returns: image reference (repository:tag) to its image id
+        :rtype: dict
+    '''
+    try:
+        docker = get_tool_path("docker")
+    except ToolNotFound as e:
+        logging.error(str(e))
+        return {}
+    cmd = "{} images --no-trunc --format '{{{{.Repository}}}}:{{{{.Tag}}}}\t{{{{.ID}}}}'"\
+        .format(docker)
     p1 = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
         stderr=subprocess.PIPE)
-    output = p1.stdout.decode('UTF-8')
-    error  = p1.stderr.decode('UTF-8')
-    if not error:
-        if output:
-            c_lines = 0
-            for line in output.split('\n'):
-                c_lines +=1
-            if c_lines !=3:
-                msg = (" ERROR: docker image {} was not found").format(image)
-                logging.error(msg)
-            else:
-                msg = (" INFO: found docker image {}").format(image)
-                logging.info(msg)
-        else:
+    if p1.returncode != 0:
+        msg = (" ERROR: Unable to list docker images: {}").format(
+            p1.stderr.decode('UTF-8').strip())
+        logging.error(msg)
+        return {}
+
+    images = {}
+    for line in p1.stdout.decode('UTF-8').split('\n'):
+        if "\t" in line:
+            ref, image_id = line.split("\t", 1)
+            images[ref] = image_id.strip()
+    return images
+
+def load_image_cache() -> dict:
+    '''
+        Image reference to the id it was last validated with, and when
+    '''
+    try:
+        with open(IMAGE_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_image_cache(image_cache) -> None:
+    '''
+        Write the image cache atomically, as runs may share it
+    '''
+    try:
+        os.makedirs(os.path.dirname(IMAGE_CACHE), exist_ok=True)
+        tmp_path = "{}.{}".format(IMAGE_CACHE, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(image_cache, f, indent=2)
+        os.replace(tmp_path, IMAGE_CACHE)
+    except OSError as e:
+        msg = (" WARNING: Unable to write docker image cache {}: {}").format(
+            IMAGE_CACHE, e)
+        logging.warning(msg)
+
+def validate_images(images) -> list:
+    '''
+        Check that docker images are available locally, all at once with a
+        single docker call. The on-disk cache keeps the image id (digest)
+        each image was validated with, and when. If every image was
+        validated within IMAGE_CACHE_TTL, docker is not called at all.
+        Otherwise an image whose id differs, e.g. a re-pulled :latest, is
+        reported and validated again
+
+        :param list images: image references
+        :returns: images that were not found
+        :rtype: list
+    '''
+    image_cache = load_image_cache()
+    now = time.time()
+    if all(now - image_cache.get(image, {}).get('checked', 0) < IMAGE_CACHE_TTL
+        for image in images):
+        for image in images:
+            msg = (" INFO: found docker image {} ({}, cached)").format(image,
+                image_cache[image]['id'][:19])
+            logging.info(msg)
+        return []
+    local_images = list_docker_images()
+
+    missing = []
+    for image in images:
+        image_id = local_images.get(image)
+        cached = image_cache.get(image)
+        if image_id is None:
             msg = (" ERROR: docker image {} was not found").format(image)
             logging.error(msg)
+            missing.append(image)
+            image_cache.pop(image, None)
+            continue
+        if cached is not None and cached['id'] != image_id:
+            msg = (" INFO: docker image {} changed from {} to {}").format(image,
+                cached['id'][:19], image_id[:19])
+        else:
+            msg = (" INFO: found docker image {} ({})").format(image, image_id[:19])
+        logging.info(msg)
+        image_cache[image] = {'id': image_id, 'checked': now}
 
+    save_image_cache(image_cache)
+    return missing
 
 def load_genome_config(config_yaml = None) -> dict():
     '''
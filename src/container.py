@@ -0,0 +1,245 @@
+import os
+import sys
+import re
+import uuid
+import shlex
+import logging
+import threading
+from src.tools import TOOLS, get_tool_path, ToolNotFound
+from src.runner import run_cmd
+from src.config import get_image_ref
+
+logger = logging.getLogger(__name__)
+
+# Where containerised tools run: "auto" runs them natively when installed
+# with the configured version and in docker otherwise
+BACKENDS = ("auto", "docker", "native")
+
+
+class ContainerFailed(Exception):
+    pass
+
+
+def get_mounts(paths) -> list:
+    '''
+        Folders to bind-mount so that every path is visible inside a
+        container under the same path. Nested folders are dropped
+
+        :param list paths: files or folders used by containerised commands
+        :rtype: list
+    '''
+    folders = set()
+    for path in paths:
+        path = os.path.realpath(path)
+        folders.add(path if os.path.isdir(path) else os.path.dirname(path))
+
+    mounts = []
+    for folder in sorted(folders):
+        if mounts and (folder + os.sep).startswith(mounts[-1].rstrip(os.sep) + os.sep):
+            continue
+        mounts.append(folder)
+    return mounts
+
+def get_volume_args(mounts) -> str:
+    '''
+        docker -v arguments mounting each folder on the same path
+    '''
+    return " ".join("-v {0}:{0}".format(shlex.quote(mount)) for mount in mounts)
+
+def get_docker_run_cmd(image, cmd, mounts) -> str:
+    '''
+        One-off container running cmd, with mounts on their host paths
+    '''
+    return "{} run --rm -u {}:{} {} --entrypoint sh {} -c {}".format(
+        get_tool_path('docker'), os.getuid(), os.getgid(), get_volume_args(mounts),
+        image, shlex.quote(cmd))
+
+
+class ContainerSession():
+    '''
+        A long-lived container of an image. It is started once, idle, and
+        commands are dispatched to it with docker exec, which avoids paying
+        the container startup cost on every tool invocation. Folders are
+        mounted on their host paths, so commands use host paths unchanged
+
+        :param str image: docker image
+        :param list mounts: folders mounted in the container
+    '''
+    def __init__(self, image, mounts):
+        self._image = image
+        self._mounts = list(mounts)
+        self._name = "rnaseq_{}_{}_{}".format(os.getpid(),
+            re.sub(r'[^A-Za-z0-9_.-]', "_", image.split("/")[-1]), uuid.uuid4().hex[:8])
+        self._running = False
+
+    @property
+    def image(self) -> str:
+        return self._image
+
+    @property
+    def name(self) -> str:
+        '''
+            :getter: Returns the container name
+        '''
+        return self._name
+
+    @property
+    def mounts(self) -> list:
+        return list(self._mounts)
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def start(self) -> None:
+        '''
+            Start the container detached, idling until it is stopped
+
+            :raises ContainerFailed: if docker could not start it
+        '''
+        msg = (" INFO: Starting container {} from {}").format(self._name, self._image)
+        logging.info(msg)
+
+        cmd = "{} run -d --rm --name {} -u {}:{} {} --entrypoint sleep {} infinity"\
+            .format(get_tool_path('docker'), self._name, os.getuid(), os.getgid(),
+            get_volume_args(self._mounts), self._image)
+        result = run_cmd(cmd, check=False)
+        if result.returncode != 0:
+            msg = (" ERROR: Unable to start a container from {}: {}").format(
+                self._image, result.stderr)
+            raise ContainerFailed(msg)
+        self._running = True
+
+    def exec_cmd(self, cmd) -> str:
+        '''
+            Command line running cmd inside the container
+        '''
+        return "{} exec {} sh -c {}".format(get_tool_path('docker'), self._name,
+            shlex.quote(cmd))
+
+    def stop(self) -> None:
+        '''
+            Remove the container, killing any command still running in it
+        '''
+        if not self._running:
+            return
+        self._running = False
+        result = run_cmd("{} rm -f {}".format(get_tool_path('docker'), self._name),
+            check=False)
+        if result.returncode != 0:
+            msg = (" WARNING: Unable to remove container {}: {}").format(
+                self._name, result.stderr)
+            logging.warning(msg)
+
+
+class ContainerPool():
+    '''
+        Container sessions of a run, one per image, started on first use
+        and removed when the pool is closed
+
+        :param list mounts: folders mounted in every container
+    '''
+    def __init__(self, mounts):
+        self._mounts = list(mounts)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, image) -> ContainerSession:
+        '''
+            Running session of an image, started if needed
+
+            :raises ContainerFailed: if the container could not be started
+        '''
+        with self._lock:
+            session = self._sessions.get(image)
+            if session is None or not session.running:
+                session = ContainerSession(image, self._mounts)
+                session.start()
+                self._sessions[image] = session
+            return session
+
+    def exec_cmd(self, image, cmd) -> str:
+        '''
+            Command line running cmd in the session of image
+        '''
+        return self.session(image).exec_cmd(cmd)
+
+    def close(self) -> None:
+        '''
+            Stop every session
+        '''
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def version_matches(version, wanted) -> bool:
+    '''
+        Whether a version string printed by a tool, e.g. "FastQC v0.11.9",
+        is the configured version. "latest" accepts any version
+    '''
+    if not wanted or str(wanted) == "latest":
+        return True
+    wanted = re.escape(str(wanted).lstrip("v"))
+    return re.search(r'(?<![\d.]){}(?![\d])'.format(wanted), version) is not None
+
+def use_native(program, docker_dict, backend="auto") -> bool:
+    '''
+        Whether program runs natively instead of from its docker image
+
+        :param str program: tool name, as on docker_dict and on PATH
+        :param dict docker_dict: docker images configuration
+        :param str backend: one of BACKENDS
+        :raises ToolNotFound: if backend is native and the tool is not
+            installed with the configured version
+    '''
+    if backend == "docker":
+        return False
+
+    wanted = docker_dict.get(program, {}).get('version')
+    native = TOOLS.is_available(program) and \
+        version_matches(TOOLS.version(program), wanted)
+    if backend == "native" and not native:
+        msg = (" ERROR: {} version {} is not installed").format(program, wanted)
+        raise ToolNotFound(msg)
+    return native
+
+def get_tool_cmd(program, cmd, paths, docker_dict, containers=None,
+    backend="auto") -> str:
+    '''
+        Command line running a containerised tool: natively when the backend
+        allows it, in the run container session when a pool is given,
+        otherwise in a one-off container
+
+        :param str program: tool name, key of docker_dict
+        :param str cmd: tool command, using host paths
+        :param list paths: files and folders used by cmd
+        :param dict docker_dict: docker images configuration
+        :param ContainerPool containers: container sessions of the run
+        :param str backend: one of BACKENDS
+    '''
+    if use_native(program, docker_dict, backend):
+        return "{} {}".format(get_tool_path(program), cmd.split(" ", 1)[1])
+
+    image = get_image_ref(program, docker_dict)
+    if containers is not None:
+        return containers.exec_cmd(image, cmd)
+    return get_docker_run_cmd(image, cmd, get_mounts(paths))
+
+def get_backend_version(program, docker_dict, backend="auto") -> str:
+    '''
+        Version of a containerised tool: the native tool version or its
+        configured image and version
+    '''
+    if use_native(program, docker_dict, backend):
+        return TOOLS.version(program)
+    return get_image_ref(program, docker_dict)
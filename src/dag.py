@@ -0,0 +1,323 @@
+import os
+import sys
+import logging
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+
+class TaskFailed(Exception):
+    pass
+
+class TaskSkipped():
+    '''
+        Result of a task whose outputs were found up to date
+    '''
+    pass
+
+class InvalidTaskGraph(Exception):
+    pass
+
+
+class Task():
+    '''
+        A single pipeline step. Tasks declare the files they read and write,
+        and the engine derives the execution order from them: a task depends
+        on every task producing one of its inputs
+
+        :param str name: unique task name, e.g. "hisat2:sample1"
+        :param callable func: function that performs the step
+        :param tuple args: positional arguments for func
+        :param dict kwargs: keyword arguments for func
+        :param list inputs: files read by the task
+        :param list outputs: files written by the task
+        :param list deps: names of extra tasks that must end before this one
+        :param str sample: sample the task belongs to, or list of the samples
+            of a task run for several of them, e.g. a batch alignment
+        :param int cpus: CPUs needed by the task
+        :param int mem_mb: memory needed by the task in MB
+        :param str cmd: command line run by the task, recorded in the manifest
+        :param str version: version of the tool run by the task
+        :param bool cacheable: outputs can be shared through the artifact cache
+    '''
+    def __init__(self, name, func, args=(), kwargs=None, inputs=(), outputs=(),
+        deps=(), sample=None, cpus=1, mem_mb=0, cmd=None, version=None,
+        cacheable=False):
+        self._name = name
+        self._func = func
+        self._args = tuple(args)
+        self._kwargs = kwargs if kwargs is not None else {}
+        self._inputs = list(inputs)
+        self._outputs = list(outputs)
+        self._deps = list(deps)
+        self._sample = sample
+        self._cpus = cpus
+        self._mem_mb = mem_mb
+        self._cmd = cmd
+        self._version = version
+        self._cacheable = cacheable
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def inputs(self) -> list:
+        return self._inputs
+
+    @property
+    def outputs(self) -> list:
+        return self._outputs
+
+    @property
+    def deps(self) -> list:
+        return self._deps
+
+    @property
+    def sample(self) -> str:
+        return self._sample
+
+    @property
+    def samples(self) -> list:
+        '''
+            :getter: Returns the samples the task belongs to
+        '''
+        if self._sample is None:
+            return []
+        if isinstance(self._sample, (list, tuple)):
+            return list(self._sample)
+        return [self._sample]
+
+    @property
+    def cpus(self) -> int:
+        return self._cpus
+
+    @property
+    def mem_mb(self) -> int:
+        return self._mem_mb
+
+    @property
+    def cmd(self) -> str:
+        return self._cmd
+
+    @property
+    def version(self) -> str:
+        return self._version
+
+    @property
+    def cacheable(self) -> bool:
+        return self._cacheable
+
+    def run(self):
+        '''
+            Execute the step
+        '''
+        return self._func(*self._args, **self._kwargs)
+
+
+class TaskGraph():
+    '''
+        Dependency graph of pipeline tasks. Any task whose upstream tasks
+        have ended is run, so independent steps run in parallel
+    '''
+    def __init__(self):
+        self._tasks = {}
+        self._producers = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __contains__(self, name):
+        return name in self._tasks
+
+    @property
+    def tasks(self) -> list:
+        return list(self._tasks.values())
+
+    def add(self, task) -> Task:
+        '''
+            Add a new task to the graph
+
+            :param Task task: task to be added
+            :raises InvalidTaskGraph: if the task name or any of its outputs
+                were already declared by another task
+        '''
+        if task.name in self._tasks:
+            msg = (" ERROR: duplicated task {}").format(task.name)
+            raise InvalidTaskGraph(msg)
+        for output in task.outputs:
+            if output in self._producers:
+                msg = (" ERROR: output {} is produced by both {} and {}")\
+                    .format(output, self._producers[output], task.name)
+                raise InvalidTaskGraph(msg)
+        for output in task.outputs:
+            self._producers[output] = task.name
+        self._tasks[task.name] = task
+        return task
+
+    def upstream(self, task) -> set:
+        '''
+            Names of the tasks that must end before task can start.
+            Inputs without a producer are external files (raw fastq, gtf...)
+        '''
+        upstream = set(task.deps)
+        for input in task.inputs:
+            if input in self._producers:
+                upstream.add(self._producers[input])
+        upstream.discard(task.name)
+        for name in upstream:
+            if name not in self._tasks:
+                msg = (" ERROR: task {} depends on unknown task {}")\
+                    .format(task.name, name)
+                raise InvalidTaskGraph(msg)
+        return upstream
+
+    def topological_order(self) -> list:
+        '''
+            Return task names sorted so that every task comes after its
+            upstream tasks
+
+            :raises InvalidTaskGraph: if the graph has cycles
+        '''
+        upstream = {name: self.upstream(task) for name, task in self._tasks.items()}
+        downstream = {name: set() for name in self._tasks}
+        for name, parents in upstream.items():
+            for parent in parents:
+                downstream[parent].add(name)
+
+        pending = {name: len(parents) for name, parents in upstream.items()}
+        ready = [name for name in self._tasks if pending[name] == 0]
+        order = []
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for child in sorted(downstream[name]):
+                pending[child] -= 1
+                if pending[child] == 0:
+                    ready.append(child)
+
+        if len(order) != len(self._tasks):
+            cyclic = sorted(set(self._tasks) - set(order))
+            msg = (" ERROR: cyclic dependencies between tasks: {}")\
+                .format(", ".join(cyclic))
+            raise InvalidTaskGraph(msg)
+        return order
+
+    @staticmethod
+    def _run_task(task, broker, manifest, cache, recorder):
+        '''
+            Run a task once its CPUs and memory fit the broker budget. Tasks
+            recorded as up to date in the manifest are skipped, and cacheable
+            tasks take their outputs from the artifact cache when possible
+        '''
+        if manifest is not None:
+            if manifest.is_up_to_date(task):
+                msg = (" INFO: Skipping up to date task {}").format(task.name)
+                logging.info(msg)
+                if recorder is not None:
+                    recorder.skip(task, "up_to_date")
+                return TaskSkipped()
+            manifest.invalidate(task)
+
+        key = None
+        if cache is not None and task.cacheable:
+            key = cache.key(task)
+        if key is not None and cache.fetch(key, task.outputs):
+            msg = (" INFO: Reusing cached outputs for task {}").format(task.name)
+            logging.info(msg)
+            if recorder is not None:
+                recorder.skip(task, "cached")
+            result = TaskSkipped()
+        else:
+            reserve = broker.reserve(task.cpus, task.mem_mb) if broker else nullcontext()
+            with reserve:
+                with recorder.step(task) if recorder else nullcontext():
+                    result = task.run()
+            if key is not None:
+                cache.store(key, task.outputs)
+
+        if manifest is not None:
+            manifest.record(task)
+        return result
+
+    def run(self, max_workers=1, broker=None, manifest=None, cache=None,
+        recorder=None, on_interrupt=None) -> dict:
+        '''
+            Run all tasks, up to max_workers at the same time. When a task
+            fails its downstream tasks are skipped, while the remaining
+            branches of the graph keep running
+
+            :param int max_workers: max. number of concurrent tasks
+            :param ResourceBroker broker: if given, tasks only start once
+                their CPU and memory needs fit the budget
+            :param RunManifest manifest: if given, only tasks whose inputs,
+                command line or tool version changed are run
+            :param ArtifactCache cache: if given, outputs of cacheable tasks
+                are shared with other runs
+            :param MetricsRecorder recorder: if given, collects timing and
+                resource usage of every task
+            :param callable on_interrupt: called on KeyboardInterrupt, before
+                waiting for running tasks, e.g. to kill their processes
+            :returns: task name to task return value
+            :rtype: dict
+            :raises TaskFailed: if any task failed
+        '''
+        order = self.topological_order()
+        upstream = {name: self.upstream(self._tasks[name]) for name in order}
+
+        results = {}
+        failed = []
+        skipped = set()
+        done = set()
+        running = {}
+
+        executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        try:
+            while len(done) + len(skipped) < len(order):
+                for name in order:
+                    if name in done or name in skipped or name in running.values():
+                        continue
+                    if upstream[name] & (skipped | set(failed)):
+                        msg = (" INFO: Skipping task {} as an upstream task failed")\
+                            .format(name)
+                        logging.info(msg)
+                        skipped.add(name)
+                        continue
+                    if upstream[name] <= done:
+                        future = executor.submit(self._run_task,
+                            self._tasks[name], broker, manifest, cache,
+                            recorder)
+                        running[future] = name
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        msg = (" ERROR: task {} failed: {}").format(name, e)
+                        logging.error(msg)
+                        failed.append(name)
+                        skipped.add(name)
+                    else:
+                        done.add(name)
+        except KeyboardInterrupt:
+            msg = " ERROR: Interrupted, stopping running tasks"
+            logging.error(msg)
+            if on_interrupt is not None:
+                on_interrupt()
+            raise
+        finally:
+            for future in running:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        if failed:
+            msg = (" ERROR: {} task(s) failed: {}").format(len(failed),
+                ", ".join(failed))
+            raise TaskFailed(msg)
+        return results
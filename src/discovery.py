@@ -0,0 +1,302 @@
+import os
+import sys
+import re
+import csv
+import logging
+from collections import namedtuple
+from types import MappingProxyType
+from src.sample import Sample
+from src.fastq import MissingFastqPair, FastqNotFound
+
+logger = logging.getLogger(__name__)
+
+# Illumina naming: <sample>_S<number>_L<lane>_R<read>_<chunk>.fastq.gz
+ILLUMINA_FASTQ = re.compile(
+    r'^(?P<sample>.+?)_S(?P<number>\d+)_L(?P<lane>\d+)_R(?P<read>[12])_(?P<chunk>\d+)'
+    r'\.(?:fastq|fq|fa)(?:\.gz)?$')
+# Other names: sample prefix before the first "_" and an R1/R2 tag
+OTHER_FASTQ = re.compile(r'^(?P<sample>[^_]+)_(?:.*_)?R(?P<read>[12])(?:[_.].*)?$')
+# Raw fastq files taken as input
+FASTQ_FILE = re.compile(r'\.(?:fastq|fa)\.gz$')
+# Files never taken as input: fastp outputs and unassigned reads
+SKIPPED_FASTQ = re.compile(r'trimmed|Undetermined')
+# Lane given to fastq files without lane information
+DEFAULT_LANE = "001"
+
+# Sample sheet sections listing the samples of a run
+SAMPLE_SHEET_SECTIONS = ("[Data]", "[BCLConvert_Data]")
+
+# Fastq files of a lane of a sample
+FastqPair = namedtuple('FastqPair', ['fq1', 'fq2'])
+# Sample of a sample sheet: fastq files are named after name and number
+SheetSample = namedtuple('SheetSample', ['name', 'number', 'project', 'sample_id',
+    'lanes'])
+
+
+def parse_fastq_name(fq) -> tuple:
+    '''
+        Sample, lane and read number (1 or 2) of a fastq file name. Extra
+        chunks of a lane (_002, ...) are reported as lanes of their own
+
+        :rtype: tuple
+        :returns: (sample, lane, read), or None if the name has no read tag
+    '''
+    name = os.path.basename(fq)
+    match = ILLUMINA_FASTQ.match(name)
+    if match:
+        lane = match.group('lane')
+        if int(match.group('chunk')) > 1:
+            lane = "{}.{}".format(lane, match.group('chunk'))
+        return match.group('sample'), lane, int(match.group('read'))
+    match = OTHER_FASTQ.match(name)
+    if match:
+        return match.group('sample'), DEFAULT_LANE, int(match.group('read'))
+    return None
+
+def scan_fastq_files(fastq_dir, recursive=False, exclude=()) -> list:
+    '''
+        Raw fastq files of a folder, listed in a single pass with scandir.
+        Hidden folders and the excluded ones are not walked into. Symlinked
+        folders are followed, each real folder once, so that a link loop or
+        a second link to a folder does not list its files again
+
+        :param str fastq_dir: input fastq directory
+        :param bool recursive: also scan sub-folders
+        :param list exclude: folders to skip, e.g. an output folder nested
+            in fastq_dir
+        :rtype: list
+    '''
+    exclude = {os.path.realpath(folder) for folder in exclude}
+    visited = {os.path.realpath(fastq_dir)}
+    fastq_files = []
+    pending = [fastq_dir]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not recursive or entry.name.startswith("."):
+                        continue
+                    folder = os.path.realpath(entry.path)
+                    if folder not in exclude and folder not in visited:
+                        visited.add(folder)
+                        pending.append(entry.path)
+                elif FASTQ_FILE.search(entry.name) and \
+                    not SKIPPED_FASTQ.search(entry.name):
+                    fastq_files.append(entry.path)
+    return sorted(fastq_files)
+
+def group_fastq_files(fastq_files) -> MappingProxyType:
+    '''
+        Index fastq files by sample, lane and read. The index is read-only
+
+        :param list fastq_files: fastq files
+        :returns: sample to {lane: FastqPair}, samples and lanes in order
+        :rtype: MappingProxyType
+        :raises MissingFastqPair: if a lane lacks its R1 or R2
+    '''
+    groups = {}
+    for fq in sorted(fastq_files):
+        parsed = parse_fastq_name(fq)
+        if parsed is None:
+            msg = (" WARNING: Skipping fastq without R1/R2 tag {}").format(fq)
+            logging.warning(msg)
+            continue
+        sample_name, lane, read = parsed
+        reads = groups.setdefault(sample_name, {}).setdefault(lane, {})
+        if read in reads:
+            msg = (" ERROR: Duplicated fastq for sample {} lane {}: {} {}").format(
+                sample_name, lane, reads[read], fq)
+            logging.error(msg)
+            raise ValueError(msg)
+        reads[read] = fq
+
+    sample_lanes = {}
+    for sample_name in sorted(groups):
+        lanes = {}
+        for lane, reads in sorted(groups[sample_name].items()):
+            if 1 not in reads or 2 not in reads:
+                msg = (" ERROR: Missing Fastq pair for sample {} lane {}: {}")\
+                    .format(sample_name, lane, list(reads.values())[0])
+                logging.error(msg)
+                raise MissingFastqPair(msg)
+            lanes[lane] = FastqPair(reads[1], reads[2])
+        sample_lanes[sample_name] = MappingProxyType(lanes)
+    return MappingProxyType(sample_lanes)
+
+def read_sample_sheet(sample_sheet) -> list:
+    '''
+        Samples of a bcl2fastq or BCL Convert sample sheet, in sheet order.
+        As both tools do, samples are numbered in order of appearance and
+        named after Sample_Name if given (bcl2fastq) or else Sample_ID
+
+        :param str sample_sheet: SampleSheet.csv
+        :rtype: list
+        :returns: list of SheetSample, with the lanes of each sample, empty
+            if the sheet has no Lane column
+    '''
+    header = None
+    rows = []
+    with open(sample_sheet, newline="") as f:
+        in_data = False
+        for line in csv.reader(f):
+            if line and line[0].strip().startswith("["):
+                in_data = line[0].strip() in SAMPLE_SHEET_SECTIONS
+                continue
+            if not in_data or not any(field.strip() for field in line):
+                continue
+            if header is None:
+                header = [field.strip() for field in line]
+            else:
+                rows.append(dict(zip(header, [field.strip() for field in line])))
+
+    if header is None or 'Sample_ID' not in header:
+        msg = (" ERROR: No [Data] section with a Sample_ID column in sample sheet {}")\
+            .format(sample_sheet)
+        logging.error(msg)
+        raise ValueError(msg)
+
+    samples = {}
+    for row in rows:
+        sample_id = row['Sample_ID']
+        if sample_id not in samples:
+            samples[sample_id] = SheetSample(row.get('Sample_Name') or sample_id,
+                len(samples) + 1, row.get('Sample_Project', ""), sample_id, [])
+        if row.get('Lane'):
+            samples[sample_id].lanes.append(int(row['Lane']))
+    return list(samples.values())
+
+def index_sample_sheet(sample_sheet, fastq_dir) -> MappingProxyType:
+    '''
+        Index the fastq files of the samples of a sample sheet without
+        scanning the whole run folder: only the folders where bcl2fastq and
+        BCL Convert write the files of each sample are listed, once each,
+        and file names are derived from the sheet
+
+        :param str sample_sheet: SampleSheet.csv of the run
+        :param str fastq_dir: output folder of bcl2fastq or BCL Convert
+        :rtype: MappingProxyType
+        :raises FastqNotFound: if a sample of the sheet has no fastq files
+    '''
+    listings = {}
+    fastq_files = []
+    for sheet_sample in read_sample_sheet(sample_sheet):
+        folders = [fastq_dir]
+        if sheet_sample.project:
+            folders.append(os.path.join(fastq_dir, sheet_sample.project))
+            folders.append(os.path.join(fastq_dir, sheet_sample.project,
+                sheet_sample.sample_id))
+        folders.append(os.path.join(fastq_dir, sheet_sample.sample_id))
+
+        prefix = "{}_S{}_".format(sheet_sample.name, sheet_sample.number)
+        lanes = {"L{:03d}".format(lane) for lane in sheet_sample.lanes}
+        sample_files = []
+        for folder in folders:
+            if folder not in listings:
+                listings[folder] = sorted(os.listdir(folder)) \
+                    if os.path.isdir(folder) else []
+            for name in listings[folder]:
+                if not name.startswith(prefix) or not FASTQ_FILE.search(name):
+                    continue
+                match = ILLUMINA_FASTQ.match(name)
+                if match is None or match.group('sample') != sheet_sample.name:
+                    continue
+                if lanes and "L" + match.group('lane') not in lanes:
+                    continue
+                sample_files.append(os.path.join(folder, name))
+
+        if not sample_files:
+            msg = (" ERROR: No fastq files for sample {} of sample sheet {}").format(
+                sheet_sample.name, sample_sheet)
+            logging.error(msg)
+            raise FastqNotFound(msg)
+        fastq_files.extend(sample_files)
+
+    return group_fastq_files(fastq_files)
+
+def index_fastq_files(fastq_dir, output_dir, recursive=False,
+    sample_sheet=None) -> MappingProxyType:
+    '''
+        Index the raw fastq files of a run by sample, lane and read, from a
+        sample sheet if given or else by scanning fastq_dir
+
+        :param str fastq_dir: input fastq directory
+        :param str output_dir: output directory, never scanned
+        :param bool recursive: also scan sub-folders of fastq_dir
+        :param str sample_sheet: bcl2fastq or BCL Convert SampleSheet.csv
+        :rtype: MappingProxyType
+    '''
+    if sample_sheet:
+        index = index_sample_sheet(sample_sheet, fastq_dir)
+    else:
+        index = group_fastq_files(scan_fastq_files(fastq_dir, recursive,
+            exclude=[output_dir]))
+    if not index:
+        msg = " ERROR: No input fastq files were detected"
+        logging.error(msg)
+        sys.exit()
+
+    msg = (" INFO: Found {} samples, {} fastq files").format(len(index),
+        2*sum(len(lanes) for lanes in index.values()))
+    logging.info(msg)
+    return index
+
+def create_samples(fastq_dir, output_dir, recursive=False, sample_sheet=None) -> list:
+    '''
+        Discover paired fastq files and create one Sample object per sample,
+        with all its lanes, together with its output folder structure. A
+        single-lane sample has fq1/fq2 set to its fastq files
+
+        :param str fastq_dir: input fastq directory
+        :param str output_dir: output directory
+        :param bool recursive: also scan sub-folders of fastq_dir
+        :param str sample_sheet: bcl2fastq or BCL Convert SampleSheet.csv
+        :returns: list of Sample objects
+        :rtype: list
+    '''
+    index = index_fastq_files(fastq_dir, output_dir, recursive, sample_sheet)
+
+    sample_list = []
+    for sample_name, lanes in index.items():
+        sample = Sample(sample_name)
+
+        sample_folder = os.path.join(output_dir, sample_name)
+        fastq_folder = os.path.join(sample_folder, "FASTQ_FOLDER")
+        os.makedirs(fastq_folder, exist_ok=True)
+
+        sample.add("sample_folder", sample_folder)
+        sample.add("fastq_folder", fastq_folder)
+        sample.add("sample_name", sample_name)
+        sample.add("lanes", lanes)
+        sample.add("raw_fastqs", [fq for pair in lanes.values() for fq in pair])
+        fq1, fq2 = next(iter(lanes.values()))
+        sample.add("fq1", fq1)
+        sample.add("fq2", fq2)
+
+        if len(lanes) > 1:
+            msg = (" INFO: Sample {} has {} lanes").format(sample_name, len(lanes))
+            logging.info(msg)
+        sample_list.append(sample)
+    return sample_list
+
+def get_lane_units(sample) -> list:
+    '''
+        One Sample object per lane of a sample, to trim and align lanes on
+        their own. Each lane has its own folder for trimmed fastq files and
+        fastp reports, and shares the BAM folder of the sample
+
+        :param Sample sample: multi-lane sample
+        :rtype: list
+    '''
+    units = []
+    for lane, (fq1, fq2) in sample.lanes.items():
+        unit = Sample("{}.L{}".format(sample.name, lane))
+        fastq_folder = os.path.join(sample.fastq_folder, "L" + lane)
+        os.makedirs(fastq_folder, exist_ok=True)
+        unit.add("sample_folder", sample.sample_folder)
+        unit.add("fastq_folder", fastq_folder)
+        unit.add("sample_name", sample.name)
+        unit.add("lane", lane)
+        unit.add("fq1", fq1)
+        unit.add("fq2", fq2)
+        units.append(unit)
+    return units
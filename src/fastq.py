@@ -3,12 +3,47 @@
 import sys
 import re
 import os.path
+import time
+import json
+import gzip
+import random
+import zlib
+import fcntl
+import hashlib
 import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from itertools import zip_longest, islice
+from queue import Empty
+import numpy as np
 import pyfastx
-from src.config import NGSbinaries
+from src.utils import atomic_outputs
 
 logger = logging.getLogger(__name__)
 
+# Reads handed over at once by a mate reader
+VALIDATION_BATCH_SIZE = 100000
+# Batches a mate reader may read ahead of the other one
+VALIDATION_QUEUE_SIZE = 2
+# Mate suffix of old-style read names, e.g. @read1/1
+MATE_SUFFIX = re.compile(r'/[12]$')
+# Folder of the output directory holding fastq statistics sidecars
+STATS_DIR = ".fastq_stats"
+# Bumped whenever the statistics change, so that sidecars are recomputed
+STATS_VERSION = 1
+# Phred+33 (Sanger / Illumina 1.8+) quality encoding
+PHRED_OFFSET = 33
+# Default folder of pyfastx indexes, shared by all runs of a user
+INDEX_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME",
+    os.path.join(os.path.expanduser("~"), ".cache")), "rna_seq_pipeline",
+    "fastq_index")
+# Written next to an index once it is complete
+INDEX_DONE_SUFFIX = ".done"
+# Streaming subsample: read pairs read per read pair kept, so that the draw
+# stops early instead of reading whole files
+SUBSAMPLE_POOL_FACTOR = 10
+
 class FastqNotFound(Exception):
     pass
 
@@ -40,15 +75,21 @@ class Fastq:
         Fastq class. This class automatically validates fastq nomenclature and file consistency
 
         :param str fq: fastq file
+        :param str stats_dir: output folder where statistics are persisted,
+            see get_fastq_stats. If None they are only kept in memory
+        :py:meth:`stats`
         :py:meth:`check_consistency`
         :py:meth:`mean_read_length`
         :py:meth:`check_nomenclature`
     '''
 
-    def __init__(self, fq, expect_paired=True, force_naming_convention=True):
+    def __init__(self, fq, expect_paired=True, force_naming_convention=True,
+        stats_dir=None):
         self._fq  = fq
         self._expect_paired = expect_paired
         self._paired = False
+        self._stats_dir = stats_dir
+        self._stats = None
 
         if not os.path.isfile(self._fq):
             msg = ("Input Fastq {} not found").format(self._fq)
@@ -151,19 +192,24 @@ class Fastq:
             return(fq_tmp[0])
 
     @property
-    def mean_read_length(self) -> int:
+    def stats(self) -> dict:
+        '''
+            :getter: Returns the statistics of the fastq file, computed on
+                first access only and persisted if stats_dir was given
         '''
-            Calculate the mean read length in base pairs
+        if self._stats is None:
+            self._stats = get_fastq_stats(self._fq, self._stats_dir)
+        return self._stats
 
-            :param fastq: fastq file to be checked
-            :type: str
-            :returns: returns the mean read length
-            :rtype: int
+    @property
+    def mean_read_length(self) -> float:
         '''
-        fq = pyfastx.Fastx(self._fq1)
-        mean_length = fq.mean
+            Mean read length in base pairs
 
-        return mean_length
+            :returns: returns the mean read length
+            :rtype: float
+        '''
+        return self.stats['mean_length']
 
     def check_consistency(self) -> bool:
         '''
@@ -171,41 +217,25 @@ class Fastq:
 
             - Check that SEQ and QUAL have equal lengths
             - Check that fastq1 and fastq2 have equal read number
+            - Check that mates have the same read name
 
-            :param str fastq1: fastq1 file to be checked
-            :param str fastq2: fastq2 file to be checked
+            See validate_fastq_pair
 
             :returns: returns True if no issues were detected, otherwise False
             :rtype: bool
         '''
-        is_consistent = True
-        fq1_reads = 0
-        fq1 = pyfastx.Fastx(self.fq1)
-        for name,seq,qual,comment in fq1:
-            fq1_reads+=1
-            if len(seq) != len(qual):
-                msg = (" ERROR: Inconsistent length between SEQ and QUAL on line {} from file {}").\
-                    format(str(fq1_reads), self.fq1)
-                logging.error(msg)
-                is_consistent = False
-
         if self._paired is True:
-            fq2_reads = 0
-            fq2 = pyfastx.Fastx(self.fq2)
-            for name,seq,qual,comment in fq2:
-                fq2_reads+=1
-                if len(seq) != len(qual):
-                    msg = (" ERROR: Inconsistent length between SEQ and QUAL on line {} from file {}").\
-                        format(str(fq2_reads), self.fq2)
-                    logging.error(msg)
-                    is_consistent =  False
+            return validate_fastq_pair(self.fq1, self.fq2)['is_consistent']
 
-            if fq1_reads != fq2_reads:
-                msg = (" ERROR: Unequal total reads between fq1 {}:{} and fq2 {}:{}").\
-                    format( str(fq1_reads), self.fq1, str(fq2_reads), self.fq2)
+        fq_reads = 0
+        for name, seq, qual, comment in pyfastx.Fastx(self._fq):
+            fq_reads += 1
+            if len(seq) != len(qual):
+                msg = (" ERROR: Inconsistent length between SEQ and QUAL on read {} from file {}").\
+                    format(str(fq_reads), self._fq)
                 logging.error(msg)
-                is_consistent = False
-        return is_consistent
+                return False
+        return True
 
     def check_nomenclature(self) -> bool:
         '''
@@ -279,3 +309,603 @@ class Fastq:
             if re.search('_S[0-9]+_L[0-9]+_R[12]_[0-9]+', self._fq) is None:
                 is_okay = False
         return is_okay
+
+
+class FastqStatsCounter():
+    '''
+        Read count, read lengths, base composition and quality histogram of
+        a fastq file, counted over batches of reads with NumPy
+    '''
+    def __init__(self):
+        self._reads = 0
+        self._bases = 0
+        self._min_length = None
+        self._max_length = 0
+        self._composition = np.zeros(256, dtype=np.int64)
+        self._qualities = np.zeros(256, dtype=np.int64)
+
+    def add_batch(self, seqs, quals) -> None:
+        '''
+            Count a batch of reads
+
+            :param list seqs: read sequences
+            :param list quals: read qualities
+        '''
+        if not seqs:
+            return
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        self._reads += len(seqs)
+        self._bases += int(lengths.sum())
+        batch_min = int(lengths.min())
+        self._min_length = batch_min if self._min_length is None \
+            else min(self._min_length, batch_min)
+        self._max_length = max(self._max_length, int(lengths.max()))
+        self._composition += np.bincount(np.frombuffer("".join(seqs).encode(),
+            dtype=np.uint8), minlength=256)
+        self._qualities += np.bincount(np.frombuffer("".join(quals).encode(),
+            dtype=np.uint8), minlength=256)
+
+    def to_dict(self) -> dict:
+        '''
+            Statistics counted so far
+        '''
+        composition = {base: int(self._composition[ord(base)] +
+            self._composition[ord(base.lower())]) for base in "ACGT"}
+        composition['N'] = self._bases - sum(composition.values())
+        gc = composition['G'] + composition['C']
+        return {
+            'reads': self._reads,
+            'bases': self._bases,
+            'mean_length': round(self._bases / self._reads, 2) if self._reads else 0,
+            'min_length': self._min_length or 0,
+            'max_length': self._max_length,
+            'base_composition': composition,
+            'gc_pct': round(100 * gc / self._bases, 2) if self._bases else 0,
+            'quality_histogram': {q - PHRED_OFFSET: int(count)
+                for q, count in enumerate(self._qualities) if count and q >= PHRED_OFFSET},
+        }
+
+
+def get_mate_hashes(names) -> np.ndarray:
+    '''
+        Hashes of read names with their /1 or /2 suffix removed, so that
+        both mates of a pair have the same hash. crc32 is used since it is
+        the same in every process, unlike hash()
+    '''
+    return np.fromiter((zlib.crc32(MATE_SUFFIX.sub("", name).encode())
+        for name in names), dtype=np.uint32, count=len(names))
+
+def read_mate_batches(fq, batch_size, queue, stats_dir=None) -> None:
+    '''
+        Worker reading a fastq file and putting, for each batch of reads, the
+        mate name hashes, read lengths and number of reads whose SEQ and QUAL
+        lengths differ. None is put at the end, or an error message. With a
+        stats_dir the statistics of the file are counted in the same pass
+        and written to its sidecar, see get_fastq_stats
+
+        :param str fq: fastq file
+        :param int batch_size: reads per batch
+        :param Queue queue: bounded queue read by validate_fastq_pair
+        :param str stats_dir: output directory holding the stats sidecars
+    '''
+    counter = FastqStatsCounter() if stats_dir is not None else None
+
+    def put_batch(names, seqs, quals):
+        seq_lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        qual_lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+        bad_quals = int(np.count_nonzero(seq_lengths != qual_lengths))
+        if counter is not None:
+            counter.add_batch(seqs, quals)
+        queue.put((get_mate_hashes(names), seq_lengths, bad_quals))
+
+    try:
+        # Taken first, so that a file changed while read gets no sidecar
+        identity = get_fastq_identity(fq)
+        names, seqs, quals = [], [], []
+        for name, seq, qual, comment in pyfastx.Fastx(fq):
+            names.append(name)
+            seqs.append(seq)
+            quals.append(qual)
+            if len(names) == batch_size:
+                put_batch(names, seqs, quals)
+                names, seqs, quals = [], [], []
+        if names:
+            put_batch(names, seqs, quals)
+        if counter is not None:
+            save_fastq_stats(fq, stats_dir, counter.to_dict(), identity)
+    except Exception as e:
+        queue.put(" ERROR: Unable to read {}: {}".format(fq, e))
+        return
+    queue.put(None)
+
+def get_mate_batch(queue, process, fq):
+    '''
+        Next message of a mate reader
+
+        :raises InvalidFastqFile: if the reader failed or died
+    '''
+    while True:
+        try:
+            batch = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive() and queue.empty():
+                msg = (" ERROR: Reader of {} exited unexpectedly").format(fq)
+                logging.error(msg)
+                raise InvalidFastqFile(fq)
+    if isinstance(batch, str):
+        logging.error(batch)
+        raise InvalidFastqFile(fq)
+    return batch
+
+def validate_fastq_pair(fq1, fq2, batch_size=VALIDATION_BATCH_SIZE, stats_dir=None) -> dict:
+    '''
+        Validate a pair of fastq files in a single pass. Each file is parsed
+        by a worker process, and batches of both mates are checked in
+        lockstep with NumPy: SEQ and QUAL lengths, mate names and read
+        counts. Read counts and length histograms come from the same pass,
+        as do the statistics sidecars of both files if stats_dir is given
+
+        :param str fq1: fastq1 file
+        :param str fq2: fastq2 file
+        :param int batch_size: reads compared at once
+        :param str stats_dir: output directory holding the stats sidecars
+        :returns: read counts, length histograms, errors found,
+            reads per second and is_consistent
+        :rtype: dict
+        :raises InvalidFastqFile: if a file could not be read
+    '''
+    start = time.perf_counter()
+    fastq_list = [fq1, fq2]
+    reads = [0, 0]
+    histograms = [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)]
+    bad_quals = [0, 0]
+    name_mismatches = 0
+    first_name_mismatch = None
+
+    # Workers are spawned: forking a process with running threads is unsafe
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=VALIDATION_QUEUE_SIZE) for fq in fastq_list]
+    processes = [context.Process(target=read_mate_batches, args=(fq, batch_size, queue, stats_dir),
+        daemon=True) for fq, queue in zip(fastq_list, queues)]
+    for process in processes:
+        process.start()
+
+    try:
+        done = [False, False]
+        while not all(done):
+            batches = [None, None]
+            for idx in range(2):
+                if not done[idx]:
+                    batches[idx] = get_mate_batch(queues[idx], processes[idx],
+                        fastq_list[idx])
+                    done[idx] = batches[idx] is None
+
+            for idx, batch in enumerate(batches):
+                if batch is None:
+                    continue
+                hashes, seq_lengths, batch_bad_quals = batch
+                histogram = np.bincount(seq_lengths)
+                if len(histogram) > len(histograms[idx]):
+                    histogram[:len(histograms[idx])] += histograms[idx]
+                    histograms[idx] = histogram
+                else:
+                    histograms[idx][:len(histogram)] += histogram
+                bad_quals[idx] += batch_bad_quals
+
+            # Batches of both mates cover the same reads until one file ends
+            if batches[0] is not None and batches[1] is not None:
+                size = min(len(batches[0][0]), len(batches[1][0]))
+                mismatches = np.flatnonzero(batches[0][0][:size] != batches[1][0][:size])
+                if len(mismatches) and first_name_mismatch is None:
+                    first_name_mismatch = reads[0] + int(mismatches[0]) + 1
+                name_mismatches += len(mismatches)
+            for idx, batch in enumerate(batches):
+                if batch is not None:
+                    reads[idx] += len(batch[0])
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    seconds = time.perf_counter() - start
+    result = {
+        'fq1': fq1,
+        'fq2': fq2,
+        'reads_fq1': reads[0],
+        'reads_fq2': reads[1],
+        'length_histogram_fq1': {length: int(count)
+            for length, count in enumerate(histograms[0]) if count},
+        'length_histogram_fq2': {length: int(count)
+            for length, count in enumerate(histograms[1]) if count},
+        'qual_length_mismatches_fq1': bad_quals[0],
+        'qual_length_mismatches_fq2': bad_quals[1],
+        'name_mismatches': name_mismatches,
+        'first_name_mismatch': first_name_mismatch,
+        'seconds': round(seconds, 3),
+        'reads_per_second': int(sum(reads) / seconds) if seconds else 0,
+    }
+    result['is_consistent'] = reads[0] == reads[1] and reads[0] > 0 \
+        and not any(bad_quals) and not name_mismatches
+
+    for idx, fq in enumerate(fastq_list):
+        if bad_quals[idx]:
+            msg = (" ERROR: {} reads with inconsistent length between SEQ and QUAL"
+                " from file {}").format(bad_quals[idx], fq)
+            logging.error(msg)
+    if reads[0] != reads[1]:
+        msg = (" ERROR: Unequal total reads between fq1 {}:{} and fq2 {}:{}").\
+            format(str(reads[0]), fq1, str(reads[1]), fq2)
+        logging.error(msg)
+    if name_mismatches:
+        msg = (" ERROR: {} mates with different read names between fq1 {} and fq2 {},"
+            " first on read {}").format(name_mismatches, fq1, fq2, first_name_mismatch)
+        logging.error(msg)
+    if not reads[0] and not reads[1]:
+        msg = (" ERROR: No reads found on {} and {}").format(fq1, fq2)
+        logging.error(msg)
+
+    msg = (" INFO: Validated {} and {}: {} read pairs in {:.1f}s ({} reads/s)").format(
+        os.path.basename(fq1), os.path.basename(fq2), reads[0], seconds,
+        result['reads_per_second'])
+    logging.info(msg)
+    return result
+
+def get_validation_report(sample_name, output_dir) -> str:
+    '''
+        Validation report of the fastq files of a sample
+    '''
+    return os.path.join(output_dir, sample_name + ".validation.json")
+
+def validate_sample(sample_name, lanes, report, stats_dir=None) -> str:
+    '''
+        Validate every lane of a sample and write a json report. With a
+        stats_dir the report also holds the statistics of every file, which
+        the validation pass leaves in their sidecars
+
+        :param str sample_name: sample name
+        :param dict lanes: lane to (fq1, fq2)
+        :param str report: json report
+        :param str stats_dir: output directory holding the stats sidecars
+        :returns: the report
+        :rtype: str
+        :raises InvalidFastqFile: if any lane is not consistent
+    '''
+    results = {lane: validate_fastq_pair(fq1, fq2, stats_dir=stats_dir)
+        for lane, (fq1, fq2) in lanes.items()}
+    if stats_dir is not None:
+        for result in results.values():
+            for key in ('fq1', 'fq2'):
+                result['stats_' + key] = get_fastq_stats(result[key], stats_dir)
+    with atomic_outputs([report]) as tmp_outputs:
+        with open(tmp_outputs[0], "w") as f:
+            json.dump({'sample': sample_name, 'lanes': results}, f, indent=2)
+
+    for result in results.values():
+        if not result['is_consistent']:
+            msg = (" ERROR: Inconsistent fastq pair {} {} for sample {}").format(
+                result['fq1'], result['fq2'], sample_name)
+            logging.error(msg)
+            raise InvalidFastqFile(result['fq1'])
+    return report
+
+def compute_fastq_stats(fq, batch_size=VALIDATION_BATCH_SIZE) -> dict:
+    '''
+        Statistics of a fastq file, see FastqStatsCounter
+
+        :param str fq: fastq file
+        :param int batch_size: reads counted at once
+        :rtype: dict
+    '''
+    counter = FastqStatsCounter()
+    seqs, quals = [], []
+    for name, seq, qual, comment in pyfastx.Fastx(fq):
+        seqs.append(seq)
+        quals.append(qual)
+        if len(seqs) == batch_size:
+            counter.add_batch(seqs, quals)
+            seqs, quals = [], []
+    if seqs:
+        counter.add_batch(seqs, quals)
+    return counter.to_dict()
+
+def get_fastq_identity(fq) -> dict:
+    '''
+        Path, size and modification time of a fastq file: its statistics are
+        reused for as long as they stay the same
+    '''
+    st = os.stat(fq)
+    return {'path': os.path.realpath(fq), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def get_stats_sidecar(fq, output_dir) -> str:
+    '''
+        Statistics sidecar of a fastq file, kept in the output directory so
+        that read-only input folders are never written. Files with the same
+        name on different folders get different sidecars
+    '''
+    path_hash = "{:08x}".format(zlib.crc32(os.path.realpath(fq).encode()))
+    name = "{}.{}.stats.json".format(os.path.basename(fq), path_hash)
+    return os.path.join(output_dir, STATS_DIR, name)
+
+def load_fastq_stats(fq, output_dir, identity=None):
+    '''
+        Statistics of a fastq file read from its sidecar, or None if there
+        is no sidecar or the file changed since it was written
+    '''
+    identity = identity or get_fastq_identity(fq)
+    sidecar = get_stats_sidecar(fq, output_dir)
+    if not os.path.isfile(sidecar):
+        return None
+    try:
+        with open(sidecar) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('version') != STATS_VERSION or cached.get('fastq') != identity:
+        return None
+    stats = cached['stats']
+    # json object keys are strings
+    stats['quality_histogram'] = {int(q): count
+        for q, count in stats['quality_histogram'].items()}
+    return stats
+
+def save_fastq_stats(fq, output_dir, stats, identity=None) -> str:
+    '''
+        Write the statistics of a fastq file to its sidecar
+
+        :param str fq: fastq file
+        :param str output_dir: output directory holding the sidecars
+        :param dict stats: statistics, see FastqStatsCounter
+        :param dict identity: file identity the stats were counted on
+        :returns: the sidecar
+        :rtype: str
+    '''
+    sidecar = get_stats_sidecar(fq, output_dir)
+    os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+    with atomic_outputs([sidecar]) as tmp_outputs:
+        with open(tmp_outputs[0], "w") as f:
+            json.dump({'version': STATS_VERSION,
+                'fastq': identity or get_fastq_identity(fq), 'stats': stats}, f, indent=2)
+    return sidecar
+
+def get_fastq_stats(fq, output_dir=None) -> dict:
+    '''
+        Statistics of a fastq file, see FastqStatsCounter. With an output
+        directory they are read from the sidecar if the file did not change
+        since it was written, and the sidecar is written otherwise
+
+        :param str fq: fastq file
+        :param str output_dir: output directory holding the sidecars
+        :rtype: dict
+    '''
+    if output_dir is None:
+        return compute_fastq_stats(fq)
+
+    identity = get_fastq_identity(fq)
+    stats = load_fastq_stats(fq, output_dir, identity)
+    if stats is not None:
+        return stats
+
+    msg = (" INFO: Computing statistics of {}").format(fq)
+    logging.info(msg)
+    stats = compute_fastq_stats(fq)
+    save_fastq_stats(fq, output_dir, stats, identity)
+    return stats
+
+
+class FastqIndexCache():
+    '''
+        Placement and reuse of pyfastx indexes. pyfastx writes the .fxi
+        index of a file next to it, which fails on read-only sequencer shares
+        and is redone whenever the file is opened through another path. Here
+        a file is opened through a symlink in the cache folder instead, so
+        the index is written there. The link folder is named after the file
+        identity (name, size and mtime), so the index is reused by every run
+        and every path of the same file
+
+        :param str cache_dir: folder holding links and indexes, created on
+            the first index only
+    '''
+    def __init__(self, cache_dir=None):
+        self._cache_dir = os.path.abspath(cache_dir or INDEX_CACHE_DIR)
+        self._lock = threading.Lock()
+
+    @property
+    def cache_dir(self) -> str:
+        return self._cache_dir
+
+    def get_key(self, fq) -> str:
+        '''
+            Identity of a fastq file: its name, size and modification time
+        '''
+        st = os.stat(fq)
+        identity = "{}:{}:{}".format(os.path.basename(fq), st.st_size, st.st_mtime_ns)
+        return hashlib.sha1(identity.encode()).hexdigest()[:16]
+
+    def get_link(self, fq) -> str:
+        '''
+            Symlink through which a fastq file is opened, named as the file
+        '''
+        return os.path.join(self._cache_dir, self.get_key(fq), os.path.basename(fq))
+
+    def get_index(self, fq) -> str:
+        '''
+            pyfastx index of a fastq file, written next to its link
+        '''
+        return self.get_link(fq) + ".fxi"
+
+    def get_done_marker(self, fq) -> str:
+        '''
+            File written once the index of a fastq file is complete
+        '''
+        return self.get_index(fq) + INDEX_DONE_SUFFIX
+
+    @contextmanager
+    def _locked(self, folder):
+        '''
+            Exclusive lock on the index of a file, shared with other runs
+        '''
+        with self._lock:
+            with open(os.path.join(folder, ".lock"), "w") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def open(self, fq):
+        '''
+            Indexed fastq file, with its index built on first use only
+
+            :param str fq: fastq file
+            :returns: pyfastx.Fastq object, indexable by read number
+            :raises FastqNotFound: if the file does not exist
+        '''
+        if not os.path.isfile(fq):
+            msg = ("Input Fastq {} not found").format(fq)
+            logging.error(msg)
+            raise FastqNotFound(msg)
+
+        link = self.get_link(fq)
+        folder = os.path.dirname(link)
+        os.makedirs(folder, exist_ok=True)
+        with self._locked(folder):
+            # The link follows the file to its current path
+            target = os.path.realpath(fq)
+            if not os.path.islink(link) or os.readlink(link) != target:
+                os.symlink(target, link + ".tmp")
+                os.replace(link + ".tmp", link)
+
+            index = self.get_index(fq)
+            done_marker = self.get_done_marker(fq)
+            if os.path.exists(index) and not os.path.exists(done_marker):
+                os.remove(index)
+            if not os.path.exists(index):
+                msg = (" INFO: Building the pyfastx index of {}").format(fq)
+                logging.info(msg)
+            indexed_fq = pyfastx.Fastq(link)
+            open(done_marker, "w").close()
+        return indexed_fq
+
+    def is_indexed(self, fq) -> bool:
+        '''
+            Whether the index of a fastq file is already complete, so that
+            opening the file does not read it through
+        '''
+        return os.path.exists(self.get_index(fq)) and \
+            os.path.exists(self.get_done_marker(fq))
+
+    def read_count(self, fq) -> int:
+        '''
+            Number of reads of a fastq file, read from its index
+        '''
+        return len(self.open(fq))
+
+
+def index_fastqs(fastq_list, cache_dir=None) -> list:
+    '''
+        Build the missing pyfastx indexes of fastq files in the index cache,
+        so that their reads can be fetched at random by this and later runs
+
+        :param list fastq_list: fastq files
+        :param str cache_dir: folder of the indexes
+        :returns: the done marker of every index
+        :rtype: list
+    '''
+    index_cache = FastqIndexCache(cache_dir)
+    for fq in fastq_list:
+        index_cache.open(fq)
+    return [index_cache.get_done_marker(fq) for fq in fastq_list]
+
+def subsample_fastq_pair(fq1, fq2, reads, out_fq1, out_fq2, index_cache, seed=0) -> int:
+    '''
+        Write a random subset of read pairs, fetched through the pyfastx
+        index: only the gzip blocks holding the chosen reads are decompressed
+        instead of the whole files
+
+        :param str fq1: fastq1 file
+        :param str fq2: fastq2 file
+        :param int reads: read pairs to keep
+        :param str out_fq1: gzipped subsample of fq1
+        :param str out_fq2: gzipped subsample of fq2
+        :param FastqIndexCache index_cache: index cache
+        :param int seed: random seed, the same subset is drawn for a seed
+        :returns: read pairs written
+        :rtype: int
+        :raises InvalidFastqFile: if fq1 and fq2 have unequal read counts
+    '''
+    indexed_fqs = [index_cache.open(fq1), index_cache.open(fq2)]
+    total = len(indexed_fqs[0])
+    if total != len(indexed_fqs[1]):
+        msg = (" ERROR: Unequal total reads between fq1 {}:{} and fq2 {}:{}").\
+            format(str(total), fq1, str(len(indexed_fqs[1])), fq2)
+        logging.error(msg)
+        raise InvalidFastqFile(fq1)
+
+    # Fetched in file order, so that reads near each other share gzip blocks
+    reads = min(reads, total)
+    rng = np.random.default_rng(seed)
+    read_ids = np.sort(rng.choice(total, size=reads, replace=False))
+
+    with atomic_outputs([out_fq1, out_fq2]) as tmp_outputs:
+        for indexed_fq, tmp_output in zip(indexed_fqs, tmp_outputs):
+            with gzip.open(tmp_output, "wt", compresslevel=1) as f:
+                for read_id in read_ids:
+                    f.write(indexed_fq[int(read_id)].raw)
+    return reads
+
+def get_fastq_record(name, seq, qual, comment) -> str:
+    '''
+        Fastq record of a read, as parsed by pyfastx.Fastx
+    '''
+    header = "{} {}".format(name, comment) if comment else name
+    return "@{}\n{}\n+\n{}\n".format(header, seq, qual)
+
+def stream_subsample_fastq_pairs(pairs, reads, out_fq1, out_fq2, seed=0) -> int:
+    '''
+        Write a random subset of the read pairs of several fastq pairs, drawn
+        by reservoir sampling in a single streaming pass: no index is built
+        and only the kept pairs are held in memory. The pass stops after
+        SUBSAMPLE_POOL_FACTOR times the kept read pairs, shared evenly by the
+        fastq pairs, so the subset is drawn from the head of every lane rather
+        than from whole files
+
+        :param list pairs: (fq1, fq2) tuples, read one after the other
+        :param int reads: read pairs to keep
+        :param str out_fq1: gzipped subsample of the fastq1 files
+        :param str out_fq2: gzipped subsample of the fastq2 files
+        :param int seed: random seed, the same subset is drawn for a seed
+        :returns: read pairs written
+        :rtype: int
+        :raises InvalidFastqFile: if a fq1 and fq2 have unequal read counts
+            within the read pairs read
+    '''
+    rng = random.Random(seed)
+    reservoir = []
+    seen = 0
+    pair_pool = -(-reads * SUBSAMPLE_POOL_FACTOR // max(len(pairs), 1))
+    for fq1, fq2 in pairs:
+        records = zip_longest(pyfastx.Fastx(fq1), pyfastx.Fastx(fq2))
+        for record1, record2 in islice(records, pair_pool):
+            if record1 is None or record2 is None:
+                msg = (" ERROR: Unequal total reads between fq1 {} and fq2 {}").\
+                    format(fq1, fq2)
+                logging.error(msg)
+                raise InvalidFastqFile(fq1)
+            if seen < reads:
+                reservoir.append((seen, record1, record2))
+            else:
+                slot = rng.randrange(seen + 1)
+                if slot < reads:
+                    reservoir[slot] = (seen, record1, record2)
+            seen += 1
+
+    # Written in file order, as the indexed subsample is
+    reservoir.sort(key=lambda kept: kept[0])
+    with atomic_outputs([out_fq1, out_fq2]) as tmp_outputs:
+        for mate, tmp_output in enumerate(tmp_outputs, 1):
+            with gzip.open(tmp_output, "wt", compresslevel=1) as f:
+                for kept in reservoir:
+                    f.write(get_fastq_record(*kept[mate]))
+    return len(reservoir)
@@ -0,0 +1,390 @@
+import os
+import sys
+import json
+import logging
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pyfastx
+from src.utils import atomic_outputs
+
+logger = logging.getLogger(__name__)
+
+# Reads converted to arrays at once
+BATCH_SIZE = 100000
+# Phred+33 (Sanger / Illumina 1.8+) quality encoding
+PHRED_OFFSET = 33
+MAX_QUALITY = 93
+# Like FastQC, overrepresented sequences are tracked on the first reads
+# only, truncated to 50bp, and reported above 0.1% of all reads
+OVERREPRESENTED_READS = 100000
+OVERREPRESENTED_LENGTH = 50
+OVERREPRESENTED_MIN_PCT = 0.1
+# FastQC version written on reports, for the tools that parse them
+FASTQC_COMPAT_VERSION = "0.11.9"
+# Bumped whenever the statistics change, so that reports are recomputed
+QC_VERSION = "fastq_qc 1.0 (numpy {})".format(np.__version__)
+
+_G, _C, _N = ord("G"), ord("C"), ord("N")
+
+
+class FastqQC():
+    '''
+        FastQC-like statistics of a fastq file, accumulated over batches of
+        reads with vectorised NumPy: per-base quality, per-sequence GC
+        content, per-base N content, length distribution and overrepresented
+        sequences
+
+        :param str fq: fastq file
+    '''
+    def __init__(self, fq):
+        self._fq = fq
+        self._reads = 0
+        self._bases = 0
+        self._gc_bases = 0
+        self._quality_counts = np.zeros((0, MAX_QUALITY + 1), dtype=np.int64)
+        self._n_counts = np.zeros(0, dtype=np.int64)
+        self._length_counts = np.zeros(0, dtype=np.int64)
+        self._gc_counts = np.zeros(101, dtype=np.int64)
+        self._prefixes = Counter()
+
+    @property
+    def fq(self) -> str:
+        return self._fq
+
+    @property
+    def reads(self) -> int:
+        '''
+            :getter: Returns the number of reads processed
+        '''
+        return self._reads
+
+    def _grow(self, max_length) -> None:
+        '''
+            Extend the per-position arrays up to max_length bases
+        '''
+        extra = max_length - len(self._n_counts)
+        if extra <= 0:
+            return
+        self._quality_counts = np.vstack([self._quality_counts,
+            np.zeros((extra, MAX_QUALITY + 1), dtype=np.int64)])
+        self._n_counts = np.concatenate([self._n_counts, np.zeros(extra, dtype=np.int64)])
+
+    def add_batch(self, seqs, quals) -> None:
+        '''
+            Add a batch of reads
+
+            :param list seqs: read sequences
+            :param list quals: read qualities, Phred+33 encoded
+        '''
+        if not seqs:
+            return
+        lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64,
+            count=len(seqs))
+        seq = np.frombuffer("".join(seqs).encode('ascii'), dtype=np.uint8)
+        qual = np.frombuffer("".join(quals).encode('ascii'), dtype=np.uint8)
+        if len(seq) != len(qual):
+            msg = (" ERROR: Inconsistent length between SEQ and QUAL in {}").format(
+                self._fq)
+            raise ValueError(msg)
+
+        max_length = int(lengths.max())
+        self._grow(max_length)
+        if len(self._length_counts) <= max_length:
+            self._length_counts = np.concatenate([self._length_counts,
+                np.zeros(max_length + 1 - len(self._length_counts), dtype=np.int64)])
+        self._length_counts += np.bincount(lengths,
+            minlength=len(self._length_counts))
+
+        # Position of every base within its read
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(len(seq)) - np.repeat(starts, lengths)
+
+        quality = np.clip(qual.astype(np.int64) - PHRED_OFFSET, 0, MAX_QUALITY)
+        n_columns = MAX_QUALITY + 1
+        self._quality_counts += np.bincount(positions * n_columns + quality,
+            minlength=self._quality_counts.size).reshape(self._quality_counts.shape)
+
+        is_n = seq == _N
+        self._n_counts += np.bincount(positions[is_n], minlength=len(self._n_counts))
+
+        # GC percentage of every read, ignoring empty reads
+        is_gc = ((seq == _G) | (seq == _C)).astype(np.int64)
+        gc_per_read = np.bincount(np.repeat(np.arange(len(seqs)), lengths),
+            weights=is_gc, minlength=len(seqs))
+        non_empty = lengths > 0
+        gc_pct = np.rint(100 * gc_per_read[non_empty] / lengths[non_empty])\
+            .astype(np.int64)
+        self._gc_counts += np.bincount(gc_pct, minlength=101)
+
+        if self._reads < OVERREPRESENTED_READS:
+            tracked = seqs[:OVERREPRESENTED_READS - self._reads]
+            self._prefixes.update(s[:OVERREPRESENTED_LENGTH] for s in tracked)
+
+        self._reads += len(seqs)
+        self._bases += len(seq)
+        self._gc_bases += int(is_gc.sum())
+
+    def per_base_quality(self) -> list:
+        '''
+            Mean, median, quartiles and 10th/90th percentiles of the base
+            quality at every read position
+        '''
+        rows = []
+        scores = np.arange(MAX_QUALITY + 1)
+        for position, counts in enumerate(self._quality_counts, 1):
+            total = counts.sum()
+            if total == 0:
+                continue
+            cumulative = np.cumsum(counts)
+            def percentile(pct):
+                return int(np.searchsorted(cumulative, total * pct / 100.0))
+            rows.append({
+                'base': position,
+                'mean': float((counts * scores).sum() / total),
+                'median': percentile(50),
+                'lower_quartile': percentile(25),
+                'upper_quartile': percentile(75),
+                'percentile_10': percentile(10),
+                'percentile_90': percentile(90),
+            })
+        return rows
+
+    def per_base_n_content(self) -> list:
+        '''
+            Percentage of N calls at every read position
+        '''
+        covered = self._quality_counts.sum(axis=1)
+        return [{'base': position, 'n_pct': 100.0 * n / total}
+            for position, (n, total) in enumerate(zip(self._n_counts, covered), 1)
+            if total > 0]
+
+    def gc_distribution(self) -> list:
+        '''
+            Number of reads at each GC percentage
+        '''
+        return [{'gc': gc, 'count': int(count)} for gc, count in enumerate(self._gc_counts)]
+
+    def length_distribution(self) -> list:
+        '''
+            Number of reads of each length
+        '''
+        return [{'length': length, 'count': int(count)}
+            for length, count in enumerate(self._length_counts) if count > 0]
+
+    def overrepresented_sequences(self) -> list:
+        '''
+            Sequences above OVERREPRESENTED_MIN_PCT of the reads tracked
+        '''
+        tracked = min(self._reads, OVERREPRESENTED_READS)
+        rows = []
+        for sequence, count in self._prefixes.most_common():
+            pct = 100.0 * count / tracked
+            if pct < OVERREPRESENTED_MIN_PCT:
+                break
+            rows.append({'sequence': sequence, 'count': count, 'percentage': pct,
+                'possible_source': "No Hit"})
+        return rows
+
+    def gc_deviation(self) -> float:
+        '''
+            Percentage of reads deviating from a normal GC distribution with
+            the same mode and standard deviation, as FastQC computes it
+        '''
+        total = self._gc_counts.sum()
+        if total == 0:
+            return 0.0
+        gc = np.arange(101)
+        mode = float(gc[np.argmax(self._gc_counts)])
+        sd = np.sqrt((self._gc_counts * (gc - mode) ** 2).sum() / total)
+        if sd == 0:
+            return 0.0
+        theoretical = np.exp(-((gc - mode) ** 2) / (2 * sd ** 2))
+        theoretical *= total / theoretical.sum()
+        return float(np.abs(self._gc_counts - theoretical).sum() / total * 100)
+
+    def status(self) -> dict:
+        '''
+            pass/warn/fail of every module, with FastQC default thresholds
+        '''
+        def grade(value_warn, value_fail):
+            return "fail" if value_fail else "warn" if value_warn else "pass"
+
+        quality = self.per_base_quality()
+        lowest_median = min([row['median'] for row in quality] or [0])
+        lowest_quartile = min([row['lower_quartile'] for row in quality] or [0])
+        max_n = max([row['n_pct'] for row in self.per_base_n_content()] or [0])
+        lengths = self.length_distribution()
+        max_overrepresented = max([row['percentage'] for row in
+            self.overrepresented_sequences()] or [0])
+        gc_deviation = self.gc_deviation()
+
+        return {
+            'Basic Statistics': "pass",
+            'Per base sequence quality': grade(lowest_quartile < 10 or lowest_median < 25,
+                lowest_quartile < 5 or lowest_median < 20),
+            'Per sequence GC content': grade(gc_deviation > 15, gc_deviation > 30),
+            'Per base N content': grade(max_n > 5, max_n > 20),
+            'Sequence Length Distribution': grade(len(lengths) > 1,
+                any(row['length'] == 0 for row in lengths)),
+            'Overrepresented sequences': grade(max_overrepresented > 0.1,
+                max_overrepresented > 1),
+        }
+
+    def basic_statistics(self) -> dict:
+        '''
+        '''
+        lengths = [row['length'] for row in self.length_distribution()]
+        if not lengths:
+            length_range = "0"
+        elif lengths[0] == lengths[-1]:
+            length_range = str(lengths[0])
+        else:
+            length_range = "{}-{}".format(lengths[0], lengths[-1])
+        return {
+            'Filename': os.path.basename(self._fq),
+            'File type': "Conventional base calls",
+            'Encoding': "Sanger / Illumina 1.9",
+            'Total Sequences': self._reads,
+            'Sequences flagged as poor quality': 0,
+            'Sequence length': length_range,
+            '%GC': int(round(100.0 * self._gc_bases / self._bases)) if self._bases else 0,
+        }
+
+    def to_dict(self) -> dict:
+        '''
+            All statistics, as written to the json report
+        '''
+        return {
+            'filename': os.path.basename(self._fq),
+            'status': self.status(),
+            'basic_statistics': self.basic_statistics(),
+            'per_base_sequence_quality': self.per_base_quality(),
+            'per_sequence_gc_content': self.gc_distribution(),
+            'per_base_n_content': self.per_base_n_content(),
+            'sequence_length_distribution': self.length_distribution(),
+            'overrepresented_sequences': self.overrepresented_sequences(),
+        }
+
+    def to_fastqc_data(self) -> str:
+        '''
+            Statistics in the fastqc_data.txt format, readable by MultiQC
+        '''
+        status = self.status()
+        lines = ["##FastQC\t{}".format(FASTQC_COMPAT_VERSION)]
+        def module(name, header, rows):
+            lines.append(">>{}\t{}".format(name, status[name]))
+            lines.append("#" + "\t".join(header))
+            for row in rows:
+                lines.append("\t".join(
+                    "{:.3f}".format(value) if isinstance(value, float) else str(value)
+                    for value in row))
+            lines.append(">>END_MODULE")
+
+        module('Basic Statistics', ["Measure", "Value"],
+            self.basic_statistics().items())
+        module('Per base sequence quality', ["Base", "Mean", "Median",
+            "Lower Quartile", "Upper Quartile", "10th Percentile", "90th Percentile"],
+            [(row['base'], row['mean'], row['median'], row['lower_quartile'],
+            row['upper_quartile'], row['percentile_10'], row['percentile_90'])
+            for row in self.per_base_quality()])
+        module('Per sequence GC content', ["GC Content", "Count"],
+            [(row['gc'], row['count']) for row in self.gc_distribution()])
+        module('Per base N content', ["Base", "N-Count"],
+            [(row['base'], row['n_pct']) for row in self.per_base_n_content()])
+        module('Sequence Length Distribution', ["Length", "Count"],
+            [(row['length'], row['count']) for row in self.length_distribution()])
+        module('Overrepresented sequences', ["Sequence", "Count", "Percentage",
+            "Possible Source"], [(row['sequence'], row['count'], row['percentage'],
+            row['possible_source']) for row in self.overrepresented_sequences()])
+        return "\n".join(lines) + "\n"
+
+    def to_summary(self) -> str:
+        '''
+            Statistics in the FastQC summary.txt format
+        '''
+        return "".join("{}\t{}\t{}\n".format(value.upper(), name,
+            os.path.basename(self._fq)) for name, value in self.status().items())
+
+
+def get_qc_folder(fq, output_dir) -> str:
+    '''
+        Report folder of a fastq, laid out like an unzipped FastQC report
+    '''
+    base = os.path.basename(fq)
+    for ext in (".gz", ".fastq", ".fq"):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    return os.path.join(output_dir, base + "_fastqc")
+
+def get_qc_report(fq, output_dir) -> str:
+    '''
+        fastqc_data.txt report of a fastq
+    '''
+    return os.path.join(get_qc_folder(fq, output_dir), "fastqc_data.txt")
+
+def compute_qc(fq, batch_size=BATCH_SIZE) -> FastqQC:
+    '''
+        Statistics of a whole fastq file, read in batches of batch_size reads
+    '''
+    qc = FastqQC(fq)
+    seqs = []
+    quals = []
+    for name, seq, qual, comment in pyfastx.Fastx(fq):
+        seqs.append(seq)
+        quals.append(qual)
+        if len(seqs) == batch_size:
+            qc.add_batch(seqs, quals)
+            seqs = []
+            quals = []
+    qc.add_batch(seqs, quals)
+    return qc
+
+def write_qc_report(fq, output_dir) -> str:
+    '''
+        Compute the statistics of a fastq file and write fastqc_data.txt,
+        summary.txt and fastqc_data.json into its report folder
+
+        :returns: path of fastqc_data.txt
+        :rtype: str
+    '''
+    qc = compute_qc(fq)
+    folder = get_qc_folder(fq, output_dir)
+    os.makedirs(folder, exist_ok=True)
+
+    # Written under temporary names, so that a report is complete or absent
+    reports = {
+        "fastqc_data.txt": qc.to_fastqc_data(),
+        "summary.txt": qc.to_summary(),
+        "fastqc_data.json": json.dumps(qc.to_dict(), indent=2),
+    }
+    with atomic_outputs([os.path.join(folder, name) for name in reports]) as tmp_outputs:
+        for tmp_output, content in zip(tmp_outputs, reports.values()):
+            with open(tmp_output, "w") as f:
+                f.write(content)
+    return get_qc_report(fq, output_dir)
+
+def native_qc(fastq_list, output_dirs, processes=2) -> list:
+    '''
+        QC several fastq files in parallel processes, e.g. R1 and R2 of a
+        sample
+
+        :param list fastq_list: fastq files
+        :param list output_dirs: report folder of each fastq
+        :param int processes: max. worker processes
+        :returns: fastqc_data.txt reports
+        :rtype: list
+    '''
+    msg = (" INFO: Running native QC on {}").format(" ".join(fastq_list))
+    logging.info(msg)
+
+    processes = max(1, min(processes, len(fastq_list)))
+    if processes == 1:
+        return [write_qc_report(fq, output_dir)
+            for fq, output_dir in zip(fastq_list, output_dirs)]
+
+    # Workers are spawned: forking a process with running threads is unsafe
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        return list(executor.map(write_qc_report, fastq_list, output_dirs))
@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "run_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def file_digest(path, block_size=1024*1024) -> str:
+    '''
+        sha256 of a file content
+    '''
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def fingerprint(path, with_hash=False) -> dict:
+    '''
+        Fingerprint of a file: size, mtime and optionally its sha256.
+        Returns None for missing files
+
+        :param str path: file to be fingerprinted
+        :param bool with_hash: also compute the content hash
+        :rtype: dict
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    fp = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if with_hash:
+        fp['sha256'] = file_digest(path)
+    return fp
+
+def same_fingerprint(recorded, current) -> bool:
+    '''
+        Compare two fingerprints. Files with equal size and a different mtime
+        are still the same file when both hashes are known and equal
+    '''
+    if recorded is None or current is None:
+        return False
+    if recorded['size'] != current['size']:
+        return False
+    if recorded['mtime_ns'] == current['mtime_ns']:
+        return True
+    if 'sha256' in recorded and 'sha256' in current:
+        return recorded['sha256'] == current['sha256']
+    return False
+
+
+class RunManifest():
+    '''
+        Per-run record of every finished step: input and output fingerprints,
+        command line and tool version. A step is up to date only if all of
+        them are unchanged, so that resuming a run only re-runs invalidated
+        steps
+
+        :param str path: manifest json file
+        :param bool hash_inputs: fingerprint files with sha256 as well
+    '''
+    def __init__(self, path, hash_inputs=False):
+        self._path = path
+        self._hash_inputs = hash_inputs
+        self._lock = threading.Lock()
+        self._steps = {}
+        # (path, size, mtime) to sha256, so that each file is hashed once
+        self._digests = {}
+
+        if os.path.isfile(self._path):
+            try:
+                with open(self._path) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                msg = (" WARNING: unreadable manifest {}, all steps will be run")\
+                    .format(self._path)
+                logging.warning(msg)
+            else:
+                if manifest.get('version') == MANIFEST_VERSION:
+                    self._steps = manifest.get('steps', {})
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _fingerprint(self, path, recorded=None) -> dict:
+        '''
+            Fingerprint a file, hashing it only when the cheap size/mtime
+            comparison against the recorded fingerprint is not enough
+        '''
+        fp = fingerprint(path)
+        if fp is None or not self._hash_inputs:
+            return fp
+        key = (path, fp['size'], fp['mtime_ns'])
+        if key not in self._digests:
+            if recorded is not None and recorded.get('mtime_ns') == fp['mtime_ns'] \
+                and recorded.get('size') == fp['size'] and 'sha256' in recorded:
+                self._digests[key] = recorded['sha256']
+            else:
+                self._digests[key] = file_digest(path)
+        fp['sha256'] = self._digests[key]
+        return fp
+
+    def is_up_to_date(self, task) -> bool:
+        '''
+            True if the task was recorded with the same command line, tool
+            version, inputs and outputs as the ones found now
+        '''
+        with self._lock:
+            step = self._steps.get(task.name)
+        if step is None:
+            return False
+        if step.get('cmd') != task.cmd or step.get('version') != task.version:
+            return False
+
+        for key, paths in (('inputs', task.inputs), ('outputs', task.outputs)):
+            recorded = step.get(key, {})
+            if sorted(recorded) != sorted(paths):
+                return False
+            for path in paths:
+                if not same_fingerprint(recorded[path],
+                    self._fingerprint(path, recorded[path])):
+                    return False
+        return True
+
+    def record(self, task) -> None:
+        '''
+            Store a finished task and save the manifest
+        '''
+        step = {
+            'cmd': task.cmd,
+            'version': task.version,
+            'inputs': {path: self._fingerprint(path) for path in task.inputs},
+            'outputs': {path: self._fingerprint(path) for path in task.outputs},
+            'finished': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with self._lock:
+            self._steps[task.name] = step
+            self._save()
+
+    def invalidate(self, task) -> None:
+        '''
+            Forget a task, e.g. before re-running it
+        '''
+        with self._lock:
+            if self._steps.pop(task.name, None) is not None:
+                self._save()
+
+    def _save(self) -> None:
+        '''
+            Atomically write the manifest
+        '''
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'version': MANIFEST_VERSION, 'steps': self._steps}, f,
+                indent=2, sort_keys=True)
+        os.replace(tmp_path, self._path)
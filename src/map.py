@@ -1,19 +1,34 @@
 import os
 import sys
+import glob
+import fcntl
+import hashlib
+from contextlib import contextmanager
 from pathlib import Path
-import subprocess
 import logging
 from src.sample import Sample
-from src.utils import get_fastq_files
-from src.fastq import Fastq
+from src.utils import atomic_outputs
+from src.runner import run_cmd, get_log_prefix
 import re
-from src.config import NGSbinaries
+from src.tools import get_tool_path, get_tool_command
+from src.resources import get_tool_threads
 
 logger = logging.getLogger(__name__)
 
+# Markers of the Hisat2 indexes already read into the page cache of a node
+WARM_INDEX_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME",
+    os.path.join(os.path.expanduser("~"), ".cache")), "rna_seq_pipeline",
+    "hisat2_index")
+# Block size when reading an index through
+WARM_BLOCK_SIZE = 16*1024*1024
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
 class InvalidBAM(Exception):
     pass
 
+class InvalidIndex(Exception):
+    pass
+
 
 def salmon_alignment(sample_list, config_dict, docker_dict):
     '''
@@ -23,125 +38,429 @@ def salmon_alignment(sample_list, config_dict, docker_dict):
 
 
 
-def index_bam(bam_in) -> None:
+def get_index_cmd(bam_in, bai, threads=1) -> str:
     '''
+        samtools index command line
+    '''
+    return "{} index -@ {} {} {}".format(get_tool_path("samtools"), threads, bam_in, bai)
+
+def index_bam(bam_in, threads=1) -> str:
+    '''
+        Index a BAM file with samtools. The index is written under a
+        temporary name and renamed once samtools ends successfully
     '''
     bai = bam_in + ".bai"
-    cmd = "{} index {}".format(NGSbinaries.SAMTOOLS, bam_in)
 
-    if not os.path.isfile(bai):
-        p1 = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        output = p1.stdout.decode('UTF-8')
-        error  = p1.stderr.decode('UTF-8')
-        if error:
-            raise InvalidBAM(error)
+    log_prefix = get_log_prefix(os.path.dirname(bam_in),
+        "index." + os.path.basename(bam_in))
+    with atomic_outputs([bai]) as (tmp_bai,):
+        cmd = get_index_cmd(bam_in, tmp_bai, threads)
+        result = run_cmd(cmd, log_prefix=log_prefix, check=False)
+        if result.returncode != 0 or result.stderr:
+            raise InvalidBAM(result.stderr)
+    return bai
+
+def get_mark_duplicates_cmd(bam_in, bam_out, picard_metrics, heap_mb=None,
+    gc_threads=None) -> str:
+    '''
+        Picard MarkDuplicates command line
+
+        :param int gc_threads: JVM garbage collector threads. By default the
+            JVM starts one per host core
+    '''
+    java_opts = []
+    if heap_mb:
+        java_opts.append("-Xmx{}m".format(heap_mb))
+    if gc_threads:
+        java_opts.append("-XX:ParallelGCThreads={}".format(gc_threads))
+    cmd = "{} MarkDuplicates -I {} -O {} -M {}".format(
+        get_tool_command("picard", java_opts), bam_in, bam_out, picard_metrics)
+    return cmd
 
-def mark_duplicates(bam_in) -> str:
+def mark_duplicates(bam_in, heap_mb=None, gc_threads=None) -> str:
     '''
         Markduplicates with Picard
-        :param:
+        :param str bam_in: input BAM
+        :param int heap_mb: max. JVM heap size (-Xmx) in MB
+        :param int gc_threads: JVM garbage collector threads
     '''
 
-    bam_out = bam_in.replace(".bam", ".rmdup.bam")
-    picard_metrics = bam_out.replace(".bam", ".picard.txt")
+    bam_out, picard_metrics = get_rmdup_bam(bam_in)
 
-    cmd = "java -jar {} MarkDuplicates -I {} -O {} -M {}".format(
-        NGSbinaries.PICARD, bam_in, bam_out,picard_metrics)
+    msg = (" INFO: Marking duplicates for {}").format(bam_in)
+    logging.info(msg)
 
-    if not os.path.isfile(bam_out):
-        msg = (" INFO: Marking duplicates for {}").format(bam_in)
-        logging.info(msg)
+    log_prefix = get_log_prefix(os.path.dirname(bam_in),
+        "mark_duplicates." + os.path.basename(bam_in))
+    with atomic_outputs([bam_out, picard_metrics]) as (tmp_bam, tmp_metrics):
+        cmd = get_mark_duplicates_cmd(bam_in, tmp_bam, tmp_metrics, heap_mb, gc_threads)
+        result = run_cmd(cmd, log_prefix=log_prefix, check=False)
+        if result.returncode != 0:
+            raise InvalidBAM(result.stderr)
+
+    return bam_out
+
+def get_merge_bams_cmd(bams, bam_out, threads=1) -> str:
+    '''
+        samtools merge command line for coordinate-sorted BAM files. Identical
+        @RG and @PG header lines, e.g. of chunks of the same lane, are kept
+        once instead of being renamed
+    '''
+    return "{} merge -f -c -p -@ {} {} {}".format(get_tool_path("samtools"), threads,
+        bam_out, " ".join(bams))
+
+def merge_bams(bams, bam_out, threads=1) -> str:
+    '''
+        Merge the BAM files of the lanes or chunks of a sample, keeping their
+        read groups. The merged BAM is written under a temporary name
+
+        :param list bams: coordinate-sorted BAM files
+        :param str bam_out: merged BAM
+        :param int threads: samtools compression threads
+    '''
+    msg = (" INFO: Merging {} BAM files into {}").format(len(bams), bam_out)
+    logging.info(msg)
+
+    log_prefix = get_log_prefix(os.path.dirname(bam_out),
+        "merge." + os.path.basename(bam_out))
+    with atomic_outputs([bam_out]) as (tmp_bam,):
+        result = run_cmd(get_merge_bams_cmd(bams, tmp_bam, threads),
+            log_prefix=log_prefix, check=False)
+        if result.returncode != 0:
+            raise InvalidBAM(result.stderr)
+    return bam_out
+
+def get_hisat2_index_files(genome_index) -> list:
+    '''
+        Files of a Hisat2 index: <index>.1.ht2 ... (.ht2l for large indexes)
+    '''
+    return sorted(glob.glob(genome_index + ".*.ht2")
+        + glob.glob(genome_index + ".*.ht2l"))
 
-        p1 = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        output = p1.stdout.decode('UTF-8')
-        error  = p1.stderr.decode('UTF-8')
-    else:
-        msg = (" INFO: Skipping duplicate marking for {}").format(bam_in)
+def get_boot_id() -> str:
+    '''
+        Identifier of the current boot of the node, as the page cache does
+        not survive a reboot
+    '''
+    try:
+        with open(BOOT_ID_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return "0"
+
+def get_warm_index_marker(genome_index, warm_dir=None) -> str:
+    '''
+        Marker written once an index was read into the page cache of this
+        node, named after the index files (path, size, mtime) and the boot
+    '''
+    key = hashlib.sha1()
+    for index_file in get_hisat2_index_files(genome_index):
+        stat = os.stat(index_file)
+        key.update("{}:{}:{}\n".format(os.path.realpath(index_file), stat.st_size,
+            stat.st_mtime_ns).encode())
+    key.update(get_boot_id().encode())
+    return os.path.join(os.path.abspath(warm_dir or WARM_INDEX_DIR),
+        "{}.{}.warm".format(os.path.basename(genome_index), key.hexdigest()[:16]))
+
+@contextmanager
+def node_lock(folder):
+    '''
+        Exclusive lock on a folder, shared with other runs of the node
+    '''
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def warm_hisat2_index(genome_index, marker) -> str:
+    '''
+        Read the files of a Hisat2 index into the page cache, so that the
+        aligners loading it memory-mapped (--mm) share one physical copy
+        instead of reading their own. Readahead of all the files is
+        requested at once with posix_fadvise, then the files are read
+        through to wait for it. Runs on the same node wait for each other,
+        and the index is read once per boot
+
+        :param str genome_index: Hisat2 index prefix
+        :param str marker: marker written once the index is cached, from
+            get_warm_index_marker
+        :returns: the marker
+        :rtype: str
+        :raises InvalidIndex: if the index has no .ht2 files
+    '''
+    index_files = get_hisat2_index_files(genome_index)
+    if not index_files:
+        msg = (" ERROR: No Hisat2 index files found for {}").format(genome_index)
+        logging.error(msg)
+        raise InvalidIndex(msg)
+
+    with node_lock(os.path.dirname(marker)):
+        if os.path.isfile(marker):
+            msg = (" INFO: Hisat2 index {} already cached on this node").format(genome_index)
+            logging.info(msg)
+            return marker
+
+        size = sum(os.path.getsize(index_file) for index_file in index_files)
+        msg = (" INFO: Reading Hisat2 index {} ({:.1f} GB) into the page cache").format(
+            genome_index, size / 1024**3)
         logging.info(msg)
 
-    index_bam(bam_out)
+        fds = [os.open(index_file, os.O_RDONLY) for index_file in index_files]
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                for fd in fds:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            buffer = bytearray(WARM_BLOCK_SIZE)
+            for fd in fds:
+                with open(fd, "rb", buffering=0, closefd=False) as f:
+                    while f.readinto(buffer):
+                        pass
+        finally:
+            for fd in fds:
+                os.close(fd)
 
+        with atomic_outputs([marker]) as (tmp_marker,):
+            with open(tmp_marker, "w") as f:
+                f.write("\n".join(index_files) + "\n")
+    return marker
+
+def get_sort_cmd(bam_in, bam_out, threads=1, sort_mem_mb=None) -> str:
+    '''
+        samtools sort command line, with temporary files named after bam_out
+    '''
+    sort_mem = "-m {}M ".format(sort_mem_mb) if sort_mem_mb else ""
+    tmp_prefix = re.sub(r'\.bam$', "", bam_out)
+    return "{} sort -@ {} {}-T {} -o {} {}".format(get_tool_path("samtools"), threads,
+        sort_mem, tmp_prefix, bam_out, bam_in)
+
+def sort_bam(bam_in, bam_out, threads=1, sort_mem_mb=None) -> str:
+    '''
+        Sort a BAM file by coordinate. The sorted BAM is written under a
+        temporary name
+
+        :param str bam_in: unsorted BAM
+        :param str bam_out: coordinate-sorted BAM
+        :param int threads: samtools sort threads
+        :param int sort_mem_mb: max. memory per thread
+    '''
+    msg = (" INFO: Sorting {}").format(bam_in)
+    logging.info(msg)
+
+    log_prefix = get_log_prefix(os.path.dirname(bam_out),
+        "sort." + os.path.basename(bam_out))
+    with atomic_outputs([bam_out]) as (tmp_bam,):
+        result = run_cmd(get_sort_cmd(bam_in, tmp_bam, threads, sort_mem_mb),
+            log_prefix=log_prefix, check=False)
+        if result.returncode != 0:
+            raise InvalidBAM(result.stderr)
     return bam_out
 
-def align_reads(sample_list, config_dict, docker_dict):
+def get_rmdup_bam(bam_in) -> tuple:
     '''
+        Duplicate-marked BAM and Picard metrics file names for a given BAM
     '''
-    for sample in sample_list:
+    bam_out = bam_in.replace(".bam", ".rmdup.bam")
+    picard_metrics = bam_out.replace(".bam", ".picard.txt")
+    return bam_out, picard_metrics
 
-        bam_folder = os.path.join(sample.sample_folder, "BAM_FOLDER")
-        if not os.path.isdir(bam_folder):
-            os.mkdir(bam_folder)
-        sample.add("bam_folder", bam_folder)
+def get_alignment_summary(bam) -> str:
+    '''
+        Hisat2 alignment summary file of a BAM
+    '''
+    return bam.replace(".bam", ".summary.alignment.txt")
 
-        hisat2 = Hisat2(sample.name, sample.ready_fq1, sample.ready_fq2,
-            config_dict['GRCh38']['hisat2_index'], bam_folder)
-        bam = hisat2.align()
-        sample.add("raw_bam", bam)
+def add_bam_files(sample) -> str:
+    '''
+        Create the BAM folder of a sample and register its raw_bam,
+        ready_bam and picard_metrics. The BAM is named after the sample, or
+        after the lane for a lane of a sample as given by get_lane_units
 
-        rmdup_bam = mark_duplicates(bam)
-        sample.add("ready_bam", rmdup_bam)
+        :returns: the BAM folder
+        :rtype: str
+    '''
+    bam_folder = os.path.join(sample.sample_folder, "BAM_FOLDER")
+    if not os.path.isdir(bam_folder):
+        os.mkdir(bam_folder)
+    sample.add("bam_folder", bam_folder)
 
-    return sample_list
+    raw_bam = os.path.join(bam_folder, sample.name + ".bam")
+    sample.add("raw_bam", raw_bam)
+
+    rmdup_bam, picard_metrics = get_rmdup_bam(raw_bam)
+    sample.add("ready_bam", rmdup_bam)
+    sample.add("picard_metrics", picard_metrics)
+    return bam_folder
+
+def get_aligner(sample, config_dict, sort_mem_mb=None):
+    '''
+        Create the BAM folder of a sample and return its Hisat2 aligner.
+        A lane of a sample is tagged with a read group of its own, a chunk
+        keeps the read group of its sample or lane
+    '''
+    bam_folder = add_bam_files(sample)
+    return Hisat2(sample.sample_name, sample.ready_fq1, sample.ready_fq2,
+        config_dict['GRCh38']['hisat2_index'], bam_folder,
+        threads=get_tool_threads('hisat2', config_dict),
+        sort_threads=get_tool_threads('samtools_sort', config_dict),
+        sort_mem_mb=sort_mem_mb, lane=getattr(sample, 'lane', None),
+        chunk=getattr(sample, 'chunk', None),
+        memory_mapped=config_dict.get('shared_index', False))
 
 class Hisat2():
     '''
     '''
-    def __init__(self, sample_name, fq1, fq2, genome_index, output_dir, threads=2):
+    def __init__(self, sample_name, fq1, fq2, genome_index, output_dir, threads=2,
+        sort_threads=1, sort_mem_mb=None, lane=None, chunk=None, memory_mapped=False):
         self._sample_name = sample_name
         self._fq1 = fq1
         self._fq2 = fq2
         self._genome_index = genome_index
         self._output_dir = output_dir
         self._threads = threads
-        self._bam = output_dir +"/"+ self._sample_name + ".bam"
+        self._sort_threads = sort_threads
+        self._sort_mem_mb = sort_mem_mb
+        self._lane = lane
+        self._chunk = chunk
+        self._memory_mapped = memory_mapped
+        self._bam = output_dir +"/"+ self.name + ".bam"
 
-    def align(self) -> str:
+    @property
+    def read_group_id(self) -> str:
         '''
-            Setting --rna-strandness RF for strand-specific library
+            :getter: Returns the read group ID, the sample name or
+                <sample>.L<lane> when aligning a single lane
         '''
+        if self._lane is None:
+            return self._sample_name
+        return "{}.L{}".format(self._sample_name, self._lane)
 
-        read_group = "--rg-id={} --rg SM:{} --rg PL:ILLUMINA".format(self._sample_name,
-            self._sample_name)
-        summary_file = self._bam.replace(".bam", ".summary.alignment.txt")
+    @property
+    def name(self) -> str:
+        '''
+            :getter: Returns the name of the aligned reads: the read group ID,
+                followed by .C<chunk> when aligning a chunk
+        '''
+        if self._chunk is None:
+            return self.read_group_id
+        return "{}.C{}".format(self.read_group_id, self._chunk)
 
-        cmd = ('{} -x {} -1 {} -2 {} -p {} {} --summary-file {} --rna-strandness RF'
-            ' | {} view -Sb - | {} sort -T {} -o {}')\
-            .format(NGSbinaries.HISAT2, self._genome_index, self._fq1 ,
-            self._fq2, self._threads, read_group, summary_file, NGSbinaries.SAMTOOLS,
-            NGSbinaries.SAMTOOLS, self._sample_name, self._bam)
+    @property
+    def read_group(self) -> list:
+        '''
+            :getter: Returns the fields of the read group other than its ID
+        '''
+        fields = ["SM:" + self._sample_name, "PL:ILLUMINA"]
+        if self._lane is not None:
+            # Lanes of a library, so that duplicates are marked across lanes
+            fields += ["LB:" + self._sample_name, "PU:" + self._lane]
+        return fields
 
-        if not os.path.isfile(self._bam):
-            msg = (" INFO: Trimming sample {}").format(self._sample_name)
-            logging.info(msg)
+    @property
+    def sample_name(self) -> str:
+        return self._sample_name
 
-            p1 = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-            output = p1.stdout.decode('UTF-8')
-            error  = p1.stderr.decode('UTF-8')
-        else:
-            msg = (" INFO: Skipping hisat2 mapping for sample {}").format(self._sample_name)
-            logging.info(msg)
+    @property
+    def fastqs(self) -> tuple:
+        '''
+            :getter: Returns the fastq files read by Hisat2
+        '''
+        return self._fq1, self._fq2
+
+    @property
+    def genome_index(self) -> str:
+        return self._genome_index
 
-        self.index_bam(self._bam)
+    @property
+    def bam(self) -> str:
+        '''
+            :getter: Returns the output BAM
+        '''
         return self._bam
 
-    @staticmethod
-    def index_bam(bam_in) -> None:
+    @property
+    def output_dir(self) -> str:
+        return self._output_dir
+
+    @property
+    def threads(self) -> int:
         '''
+            :getter: Returns the number of Hisat2 threads
         '''
+        return self._threads
 
-        bai = bam_in + ".bai"
-        cmd = "{} index {}".format(NGSbinaries.SAMTOOLS, bam_in)
+    @property
+    def sort_threads(self) -> int:
+        '''
+            :getter: Returns the number of samtools sort threads
+        '''
+        return self._sort_threads
 
-        if not os.path.isfile(bai):
-            p1 = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-            output = p1.stdout.decode('UTF-8')
-            error  = p1.stderr.decode('UTF-8')
-            if error:
-                raise InvalidBAM(error)
+    @property
+    def memory_mapped(self) -> bool:
+        '''
+            :getter: Returns True if the index is loaded memory-mapped (--mm)
+        '''
+        return self._memory_mapped
+
+    @property
+    def summary_file(self) -> str:
+        '''
+            :getter: Returns the Hisat2 alignment summary file
+        '''
+        return get_alignment_summary(self._bam)
+
+    def get_cmd(self, bam, summary_file) -> str:
+        '''
+            Hisat2 command line piped to samtools sort
+        '''
+        read_group = "--rg-id={} ".format(self.read_group_id) + \
+            " ".join("--rg " + field for field in self.read_group)
+        # Index pages shared through the page cache with other aligners
+        mm = "--mm " if self._memory_mapped else ""
+        # Max. memory per samtools sort thread
+        sort_mem = "-m {}M ".format(self._sort_mem_mb) if self._sort_mem_mb else ""
+        sort_prefix = os.path.join(self._output_dir, self.name)
+
+        # Uncompressed BAM between view and sort, which compresses the output
+        # with its own threads
+        cmd = ('{} {}-x {} -1 {} -2 {} -p {} {} --summary-file {} --rna-strandness RF'
+            ' | {} view -u - | {} sort -@ {} {}-T {} -o {}')\
+            .format(get_tool_path("hisat2"), mm, self._genome_index, self._fq1 ,
+            self._fq2, self._threads, read_group, summary_file, get_tool_path("samtools"),
+            get_tool_path("samtools"), self._sort_threads, sort_mem, sort_prefix, bam)
+        return cmd
+
+    @property
+    def cmd(self) -> str:
+        '''
+            :getter: Returns the command line writing the final outputs
+        '''
+        return self.get_cmd(self._bam, self.summary_file)
+
+    def align(self) -> str:
+        '''
+            Setting --rna-strandness RF for strand-specific library
+        '''
+        msg = (" INFO: Mapping sample {}").format(self._sample_name)
+        logging.info(msg)
+
+        log_prefix = get_log_prefix(self._output_dir, "hisat2." + self.name)
+        with atomic_outputs([self._bam, self.summary_file]) as (tmp_bam, tmp_summary):
+            cmd = self.get_cmd(tmp_bam, tmp_summary)
+            result = run_cmd(cmd, log_prefix=log_prefix, check=False)
+            if result.returncode != 0:
+                raise InvalidBAM(result.stderr)
+
+        return self._bam
+
+    @staticmethod
+    def index_bam(bam_in) -> None:
+        '''
+        '''
+        index_bam(bam_in)
 
 class STAR():
     '''
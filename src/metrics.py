@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRICS_JSON = "run_metrics.json"
+METRICS_TSV_SUFFIX = ".metrics.tsv"
+
+# Columns of the per-sample TSV
+TSV_FIELDS = ['task', 'step', 'status', 'start', 'wall', 'utime', 'stime',
+    'cpu_usage', 'maxrss_kb', 'read_bytes', 'write_bytes', 'disk_read_bytes',
+    'disk_write_bytes', 'input_bytes', 'output_bytes', 'commands']
+
+
+def get_size(paths) -> int:
+    '''
+        Total size in bytes of the existing files in paths
+    '''
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+class MetricsRecorder():
+    '''
+        Collect timing and resource usage of every pipeline step: wall time,
+        user/sys CPU, peak RSS and bytes read/written by its commands, plus
+        the size of its inputs and outputs. Commands are attributed to the
+        step running on the thread that submitted them
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._steps = []
+        self._start = time.time()
+
+    def on_command(self, result) -> None:
+        '''
+            Runner listener: attach a finished command to the current step
+        '''
+        step = getattr(self._local, 'step', None)
+        record = {
+            'cmd': result.cmd,
+            'returncode': result.returncode,
+            'start': result.start,
+            'end': result.end,
+            'wall': result.wall,
+            'utime': result.utime,
+            'stime': result.stime,
+            'maxrss_kb': result.maxrss_kb,
+            'read_bytes': result.read_bytes,
+            'write_bytes': result.write_bytes,
+            'disk_read_bytes': result.io.get('read_bytes', 0),
+            'disk_write_bytes': result.io.get('write_bytes', 0),
+        }
+        if step is None:
+            step = self._new_step(None, "untracked", None, [], [])
+            step['status'] = "done"
+            step['start'] = result.start
+            step['end'] = result.end
+            with self._lock:
+                self._steps.append(step)
+        step['commands'].append(record)
+
+    def _new_step(self, task_name, step_name, sample, samples, inputs) -> dict:
+        '''
+        '''
+        return {
+            'task': task_name,
+            'step': step_name,
+            'sample': sample,
+            'samples': samples,
+            'status': "running",
+            'start': time.time(),
+            'end': None,
+            'input_bytes': get_size(inputs),
+            'output_bytes': 0,
+            'commands': [],
+        }
+
+    @contextmanager
+    def step(self, task):
+        '''
+            Context manager tracking a task while it runs on this thread
+        '''
+        step = self._new_step(task.name, task.name.split(":")[0], task.sample,
+            task.samples, task.inputs)
+        self._local.step = step
+        try:
+            yield step
+            if step['status'] == "running":
+                step['status'] = "done"
+        except BaseException:
+            step['status'] = "failed"
+            raise
+        finally:
+            self._local.step = None
+            step['end'] = time.time()
+            step['output_bytes'] = get_size(task.outputs)
+            with self._lock:
+                self._steps.append(step)
+
+    def skip(self, task, status) -> None:
+        '''
+            Record a task that was not run, e.g. up to date or cached
+        '''
+        step = self._new_step(task.name, task.name.split(":")[0], task.sample,
+            task.samples, task.inputs)
+        step['status'] = status
+        step['end'] = step['start']
+        step['output_bytes'] = get_size(task.outputs)
+        with self._lock:
+            self._steps.append(step)
+
+    @staticmethod
+    def summarize(step) -> dict:
+        '''
+            Aggregate the commands of a step
+        '''
+        commands = step['commands']
+        wall = (step['end'] or time.time()) - step['start']
+        utime = sum(c['utime'] for c in commands)
+        stime = sum(c['stime'] for c in commands)
+        return {
+            'task': step['task'],
+            'step': step['step'],
+            'sample': step['sample'],
+            'status': step['status'],
+            'start': step['start'],
+            'end': step['end'],
+            'wall': wall,
+            'utime': utime,
+            'stime': stime,
+            # Average number of busy cores while the step ran
+            'cpu_usage': (utime + stime) / wall if wall > 0 else 0.0,
+            'maxrss_kb': max([c['maxrss_kb'] for c in commands] or [0]),
+            'read_bytes': sum(c['read_bytes'] for c in commands),
+            'write_bytes': sum(c['write_bytes'] for c in commands),
+            'disk_read_bytes': sum(c['disk_read_bytes'] for c in commands),
+            'disk_write_bytes': sum(c['disk_write_bytes'] for c in commands),
+            'input_bytes': step['input_bytes'],
+            'output_bytes': step['output_bytes'],
+            'commands': len(commands),
+        }
+
+    @property
+    def start(self) -> float:
+        '''
+            :getter: Returns the epoch time when recording started
+        '''
+        return self._start
+
+    @property
+    def steps(self) -> list:
+        with self._lock:
+            return list(self._steps)
+
+    def write(self, output_dir, sample_folders=None) -> str:
+        '''
+            Write run_metrics.json on output_dir and one <sample>.metrics.tsv
+            per sample
+
+            :param str output_dir: run output directory
+            :param dict sample_folders: sample name to its output folder.
+                Defaults to output_dir/<sample>
+            :returns: path of run_metrics.json
+            :rtype: str
+        '''
+        sample_folders = sample_folders or {}
+        steps = sorted(self.steps, key=lambda s: s['start'])
+        end = max([s['end'] or s['start'] for s in steps] or [time.time()])
+
+        metrics = {
+            'start': self._start,
+            'end': end,
+            'wall': end - self._start,
+            'steps': [dict(self.summarize(step), command_list=step['commands'])
+                for step in steps],
+        }
+        json_path = os.path.join(output_dir, METRICS_JSON)
+        with open(json_path, "w") as f:
+            json.dump(metrics, f, indent=2)
+
+        # A step run for several samples, e.g. a batch alignment, is listed
+        # in the metrics of each of them
+        by_sample = {}
+        for step in steps:
+            for sample in step['samples']:
+                by_sample.setdefault(sample, []).append(self.summarize(step))
+
+        for sample, summaries in by_sample.items():
+            folder = sample_folders.get(sample, os.path.join(output_dir, sample))
+            if not os.path.isdir(folder):
+                continue
+            tsv = os.path.join(folder, sample + METRICS_TSV_SUFFIX)
+            with open(tsv, "w") as f:
+                f.write("\t".join(TSV_FIELDS) + "\n")
+                for summary in summaries:
+                    row = []
+                    for field in TSV_FIELDS:
+                        value = summary[field]
+                        row.append("{:.3f}".format(value) if isinstance(value, float)
+                            else str(value))
+                    f.write("\t".join(row) + "\n")
+
+        msg = (" INFO: Run metrics written to {}").format(json_path)
+        logging.info(msg)
+        return json_path
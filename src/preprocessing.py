@@ -1,92 +1,186 @@
 import os
 import sys
 from pathlib import Path
-import subprocess
 import logging
 from src.sample import Sample
-from src.utils import get_fastq_files
-from src.fastq import Fastq
-from src.config import NGSbinaries, DOCKER
+from src.utils import atomic_outputs
+from src.runner import run_cmd, get_log_prefix
+from src.container import get_tool_cmd
 import re
+import shutil
 logger = logging.getLogger(__name__)
 
+class TrimmingFailed(Exception):
+    pass
 
-def preprocess(fastq_dir, output_dir, config_dict, docker_dict):
-    '''
-    '''
-
-    fastq_files = get_fastq_files(fastq_dir, avoid_trimmed=True)
-
-    # This list will hold sample objects
-    sample_list = []
-
-    # Check fastq files are well formated
-    seen_fq = set()
+class QCFailed(Exception):
+    pass
 
-    for fq in sorted(fastq_files):
 
-        f_pair = Fastq(fq, expect_paired=True, force_naming_convention=False)
-        fq1 = f_pair.fq1
-        fq2 = f_pair.fq2
-        sample_name = f_pair.sample_name
-
-        sample_folder = os.path.join(output_dir, sample_name)
+def get_merged_fastq(sample_name, read, output_dir) -> str:
+    '''
+        Fastq file holding all lanes of a read of a sample
+    '''
+    return os.path.join(output_dir, "{}_R{}.merged.fastq.gz".format(sample_name, read))
 
-        if sample_name in seen_fq:
-            continue
+def get_merge_lanes_cmd(fastq_list, merged_fq) -> str:
+    '''
+        Command line concatenating gzipped fastq files. A concatenation of
+        gzip members is a valid gzip file, so nothing is recompressed
+    '''
+    return "cat {} > {}".format(" ".join(fastq_list), merged_fq)
 
-        seen_fq.add(sample_name)
+def merge_lanes(fastq_list, merged_fq) -> str:
+    '''
+        Merge the lanes of a read of a sample into a single fastq file,
+        written under a temporary name
+    '''
+    msg = (" INFO: Merging {} lanes into {}").format(len(fastq_list), merged_fq)
+    logging.info(msg)
+
+    with atomic_outputs([merged_fq]) as (tmp_fq,):
+        result = run_cmd(get_merge_lanes_cmd(fastq_list, tmp_fq), check=False)
+        if result.returncode != 0:
+            msg = (" ERROR: Unable to merge lanes into {}: {}").format(merged_fq,
+                result.stderr)
+            raise TrimmingFailed(msg)
+    return merged_fq
+
+def get_trimmed_fastq(fq, output_dir) -> str:
+    '''
+        Trimmed fastq file name produced by fastp for a raw fastq
+    '''
+    trimmed_fq_name = os.path.basename(fq).replace(".fastq.gz", ".trimmed.fastq.gz")
+    return os.path.join(output_dir, trimmed_fq_name)
 
-        # Create a new Sample object
-        sample = Sample(sample_name)
+def get_fastp_json(output_dir) -> str:
+    '''
+        fastp json report of a sample
+    '''
+    #json_name = ("{}{}").format(sample_name, ".json")
+    json_name = "fastp.json"
+    return os.path.join(output_dir, json_name)
 
-        if not os.path.isdir(sample_folder):
-            os.mkdir(sample_folder)
+def get_fastp_html(output_dir) -> str:
+    '''
+        fastp html report of a sample
+    '''
+    return os.path.join(output_dir, "fastp.html")
 
-        sample.add("sample_folder", sample_folder)
-        fastq_folder = os.path.join(sample_folder, "FASTQ_FOLDER")
+def get_fastqc_report(fq, output_dir) -> str:
+    '''
+        FastQC report name for a raw fastq
+    '''
+    fastqc_report_name = os.path.basename(fq).replace(".fastq.gz", "") + "_fastqc.zip"
+    return os.path.join(output_dir, fastqc_report_name)
 
-        if not os.path.isdir(fastq_folder):
-            os.mkdir(fastq_folder)
+def get_fastqc_html(fq, output_dir) -> str:
+    '''
+        FastQC html report name for a raw fastq
+    '''
+    return get_fastqc_report(fq, output_dir).replace("_fastqc.zip", "_fastqc.html")
 
-        sample.add("fastq_folder", fastq_folder)
-        sample.add("sample_name", sample_name)
-        trimmed_fq1, trimmed_fq2 = fastp(sample_name, fastq_folder,
-            fq1, fq2, config_dict['threads'], NGSbinaries.FASTP)
-        sample.add("ready_fq1", trimmed_fq1)
-        sample.add("ready_fq2", trimmed_fq2)
+def get_fastqc_staging_dir(output_dir, batch) -> str:
+    '''
+        Folder where a batched FastQC run writes its reports
+    '''
+    return os.path.join(output_dir, ".fastqc_batch{}".format(batch))
 
-        fastqc_report_fq1 = fastqc(fq1, fastq_folder, config_dict['threads'], docker_dict)
-        fastqc_report_fq2 = fastqc(fq2, fastq_folder, config_dict['threads'], docker_dict)
+def get_fastqc_batches(fastq_list, max_threads) -> list:
+    '''
+        Split fastq files into as few FastQC runs as possible. FastQC
+        processes one file per thread, so each run gets up to max_threads
+        files and as many threads as files
 
-        sample_list.append(sample)
-    return sample_list
+        :param list fastq_list: raw fastq files, or tuples starting with them
+        :param int max_threads: max. threads of a FastQC run
+        :rtype: list
+    '''
+    max_threads = max(1, max_threads)
+    n_batches = -(-len(fastq_list) // max_threads)
+    # Round robin, so that batches have about the same number of files
+    return [fastq_list[idx::n_batches] for idx in range(n_batches)]
 
-def fastqc(fq, output_dir, threads, docker_dict) -> str:
+def get_fastqc_cmd(fastq_list, output_dir, threads) -> str:
     '''
+        FastQC command line for raw fastq files, run inside the fastqc image
     '''
-    cmd = ('{} run -v {}:/fastq_dir/ -v {}:/output_dir/'
-        ' --rm {} -t -f fastq -o /fastq_dir/. /output_dir/{}')\
-        .format(DOCKER, os.path.dirname(fq), output_dir, docker_dict['fastqc']['image'],
-            threads, os.path.basename(fq))
-
-    fastqc_report_name = fq.replace(".fastq.gz", "") + "_fastqc.zip"
-    fastqc_report = os.path.join(output_dir, fastqc_report_name)
+    cmd = ('fastqc -t {} -f fastq -o {} {}').format(threads, output_dir,
+        " ".join(fastq_list))
+    return cmd
 
-    if not os.path.isfile(fastqc_report):
-
-        msg = (" INFO: Trimming sample {}").format(sample_name)
-        logging.info(msg)
-        p1 = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        output = p1.stdout.decode('UTF-8')
-        error  = p1.stderr.decode('UTF-8')
+def fastqc(fastq_list, report_dirs, staging_dir, threads, docker_dict,
+    containers=None, backend="auto") -> list:
+    '''
+        Run FastQC once over several raw fastq files, then move each report
+        to the folder of its sample
+
+        :param list fastq_list: raw fastq files
+        :param list report_dirs: destination folder of each fastq report
+        :param str staging_dir: folder where FastQC writes all reports. It
+            must be on the same filesystem as report_dirs
+        :param int threads: FastQC threads
+        :param ContainerPool containers: container sessions of the run. A
+            one-off container is used if not given
+        :param str backend: "native", "docker" or "auto" to run FastQC
+            natively when installed with the configured version
+        :returns: zip reports
+        :rtype: list
+    '''
+    if os.path.isdir(staging_dir):
+        shutil.rmtree(staging_dir)
+    os.makedirs(staging_dir)
+
+    cmd = get_tool_cmd('fastqc', get_fastqc_cmd(fastq_list, staging_dir, threads),
+        fastq_list + [staging_dir], docker_dict, containers, backend)
+
+    msg = (" INFO: Running FastQC on {} fastq files with {} threads").format(
+        len(fastq_list), threads)
+    logging.info(msg)
+    log_prefix = get_log_prefix(os.path.dirname(staging_dir),
+        "fastqc." + os.path.basename(staging_dir).lstrip("."))
+    result = run_cmd(cmd, log_prefix=log_prefix, check=False)
+    if result.returncode != 0:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        msg = (" ERROR: FastQC failed on {}: {}").format(" ".join(fastq_list),
+            result.stderr)
+        raise QCFailed(msg)
+
+    fastqc_reports = []
+    try:
+        for fq, report_dir in zip(fastq_list, report_dirs):
+            for get_report in (get_fastqc_html, get_fastqc_report):
+                staged_report = get_report(fq, staging_dir)
+                if not os.path.isfile(staged_report):
+                    msg = (" ERROR: FastQC report {} was not written").format(
+                        staged_report)
+                    raise QCFailed(msg)
+                os.replace(staged_report, get_report(fq, report_dir))
+            fastqc_reports.append(get_fastqc_report(fq, report_dir))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return fastqc_reports
+
+def get_fastp_cmd(fq1, fq2, trimmed_fq1, trimmed_fq2, output_json, output_html,
+    threads, fastp_exe, split=None) -> str:
+    '''
+        fastp command line for a pair of raw fastq files
 
-    return fastqc_report
+        :param int split: number of files each trimmed fastq is split into,
+            named 0001.<trimmed fastq name>, 0002...
+    '''
+    bashCommand = ('{} -i  {} -I {} -o {} -O {} -w {} -j {} -h {}') \
+      .format(fastp_exe, fq1, fq2, trimmed_fq1, trimmed_fq2, threads, output_json,
+        output_html)
+    if split:
+        bashCommand += " --split {} --split_prefix_digits 4".format(split)
+    return bashCommand
 
 def fastp(sample_name, output_dir, fq1, fq2, threads, fastp_exe):
     '''
-        Trim raw FASTQ files using fastp
+        Trim raw FASTQ files using fastp. Outputs are written under a
+        temporary name and renamed once fastp ends successfully
 
         :param str sample_name: sample name extracted from fastq
         :param str output_dir: output directory
@@ -99,47 +193,29 @@ def fastp(sample_name, output_dir, fq1, fq2, threads, fastp_exe):
         :rtype: tuple
     '''
 
-    fq1_name = os.path.basename(fq1)
-    fq2_name = os.path.basename(fq2)
-    trimmed_fq1_name = fq1_name.replace(".fastq.gz", ".trimmed.fastq.gz")
-    trimmed_fq2_name = fq2_name.replace(".fastq.gz", ".trimmed.fastq.gz")
-
-    trimmed_fq1 = os.path.join(output_dir, trimmed_fq1_name)
-    trimmed_fq2 = os.path.join(output_dir, trimmed_fq2_name)
-
-    #json_name = ("{}{}").format(sample_name, ".json")
-    json_name = "fastp.json"
-    output_json = os.path.join(output_dir, json_name)
+    trimmed_fq1 = get_trimmed_fastq(fq1, output_dir)
+    trimmed_fq2 = get_trimmed_fastq(fq2, output_dir)
+    output_json = get_fastp_json(output_dir)
+    output_html = get_fastp_html(output_dir)
 
-    # Now trimming with fastp
-    bashCommand = ('{} -i  {} -I {} -o {} -O {} -w {} -j {}') \
-      .format(fastp_exe, fq1, fq2, trimmed_fq1, trimmed_fq2, threads, output_json)
-    if not os.path.isfile(trimmed_fq1) and not os.path.isfile(trimmed_fq2):
+    msg = (" INFO: Trimming sample {}").format(sample_name)
+    logging.info(msg)
 
-      msg = (" INFO: Trimming sample {}").format(sample_name)
-      logging.info(msg)
+    with atomic_outputs([trimmed_fq1, trimmed_fq2, output_json, output_html]) as tmp:
+      # Now trimming with fastp
+      bashCommand = get_fastp_cmd(fq1, fq2, *tmp, threads, fastp_exe)
       logging.info(bashCommand)
 
-      p1 = subprocess.run(bashCommand, shell=True, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-      output = p1.stdout.decode('UTF-8')
-      error  = p1.stderr.decode('UTF-8')
-      if error:
-        if re.search("error", error):
-          msg = (" ERROR: Something wrong happened with fastp trimming for sample {}")\
-            .format(sample_name)
-          logging.error(error)
-          sys.exit()
-        else:
-          msg = (" INFO: FASTQ Trimming ended successfully for sample {}")\
-            .format(sample_name)
-          logging.info(msg)
-      else:
-        msg = (" INFO: FASTQ Trimming ended successfully for sample {}")\
-            .format(sample_name)
-        logging.info(msg)
-    else:
-      msg = (" INFO: Skipping trimming for sample {}").format(sample_name)
-      logging.info(msg)
+      log_prefix = get_log_prefix(output_dir, "fastp." + sample_name)
+      result = run_cmd(bashCommand, log_prefix=log_prefix, check=False)
+      if result.returncode != 0 or re.search("error", result.stderr):
+        msg = (" ERROR: Something wrong happened with fastp trimming for sample {}")\
+          .format(sample_name)
+        logging.error(result.stderr)
+        raise TrimmingFailed(msg)
+
+    msg = (" INFO: FASTQ Trimming ended successfully for sample {}")\
+        .format(sample_name)
+    logging.info(msg)
 
     return trimmed_fq1, trimmed_fq2
@@ -1,42 +1,125 @@
 import os
 import sys
 from pathlib import Path
-import subprocess
 import logging
 import re
+import json
 from src.sample import Sample
-from src.config import NGSbinaries, DOCKER
+from src.container import get_tool_cmd
+from src.utils import atomic_outputs
+from src.runner import run_cmd, get_log_prefix
+from src.resources import get_tool_threads
 logger = logging.getLogger(__name__)
 
+class QuantificationFailed(Exception):
+    pass
+
 
 def salmon_quantification(sample_list, config_dict, docker_dict):
     '''
     '''
     pass
 
-def apply_featureCounts(sample_list, config_dict, docker_dict):
-    '''
-    '''
-    for sample in sample_list:
-
-        count_file_name = sample.name + ".counts.txt"
-        count_file = os.path.join(sample.bam_folder, count_file_name)
-        sample.add("count_file", count_file)
-        cmd = ('{} run -v {}:/gtf_dir/ -v {}:/bam_dir/ -v {}:/out_dir/'
-            ' {} featureCounts -a /gtf_dir/{} -t exon '
-            '-g gene_id -o /out_dir/{} /bam_dir/{}').format(
-                DOCKER,
-                os.path.dirname(config_dict['GRCh38']['gtf']),
-                sample.bam_folder,
-                sample.bam_folder,
-                docker_dict['featureCounts']['image'],
-                os.path.basename(config_dict['GRCh38']['gtf']),
-                os.path.basename(count_file_name),
-                os.path.basename(sample.ready_bam))
-        if not os.path.isfile(count_file):
-            p1 = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-            output = p1.stdout.decode('UTF-8')
-            error  = p1.stderr.decode('UTF-8')
-
-    return sample_list
+def get_count_file(sample) -> str:
+    '''
+        featureCounts output file of a sample
+    '''
+    count_file_name = sample.name + ".counts.txt"
+    return os.path.join(sample.bam_folder, count_file_name)
+
+def get_featureCounts_cmd(sample, count_file, config_dict, strand=None) -> str:
+    '''
+        featureCounts command line, run inside the featureCounts image
+
+        :param int strand: featureCounts -s value, unstranded if not given
+    '''
+    strand_opt = "-s {} ".format(strand) if strand is not None else ""
+    cmd = ('featureCounts -T {} {}-a {} -t exon -g gene_id -o {} {}').format(
+        get_tool_threads('featureCounts', config_dict), strand_opt,
+        config_dict['GRCh38']['gtf'], count_file, sample.ready_bam)
+    return cmd
+
+def quantify_sample(sample, config_dict, docker_dict, containers=None):
+    '''
+        Count reads per gene for a single sample with featureCounts
+
+        :param ContainerPool containers: container sessions of the run. A
+            one-off container is used if not given. featureCounts runs
+            natively instead if config_dict['backend'] allows it
+    '''
+    count_file = get_count_file(sample)
+    sample.add("count_file", count_file)
+
+    log_prefix = get_log_prefix(sample.bam_folder, "featureCounts." + sample.name)
+    with atomic_outputs([count_file, count_file + ".summary"]) as (tmp_count_file, _):
+        cmd = get_tool_cmd('featureCounts',
+            get_featureCounts_cmd(sample, tmp_count_file, config_dict),
+            [config_dict['GRCh38']['gtf'], sample.ready_bam, tmp_count_file],
+            docker_dict, containers, config_dict.get('backend', "auto"))
+        result = run_cmd(cmd, log_prefix=log_prefix, check=False)
+        if result.returncode != 0:
+            raise QuantificationFailed(result.stderr)
+
+    return sample
+
+def get_strandedness_file(sample) -> str:
+    '''
+        Strandedness inferred for a sample, as json
+    '''
+    return os.path.join(sample.bam_folder, sample.name + ".strandedness.json")
+
+def get_assigned_reads(summary_file) -> int:
+    '''
+        Reads assigned to genes, from a featureCounts .summary file
+    '''
+    with open(summary_file) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] == "Assigned":
+                return sum(int(value) for value in fields[1:])
+    return 0
+
+def infer_strandedness(sample, config_dict, docker_dict, containers=None) -> str:
+    '''
+        Infer the library strandedness of a sample by counting reads with
+        featureCounts as forward (-s 1) and as reverse (-s 2) stranded. Most
+        reads are assigned on one side for a stranded library, and about
+        half on each for an unstranded one
+
+        :returns: json file with the assigned reads and the verdict
+        :rtype: str
+    '''
+    strandedness_file = get_strandedness_file(sample)
+    assigned = {}
+    for strand in (1, 2):
+        count_file = os.path.join(sample.bam_folder,
+            "{}.strand{}.counts.txt".format(sample.name, strand))
+        log_prefix = get_log_prefix(sample.bam_folder,
+            "featureCounts.strand{}.{}".format(strand, sample.name))
+        cmd = get_tool_cmd('featureCounts',
+            get_featureCounts_cmd(sample, count_file, config_dict, strand),
+            [config_dict['GRCh38']['gtf'], sample.ready_bam, count_file],
+            docker_dict, containers, config_dict.get('backend', "auto"))
+        result = run_cmd(cmd, log_prefix=log_prefix, check=False)
+        if result.returncode != 0:
+            raise QuantificationFailed(result.stderr)
+        assigned[strand] = get_assigned_reads(count_file + ".summary")
+        for path in (count_file, count_file + ".summary"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    total = assigned[1] + assigned[2]
+    forward_fraction = assigned[1] / total if total else 0.5
+    if forward_fraction >= 0.8:
+        strandedness = "forward"
+    elif forward_fraction <= 0.2:
+        strandedness = "reverse"
+    else:
+        strandedness = "unstranded"
+
+    with atomic_outputs([strandedness_file]) as tmp_outputs:
+        with open(tmp_outputs[0], "w") as f:
+            json.dump({'forward_assigned': assigned[1], 'reverse_assigned': assigned[2],
+                'forward_fraction': round(forward_fraction, 4),
+                'strandedness': strandedness}, f, indent=2)
+    return strandedness_file
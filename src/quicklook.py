@@ -0,0 +1,197 @@
+import os
+import sys
+import re
+import json
+import logging
+from types import MappingProxyType
+from src.fastq import FastqIndexCache, subsample_fastq_pair, stream_subsample_fastq_pairs
+from src.discovery import FastqPair, DEFAULT_LANE
+from src.utils import atomic_outputs
+from src.map import get_alignment_summary
+from src.quantification import get_count_file, get_strandedness_file
+
+logger = logging.getLogger(__name__)
+
+# Genes listed per sample on the quick-look report
+TOP_GENES = 10
+# Read pairs are drawn with the same seed, so that quick looks are repeatable
+SUBSAMPLE_SEED = 0
+
+
+def get_subsample_dir(output_dir, reads) -> str:
+    '''
+        Output tree of a quick-look run, apart from the full run outputs
+    '''
+    return os.path.join(output_dir, "subsample_{}".format(reads))
+
+def get_subsample_fastq(sample_name, read, output_dir) -> str:
+    '''
+        Subsampled fastq file of a read of a sample
+    '''
+    return os.path.join(output_dir, "{}_R{}.subsample.fastq.gz".format(sample_name, read))
+
+def get_lane_reads(counts, reads) -> list:
+    '''
+        Read pairs drawn from each lane, in proportion to its size
+
+        :param list counts: read pairs of each lane
+        :param int reads: read pairs to draw in total
+        :rtype: list
+    '''
+    total = sum(counts)
+    reads = min(reads, total)
+    lane_reads = [reads*count // total for count in counts]
+    for idx, count in enumerate(counts):
+        if sum(lane_reads) == reads:
+            break
+        if lane_reads[idx] < count:
+            lane_reads[idx] += 1
+    return lane_reads
+
+def subsample_sample(sample_name, lanes, reads, out_fq1, out_fq2, index_cache_dir=None,
+    seed=SUBSAMPLE_SEED) -> int:
+    '''
+        Draw a random subset of the read pairs of a sample, spread over its
+        lanes. Reads are fetched through the pyfastx indexes of its fastq
+        files if they are all cached already, e.g. built with --index_fastqs.
+        Otherwise they are drawn in a single streaming pass, as building the
+        indexes would read the whole files anyway
+
+        :param str sample_name: sample name
+        :param dict lanes: lane to (fq1, fq2)
+        :param int reads: read pairs to draw
+        :param str out_fq1: subsampled fastq1
+        :param str out_fq2: subsampled fastq2
+        :param str index_cache_dir: folder of the pyfastx indexes
+        :returns: read pairs written
+        :rtype: int
+    '''
+    msg = (" INFO: Subsampling {} read pairs of sample {}").format(reads, sample_name)
+    logging.info(msg)
+
+    index_cache = FastqIndexCache(index_cache_dir)
+    pairs = list(lanes.values())
+    if not all(index_cache.is_indexed(fq) for pair in pairs for fq in pair):
+        return stream_subsample_fastq_pairs(pairs, reads, out_fq1, out_fq2, seed)
+
+    if len(pairs) == 1:
+        return subsample_fastq_pair(pairs[0][0], pairs[0][1], reads, out_fq1, out_fq2,
+            index_cache, seed)
+
+    # Lane subsamples are concatenated, as gzip members
+    lane_reads = get_lane_reads([index_cache.read_count(fq1) for fq1, fq2 in pairs],
+        reads)
+    written = 0
+    with atomic_outputs([out_fq1, out_fq2]) as tmp_outputs:
+        for idx, ((fq1, fq2), lane_read_count) in enumerate(zip(pairs, lane_reads)):
+            parts = ["{}.part{}".format(tmp_output, idx) for tmp_output in tmp_outputs]
+            written += subsample_fastq_pair(fq1, fq2, lane_read_count, parts[0], parts[1],
+                index_cache, seed)
+            for part, tmp_output in zip(parts, tmp_outputs):
+                with open(tmp_output, "ab") as out, open(part, "rb") as f:
+                    out.write(f.read())
+                os.remove(part)
+    return written
+
+def set_subsample_fastqs(sample, reads) -> tuple:
+    '''
+        Point a sample to its subsampled fastq files, as a single lane, so
+        that every downstream step reads them. The original lanes are kept
+        as source_lanes
+
+        :returns: the subsampled fastq1 and fastq2
+        :rtype: tuple
+    '''
+    fq1 = get_subsample_fastq(sample.name, 1, sample.fastq_folder)
+    fq2 = get_subsample_fastq(sample.name, 2, sample.fastq_folder)
+    sample.add("source_lanes", sample.lanes)
+    sample.add("lanes", MappingProxyType({DEFAULT_LANE: FastqPair(fq1, fq2)}))
+    sample.add("raw_fastqs", [fq1, fq2])
+    sample.add("fq1", fq1)
+    sample.add("fq2", fq2)
+    return fq1, fq2
+
+def get_quicklook_report(output_dir) -> str:
+    '''
+        Quick-look report of a subsampled run
+    '''
+    return os.path.join(output_dir, "quicklook_report.tsv")
+
+def get_mapping_rate(summary_file):
+    '''
+        Overall alignment rate (%) from a Hisat2 summary file, or None
+    '''
+    with open(summary_file) as f:
+        match = re.search(r'([\d.]+)% overall alignment rate', f.read())
+    return float(match.group(1)) if match else None
+
+def get_duplication_pct(picard_metrics):
+    '''
+        Duplicated reads (%) from Picard MarkDuplicates metrics, or None
+    '''
+    with open(picard_metrics) as f:
+        lines = [line.rstrip("\n") for line in f]
+    for idx, line in enumerate(lines[:-1]):
+        header = line.split("\t")
+        if "PERCENT_DUPLICATION" in header:
+            values = lines[idx + 1].split("\t")
+            return round(100 * float(values[header.index("PERCENT_DUPLICATION")]), 2)
+    return None
+
+def get_top_genes(count_file, top=TOP_GENES) -> list:
+    '''
+        Genes with most reads from a featureCounts output file
+
+        :returns: (gene, reads) tuples
+        :rtype: list
+    '''
+    genes = []
+    with open(count_file) as f:
+        for line in f:
+            if line.startswith("#") or line.startswith("Geneid\t"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            genes.append((fields[0], int(fields[-1])))
+    return sorted(genes, key=lambda gene: gene[1], reverse=True)[:top]
+
+def get_quicklook_row(sample) -> dict:
+    '''
+        Quick-look results of a processed sample
+    '''
+    with open(get_strandedness_file(sample)) as f:
+        strandedness = json.load(f)
+    return {
+        'sample': sample.name,
+        'mapping_rate_pct': get_mapping_rate(get_alignment_summary(sample.raw_bam)),
+        'strandedness': strandedness['strandedness'],
+        'forward_fraction': strandedness['forward_fraction'],
+        'duplication_pct': get_duplication_pct(sample.picard_metrics),
+        'top_genes': ",".join("{}:{}".format(gene, reads)
+            for gene, reads in get_top_genes(get_count_file(sample))),
+    }
+
+def write_quicklook_report(sample_list, report) -> str:
+    '''
+        Write the mapping rate, strandedness, duplication and top genes of
+        every sample of a subsampled run as a tab-separated report
+
+        :param list sample_list: processed samples
+        :param str report: output report
+        :returns: the report
+        :rtype: str
+    '''
+    rows = [get_quicklook_row(sample) for sample in sample_list]
+    columns = ['sample', 'mapping_rate_pct', 'strandedness', 'forward_fraction',
+        'duplication_pct', 'top_genes']
+    with atomic_outputs([report]) as tmp_outputs:
+        with open(tmp_outputs[0], "w") as f:
+            f.write("\t".join(columns) + "\n")
+            for row in rows:
+                f.write("\t".join(str(row[column]) for column in columns) + "\n")
+
+    for row in rows:
+        msg = (" INFO: Quick look {}: {}% mapped, {} ({}), {}% duplicates").format(
+            row['sample'], row['mapping_rate_pct'], row['strandedness'],
+            row['forward_fraction'], row['duplication_pct'])
+        logging.info(msg)
+    return report
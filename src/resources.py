@@ -0,0 +1,310 @@
+import os
+import sys
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Resources declared by each external tool. Memory is given in MB as a fixed
+# amount (mem_mb) plus an amount per thread (mem_per_thread_mb). Values can be
+# overridden through the "resources" section of the config yaml
+TOOL_REQUIREMENTS = {
+    'fastp':          {'mem_mb': 1024, 'mem_per_thread_mb': 0},
+    'fastqc':         {'mem_mb': 256,  'mem_per_thread_mb': 512},
+    'native_qc':      {'mem_mb': 0,    'mem_per_thread_mb': 512},
+    'validate_fastq': {'mem_mb': 256,  'mem_per_thread_mb': 512},
+    'hisat2':         {'mem_mb': 8192, 'mem_per_thread_mb': 0},
+    'hisat2_mm':      {'mem_mb': 1024, 'mem_per_thread_mb': 0},
+    'samtools_sort':  {'mem_mb': 0,    'mem_per_thread_mb': 768},
+    'samtools_index': {'mem_mb': 256,  'mem_per_thread_mb': 0},
+    'samtools_split': {'mem_mb': 512,  'mem_per_thread_mb': 0},
+    'picard':         {'mem_mb': 4096, 'mem_per_thread_mb': 0},
+    'featureCounts':  {'mem_mb': 1024, 'mem_per_thread_mb': 0},
+}
+
+# Memory used by a JVM on top of its heap (-Xmx)
+JVM_OVERHEAD_MB = 512
+
+# Threads given to each sample when deciding how many samples run at once
+MIN_SAMPLE_THREADS = 4
+# Most threads each tool makes use of
+MAX_TOOL_THREADS = {
+    'fastp':         16,
+    'featureCounts': 32,
+    'picard':        4,
+}
+
+CGROUP_DIR = "/sys/fs/cgroup"
+
+
+def _read_first_line(path) -> str:
+    '''
+        Read the first line of a file, or None if it cannot be read
+    '''
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except (OSError, ValueError):
+        return None
+
+def get_cgroup_cpus() -> float:
+    '''
+        CPU quota of the cgroup (v2 cpu.max or v1 cfs quota), as a number of
+        CPUs. Returns None when no quota is set
+    '''
+    cpu_max = _read_first_line(os.path.join(CGROUP_DIR, "cpu.max"))
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+        return None
+
+    quota = _read_first_line(os.path.join(CGROUP_DIR, "cpu", "cpu.cfs_quota_us"))
+    period = _read_first_line(os.path.join(CGROUP_DIR, "cpu", "cpu.cfs_period_us"))
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+def get_cgroup_memory_mb() -> int:
+    '''
+        Memory limit of the cgroup (v2 memory.max or v1 memory.limit_in_bytes)
+        in MB. Returns None when no limit is set
+    '''
+    for path in (os.path.join(CGROUP_DIR, "memory.max"),
+        os.path.join(CGROUP_DIR, "memory", "memory.limit_in_bytes")):
+        limit = _read_first_line(path)
+        if limit is None:
+            continue
+        if limit == "max":
+            return None
+        limit_mb = int(limit) // (1024*1024)
+        # cgroup v1 reports a huge number when unlimited
+        if limit_mb >= 2**40:
+            return None
+        return limit_mb
+    return None
+
+def get_usable_cpus() -> int:
+    '''
+        Number of CPUs this process can use, taking into account
+        CPU affinity and cgroup quotas
+    '''
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = get_cgroup_cpus()
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota)))
+    return max(1, cpus)
+
+def get_usable_memory_mb() -> int:
+    '''
+        Memory available to this process in MB: host MemAvailable capped by
+        the cgroup memory limit
+    '''
+    memory_mb = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    memory_mb = int(line.split()[1]) // 1024
+                    break
+    except OSError:
+        pass
+
+    if memory_mb is None:
+        try:
+            memory_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") \
+                // (1024*1024)
+        except (ValueError, OSError, AttributeError):
+            memory_mb = 4096
+
+    limit_mb = get_cgroup_memory_mb()
+    if limit_mb is not None:
+        memory_mb = min(memory_mb, limit_mb)
+    return memory_mb
+
+def get_requirements(tool, config_dict, threads=1) -> dict:
+    '''
+        CPU and memory needs of a tool run with a given number of threads
+
+        :param str tool: tool name, a key of TOOL_REQUIREMENTS
+        :param dict config_dict: run configuration, may hold a "resources" section
+        :param int threads: threads given to the tool
+        :returns: dict with cpus and mem_mb
+        :rtype: dict
+    '''
+    requirements = dict(TOOL_REQUIREMENTS[tool])
+    resources = config_dict.get('resources') or {}
+    requirements.update(resources.get(tool) or {})
+
+    mem_mb = requirements['mem_mb'] + threads*requirements['mem_per_thread_mb']
+    return {'cpus': threads, 'mem_mb': mem_mb}
+
+
+def get_sample_threads(cpus, samples) -> int:
+    '''
+        Threads of each sample: the CPUs divided between the samples that run
+        at once, as many as fit with MIN_SAMPLE_THREADS each
+
+        :param int cpus: CPUs of the run
+        :param int samples: number of samples
+        :rtype: int
+    '''
+    concurrent = max(1, min(samples, cpus // MIN_SAMPLE_THREADS))
+    return max(1, cpus // concurrent)
+
+def get_thread_plan(config_dict, cpus, samples) -> dict:
+    '''
+        Threads of each tool. The threads of a sample, from --sample_threads
+        or else divided from the run CPUs, go to the tool running at a time:
+        fastp (-w), Hisat2 (-p) with samtools sort (-@) on the same pipe,
+        samtools merge and index (-@), featureCounts (-T) and the Picard JVM
+        garbage collector. Values can be overridden through the
+        "tool_threads" section of the config yaml
+
+        :param dict config_dict: run configuration
+        :param int cpus: CPUs of the run
+        :param int samples: number of samples
+        :returns: tool to threads, with the sample threads as "sample"
+        :rtype: dict
+    '''
+    sample_threads = config_dict.get('sample_threads') or get_sample_threads(cpus, samples)
+    sample_threads = max(1, min(sample_threads, cpus))
+    # Sorting takes about a quarter of the pipe, alignment the rest
+    sort_threads = max(1, sample_threads // 4)
+    plan = {
+        'sample': sample_threads,
+        'hisat2': max(1, sample_threads - sort_threads),
+        'samtools_sort': sort_threads,
+        'samtools': sample_threads,
+    }
+    for tool in ('fastp', 'featureCounts', 'picard'):
+        plan[tool] = min(sample_threads, MAX_TOOL_THREADS[tool])
+    plan.update(config_dict.get('tool_threads') or {})
+    return plan
+
+def get_tool_threads(tool, config_dict) -> int:
+    '''
+        Threads of a tool, from the thread plan of the run. Without a plan,
+        as when steps run outside of the task graph, all the requested
+        threads go to a single sample
+
+        :param str tool: tool name, a key of the thread plan
+        :param dict config_dict: run configuration
+        :rtype: int
+    '''
+    plan = config_dict.get('thread_plan')
+    if plan is None:
+        cpus = config_dict.get('threads') or get_usable_cpus()
+        plan = get_thread_plan(config_dict, cpus, 1)
+    return plan[tool]
+
+
+class ResourceBroker():
+    '''
+        Admission control for external tools. Jobs reserve CPUs and memory
+        before they start and wait until both fit within the budget
+
+        :param int cpus: total CPUs of the budget
+        :param int mem_mb: total memory of the budget in MB
+    '''
+    def __init__(self, cpus, mem_mb):
+        self._cpus = max(1, int(cpus))
+        self._mem_mb = max(1, int(mem_mb))
+        self._free_cpus = self._cpus
+        self._free_mem_mb = self._mem_mb
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config_dict):
+        '''
+            Build a broker from the run configuration. The budget is the
+            requested threads and max_memory capped by what the host or the
+            cgroup allows
+        '''
+        cpus = get_usable_cpus()
+        if config_dict.get('threads'):
+            cpus = min(cpus, config_dict['threads'])
+        mem_mb = get_usable_memory_mb()
+        if config_dict.get('max_memory'):
+            mem_mb = min(mem_mb, config_dict['max_memory'])
+        return cls(cpus, mem_mb)
+
+    @property
+    def cpus(self) -> int:
+        return self._cpus
+
+    @property
+    def mem_mb(self) -> int:
+        return self._mem_mb
+
+    def fit(self, cpus, mem_mb) -> tuple:
+        '''
+            Clamp a request to the budget, so that oversized jobs can still
+            run on their own instead of waiting forever
+        '''
+        return min(max(0, cpus), self._cpus), min(max(0, mem_mb), self._mem_mb)
+
+    def acquire(self, cpus, mem_mb) -> tuple:
+        '''
+            Block until cpus and mem_mb are free, then reserve them
+
+            :returns: the reserved cpus and mem_mb
+            :rtype: tuple
+        '''
+        fit_cpus, fit_mem_mb = self.fit(cpus, mem_mb)
+        if (fit_cpus, fit_mem_mb) != (cpus, mem_mb):
+            msg = (" WARNING: job needs {} CPUs and {} MB but the budget is {} CPUs"
+                " and {} MB").format(cpus, mem_mb, self._cpus, self._mem_mb)
+            logging.warning(msg)
+
+        with self._condition:
+            self._condition.wait_for(lambda: fit_cpus <= self._free_cpus
+                and fit_mem_mb <= self._free_mem_mb)
+            self._free_cpus -= fit_cpus
+            self._free_mem_mb -= fit_mem_mb
+        return fit_cpus, fit_mem_mb
+
+    def release(self, cpus, mem_mb) -> None:
+        '''
+            Give back resources reserved with acquire
+        '''
+        with self._condition:
+            self._free_cpus += cpus
+            self._free_mem_mb += mem_mb
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, cpus, mem_mb):
+        '''
+            Context manager that holds cpus and mem_mb while a job runs
+        '''
+        reserved = self.acquire(cpus, mem_mb)
+        try:
+            yield reserved
+        finally:
+            self.release(*reserved)
+
+
+def get_jvm_heap_mb(tool, config_dict, broker) -> int:
+    '''
+        JVM heap (-Xmx) of a java tool: its declared memory, shrunk when
+        needed so that heap plus JVM overhead fit the budget
+    '''
+    heap_mb = get_requirements(tool, config_dict)['mem_mb']
+    return max(256, min(heap_mb, broker.mem_mb - JVM_OVERHEAD_MB))
+
+def get_sort_mem_per_thread_mb(config_dict, broker, reserved_mb=0, threads=1) -> int:
+    '''
+        Memory per thread for samtools sort -m. Shrunk when needed so that the
+        sort plus reserved_mb (e.g. the aligner feeding it) fit the budget
+    '''
+    requirements = dict(TOOL_REQUIREMENTS['samtools_sort'])
+    requirements.update((config_dict.get('resources') or {}).get('samtools_sort') or {})
+    mem_mb = requirements['mem_per_thread_mb']
+    available_mb = (broker.mem_mb - reserved_mb) // max(1, threads)
+    return max(64, min(mem_mb, available_mb))
@@ -0,0 +1,471 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import threading
+import subprocess
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Bytes read at once from a tool stdout/stderr
+CHUNK_SIZE = 64*1024
+# Lines of stderr kept in memory to report failures
+TAIL_LINES = 50
+# Seconds given to a process group to exit after SIGTERM
+KILL_GRACE = 10
+
+
+class CommandFailed(Exception):
+    pass
+
+class CommandTimeout(CommandFailed):
+    pass
+
+
+class CommandResult():
+    '''
+        Outcome of an external command
+
+        :param str cmd: command line
+        :param int returncode: exit code, negative if killed by a signal
+        :param float start: epoch time when the command started
+        :param float end: epoch time when the command ended
+        :param resource.struct_rusage rusage: resource usage from wait4
+        :param str stdout_log: stdout log file, if any
+        :param str stderr_log: stderr log file, if any
+        :param list stderr_tail: last lines written to stderr
+        :param dict io: counters from /proc/<pid>/io, children included
+    '''
+    def __init__(self, cmd, returncode, start, end, rusage=None, stdout_log=None,
+        stderr_log=None, stderr_tail=(), io=None):
+        self._cmd = cmd
+        self._returncode = returncode
+        self._start = start
+        self._end = end
+        self._rusage = rusage
+        self._stdout_log = stdout_log
+        self._stderr_log = stderr_log
+        self._stderr_tail = list(stderr_tail)
+        self._io = io or {}
+
+    @property
+    def cmd(self) -> str:
+        return self._cmd
+
+    @property
+    def returncode(self) -> int:
+        return self._returncode
+
+    @property
+    def start(self) -> float:
+        return self._start
+
+    @property
+    def end(self) -> float:
+        return self._end
+
+    @property
+    def wall(self) -> float:
+        '''
+            :getter: Returns the wall time in seconds
+        '''
+        return self._end - self._start
+
+    @property
+    def utime(self) -> float:
+        '''
+            :getter: Returns user CPU time in seconds, children included
+        '''
+        return self._rusage.ru_utime if self._rusage else 0.0
+
+    @property
+    def stime(self) -> float:
+        '''
+            :getter: Returns system CPU time in seconds, children included
+        '''
+        return self._rusage.ru_stime if self._rusage else 0.0
+
+    @property
+    def maxrss_kb(self) -> int:
+        '''
+            :getter: Returns the peak resident set size in KB
+        '''
+        return self._rusage.ru_maxrss if self._rusage else 0
+
+    @property
+    def read_bytes(self) -> int:
+        '''
+            :getter: Returns bytes read by the command (rchar), children included
+        '''
+        return self._io.get('rchar', 0)
+
+    @property
+    def write_bytes(self) -> int:
+        '''
+            :getter: Returns bytes written by the command (wchar), children included
+        '''
+        return self._io.get('wchar', 0)
+
+    @property
+    def io(self) -> dict:
+        '''
+            :getter: Returns all /proc/<pid>/io counters
+        '''
+        return dict(self._io)
+
+    @property
+    def stdout_log(self) -> str:
+        return self._stdout_log
+
+    @property
+    def stderr_log(self) -> str:
+        return self._stderr_log
+
+    @property
+    def stderr(self) -> str:
+        '''
+            :getter: Returns the last lines written to stderr
+        '''
+        return "\n".join(self._stderr_tail)
+
+
+def read_proc_io(pid) -> dict:
+    '''
+        I/O counters of a process from /proc/<pid>/io. Counters of reaped
+        children are included, so reading them from the exited (not yet
+        reaped) shell of a pipeline accounts for the whole pipeline
+    '''
+    io = {}
+    try:
+        with open("/proc/{}/io".format(pid)) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                io[key.strip()] = int(value)
+    except (OSError, ValueError):
+        pass
+    return io
+
+def get_log_prefix(output_dir, step) -> str:
+    '''
+        Log file prefix of a step, under a "logs" folder of output_dir
+    '''
+    log_dir = os.path.join(output_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, step)
+
+
+class CommandRunner():
+    '''
+        Supervise external commands from a single asyncio event loop running
+        on a background thread. Commands can be submitted from any thread.
+        Their stdout/stderr are streamed to log files in fixed-size chunks,
+        exit codes are checked, resource usage is collected with wait4, and
+        commands can be timed out or cancelled
+    '''
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+            name="command-runner", daemon=True)
+        self._thread.start()
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener) -> None:
+        '''
+            Register a callable that receives every CommandResult. It is
+            called from the thread that submitted the command
+        '''
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener) -> None:
+        '''
+        '''
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    async def _drain(self, reader, log_path, tail):
+        '''
+            Copy a pipe to its log file chunk by chunk, keeping the last
+            lines in tail
+        '''
+        log = open(log_path, "wb") if log_path else None
+        pending = b""
+        try:
+            while True:
+                chunk = await reader.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if log:
+                    log.write(chunk)
+                if tail is not None:
+                    lines = (pending + chunk).split(b"\n")
+                    pending = lines.pop()[-CHUNK_SIZE:]
+                    tail.extend(line.decode('UTF-8', 'replace')
+                        for line in lines[-TAIL_LINES:])
+            if tail is not None and pending:
+                tail.append(pending.decode('UTF-8', 'replace'))
+        finally:
+            if log:
+                log.close()
+
+    async def _open_pipe(self, pipe):
+        '''
+            Wrap a pipe file object into an asyncio StreamReader
+        '''
+        reader = asyncio.StreamReader(limit=CHUNK_SIZE, loop=self._loop)
+        await self._loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader, loop=self._loop), pipe)
+        return reader
+
+    async def _wait4(self, pid):
+        '''
+            Wait for a process to exit and reap it with wait4, returning its
+            exit status, resource usage and I/O counters. Uses a pidfd when
+            available so that no thread is blocked while waiting
+        '''
+        try:
+            pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            _, status, rusage = await self._loop.run_in_executor(None, os.wait4,
+                pid, 0)
+            return status, rusage, {}
+
+        exited = self._loop.create_future()
+        self._loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            self._loop.remove_reader(pidfd)
+            os.close(pidfd)
+        # The process is a zombie now, its counters are still readable
+        io = read_proc_io(pid)
+        _, status, rusage = os.wait4(pid, 0)
+        return status, rusage, io
+
+    async def _kill(self, proc, wait_task):
+        '''
+            Terminate the whole process group of a command, then kill what is
+            left of it after KILL_GRACE seconds, or as soon as the shell exits:
+            a process forked while the group was signalled outlives the shell
+            and would hold its stdout and stderr pipes open
+        '''
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                break
+            await asyncio.wait({wait_task}, timeout=KILL_GRACE)
+        return await wait_task
+
+    async def _run(self, cmd, log_prefix, timeout):
+        '''
+        '''
+        stdout_log = log_prefix + ".stdout.log" if log_prefix else None
+        stderr_log = log_prefix + ".stderr.log" if log_prefix else None
+        tail = deque(maxlen=TAIL_LINES)
+
+        start = time.time()
+        # Own process group, so that timeouts and cancellation kill every
+        # process of a shell pipeline
+        proc = subprocess.Popen(["/bin/bash", "-o", "pipefail", "-c", cmd],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True)
+        try:
+            stdout = await self._open_pipe(proc.stdout)
+            stderr = await self._open_pipe(proc.stderr)
+            drains = asyncio.gather(self._drain(stdout, stdout_log, None),
+                self._drain(stderr, stderr_log, tail))
+            wait_task = asyncio.ensure_future(self._wait4(proc.pid))
+            try:
+                status, rusage, io = await asyncio.wait_for(
+                    asyncio.shield(wait_task), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                await self._kill(proc, wait_task)
+                await drains
+                if isinstance(e, asyncio.TimeoutError):
+                    msg = (" ERROR: command timed out after {}s: {}").format(timeout, cmd)
+                    raise CommandTimeout(msg)
+                raise
+            await drains
+        finally:
+            proc.stdout.close()
+            proc.stderr.close()
+
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        # Already reaped by wait4, keep Popen from polling the pid again
+        proc.returncode = returncode
+        return CommandResult(cmd, returncode, start, time.time(), rusage,
+            stdout_log, stderr_log, tail, io)
+
+    async def _track(self, coro):
+        '''
+            Register the running task so that it can be cancelled
+        '''
+        task = asyncio.current_task()
+        with self._lock:
+            self._tasks.add(task)
+        try:
+            return await coro
+        finally:
+            with self._lock:
+                self._tasks.discard(task)
+
+    async def run_async(self, cmd, log_prefix=None, timeout=None) -> CommandResult:
+        '''
+            Coroutine running cmd on the runner loop
+        '''
+        return await self._track(self._run(cmd, log_prefix, timeout))
+
+    def run(self, cmd, log_prefix=None, timeout=None, check=True) -> CommandResult:
+        '''
+            Run a shell command and block the calling thread until it ends
+
+            :param str cmd: shell command, run by bash with pipefail
+            :param str log_prefix: stdout/stderr are written to
+                <log_prefix>.stdout.log and <log_prefix>.stderr.log
+            :param float timeout: max. seconds before the command is killed
+            :param bool check: raise CommandFailed on a non-zero exit code
+            :rtype: CommandResult
+            :raises CommandFailed: if check is set and the command failed
+            :raises CommandTimeout: if the command did not end within timeout
+        '''
+        future = asyncio.run_coroutine_threadsafe(
+            self.run_async(cmd, log_prefix, timeout), self._loop)
+        try:
+            result = future.result()
+        except BaseException:
+            future.cancel()
+            raise
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(result)
+        if check and result.returncode != 0:
+            msg = (" ERROR: command exited with code {}: {}\n{}").format(
+                result.returncode, cmd, result.stderr)
+            raise CommandFailed(msg)
+        return result
+
+    async def _run_group(self, commands, timeout):
+        '''
+            Run commands concurrently. As soon as one of them fails, the
+            others are killed
+
+            :returns: result of every command, None for the killed ones, and
+                the first failure (a CommandResult or an exception)
+            :rtype: tuple
+        '''
+        tasks = [asyncio.ensure_future(self.run_async(cmd, log_prefix, timeout))
+            for cmd, log_prefix in commands]
+        failure = None
+        try:
+            pending = set(tasks)
+            while pending and failure is None:
+                done, pending = await asyncio.wait(pending,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task not in done or failure is not None:
+                        continue
+                    if task.exception() is not None:
+                        failure = task.exception()
+                    elif task.result().returncode != 0:
+                        failure = task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = [task.result() if not task.cancelled() and task.exception() is None
+            else None for task in tasks]
+        return results, failure
+
+    def run_group(self, commands, timeout=None, check=True) -> list:
+        '''
+            Run commands that depend on each other concurrently, e.g. a
+            producer and a consumer connected by named pipes. If any command
+            fails the others are killed, so that none of them is left blocked
+            on a pipe whose other end is gone
+
+            :param list commands: (cmd, log_prefix) tuples
+            :param float timeout: max. seconds before the commands are killed
+            :param bool check: raise CommandFailed if any command failed
+            :returns: result of every command, None for killed ones
+            :rtype: list
+            :raises CommandFailed: with the first failure, if check is set
+        '''
+        future = asyncio.run_coroutine_threadsafe(
+            self._track(self._run_group(commands, timeout)), self._loop)
+        try:
+            results, failure = future.result()
+        except BaseException:
+            future.cancel()
+            raise
+        with self._lock:
+            listeners = list(self._listeners)
+        for result in results:
+            if result is None:
+                continue
+            for listener in listeners:
+                listener(result)
+        if check and failure is not None:
+            if isinstance(failure, BaseException):
+                raise failure
+            msg = (" ERROR: command exited with code {}: {}\n{}").format(
+                failure.returncode, failure.cmd, failure.stderr)
+            raise CommandFailed(msg)
+        return results
+
+    def cancel_all(self) -> None:
+        '''
+            Kill every running command
+        '''
+        def cancel():
+            with self._lock:
+                tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+        self._loop.call_soon_threadsafe(cancel)
+
+    def close(self) -> None:
+        '''
+            Cancel running commands and stop the event loop
+        '''
+        self.cancel_all()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+_RUNNER = None
+_RUNNER_LOCK = threading.Lock()
+
+def get_runner() -> CommandRunner:
+    '''
+        Process-wide command runner, started on first use
+    '''
+    global _RUNNER
+    with _RUNNER_LOCK:
+        if _RUNNER is None:
+            _RUNNER = CommandRunner()
+        return _RUNNER
+
+def run_group(commands, timeout=None, check=True) -> list:
+    '''
+        Run dependent commands concurrently on the process-wide runner. See
+        CommandRunner.run_group
+    '''
+    return get_runner().run_group(commands, timeout=timeout, check=check)
+
+def run_cmd(cmd, log_prefix=None, timeout=None, check=True) -> CommandResult:
+    '''
+        Run a shell command on the process-wide runner. See CommandRunner.run
+    '''
+    return get_runner().run(cmd, log_prefix=log_prefix, timeout=timeout, check=check)
@@ -0,0 +1,619 @@
+import os
+import sys
+import logging
+from src.dag import Task, TaskGraph
+from src.preprocessing import fastp, fastqc, get_trimmed_fastq, get_fastp_json,\
+    get_fastp_html, get_fastqc_report, get_fastp_cmd, get_fastqc_cmd,\
+    get_fastqc_batches, get_fastqc_staging_dir, merge_lanes, get_merged_fastq,\
+    get_merge_lanes_cmd
+from src.discovery import get_lane_units
+from src.chunking import fastp_split, gather_chunks, get_chunk_units
+from src.batch import batch_align, get_batches, get_batch_dir, get_batch_outputs,\
+    get_batch_align_cmd, get_unsorted_bam, DEMUX_MAX_THREADS
+from src.fastq import validate_sample, get_validation_report, FastqIndexCache,\
+    index_fastqs
+from src.map import get_aligner, index_bam, mark_duplicates, get_index_cmd,\
+    warm_hisat2_index, get_warm_index_marker, get_hisat2_index_files, sort_bam,\
+    get_sort_cmd,\
+    get_mark_duplicates_cmd, merge_bams, get_merge_bams_cmd, add_bam_files,\
+    get_alignment_summary
+from src.quantification import quantify_sample, get_count_file, get_featureCounts_cmd,\
+    infer_strandedness, get_strandedness_file
+from src.quicklook import subsample_sample, set_subsample_fastqs, write_quicklook_report,\
+    get_quicklook_report
+from src.manifest import RunManifest, MANIFEST_NAME
+from src.cache import ArtifactCache
+from src.runner import get_runner
+from src.metrics import MetricsRecorder
+from src.trace import write_chrome_trace
+from src.stream import stream_align, get_stream_fifos, get_stream_outputs,\
+    get_stream_cmds
+from src.fastq_qc import native_qc, get_qc_report, QC_VERSION
+from src.container import ContainerPool, get_mounts, get_backend_version, use_native
+from src.config import get_image_ref
+from src.tools import get_tool_path, get_tool_version
+from src.resources import ResourceBroker, get_requirements, get_jvm_heap_mb,\
+    get_sort_mem_per_thread_mb, get_thread_plan, get_tool_threads, JVM_OVERHEAD_MB
+
+logger = logging.getLogger(__name__)
+
+# Task reading the Hisat2 index into the page cache before the aligners
+WARM_INDEX_TASK = "warm_hisat2_index"
+
+
+def get_samtools_version() -> str:
+    '''
+    '''
+    return get_tool_version("samtools")
+
+def get_hisat2_mem_mb(config_dict) -> int:
+    '''
+        Memory reserved per Hisat2 process. A memory-mapped index is shared
+        by all the aligners through the page cache, and not reserved again
+        by each one
+    '''
+    tool = 'hisat2_mm' if config_dict.get('shared_index') else 'hisat2'
+    return get_requirements(tool, config_dict)['mem_mb']
+
+def get_index_inputs(config_dict) -> list:
+    '''
+        Files of the Hisat2 index, read by every alignment task, so that a
+        rebuilt index invalidates the recorded and cached alignments
+    '''
+    return get_hisat2_index_files(config_dict['GRCh38']['hisat2_index'])
+
+def get_aligner_deps(config_dict) -> list:
+    '''
+        Tasks that must end before any Hisat2 process starts
+    '''
+    return [WARM_INDEX_TASK] if config_dict.get('shared_index') else []
+
+def add_warm_index_task(graph, config_dict) -> None:
+    '''
+        Declare the reading of the Hisat2 index into the page cache, once per
+        node, for aligners loading it memory-mapped
+    '''
+    genome_index = config_dict['GRCh38']['hisat2_index']
+    marker = get_warm_index_marker(genome_index)
+    graph.add(Task(WARM_INDEX_TASK, warm_hisat2_index,
+        args=(genome_index, marker),
+        inputs=get_index_inputs(config_dict),
+        outputs=[marker],
+        cpus=1, mem_mb=0))
+
+def add_sample_tasks(graph, sample, config_dict, docker_dict, broker,
+    containers=None, aligners=None) -> None:
+    '''
+        Declare the tasks of a sample: fastp, Hisat2, BAM indexing,
+        MarkDuplicates and featureCounts, with their CPU and memory needs
+
+        :param TaskGraph graph: graph where tasks are added
+        :param Sample sample: sample to be processed
+        :param dict config_dict: run configuration
+        :param dict docker_dict: docker images configuration
+        :param ResourceBroker broker: resource budget of the run
+        :param ContainerPool containers: container sessions of the run
+        :param list aligners: if given, collects the Hisat2 aligners of the
+            sample for batched alignment instead of declaring their tasks
+    '''
+    backend = config_dict.get('backend', "auto")
+    name = sample.name
+
+    # Raw fastq files are validated before anything reads them
+    deps = []
+    if config_dict.get('validate'):
+        deps.append(add_validation_task(graph, sample, config_dict))
+
+    if len(sample.lanes) > 1 and config_dict.get('lane_mode', "merge") == "split":
+        add_lane_tasks(graph, sample, config_dict, broker, deps, aligners)
+    else:
+        if len(sample.lanes) > 1:
+            add_merge_lanes_tasks(graph, sample, config_dict, deps)
+        if config_dict.get('stream'):
+            add_stream_tasks(graph, sample, config_dict, broker, deps)
+        else:
+            add_fastp_hisat2_tasks(graph, sample, config_dict, broker, deps, aligners)
+
+    index_threads = get_tool_threads('samtools', config_dict)
+    index_requirements = get_requirements('samtools_index', config_dict, index_threads)
+    for task_name, bam in (("index_bam", sample.raw_bam),
+        ("index_rmdup_bam", sample.ready_bam)):
+        graph.add(Task("{}:{}".format(task_name, name), index_bam,
+            args=(bam, index_threads),
+            inputs=[bam],
+            outputs=[bam + ".bai"],
+            sample=name, **index_requirements,
+            cmd=get_index_cmd(bam, bam + ".bai", index_threads),
+            version=get_samtools_version()))
+
+    heap_mb = get_jvm_heap_mb('picard', config_dict, broker)
+    gc_threads = get_tool_threads('picard', config_dict)
+    graph.add(Task("mark_duplicates:{}".format(name), mark_duplicates,
+        args=(sample.raw_bam, heap_mb, gc_threads),
+        inputs=[sample.raw_bam],
+        outputs=[sample.ready_bam, sample.picard_metrics],
+        sample=name, cpus=gc_threads, mem_mb=heap_mb + JVM_OVERHEAD_MB,
+        cmd=get_mark_duplicates_cmd(sample.raw_bam, sample.ready_bam,
+            sample.picard_metrics, heap_mb, gc_threads),
+        version=get_tool_version('picard'),
+        cacheable=True))
+
+    count_file = get_count_file(sample)
+    graph.add(Task("featureCounts:{}".format(name), quantify_sample,
+        args=(sample, config_dict, docker_dict, containers),
+        inputs=[sample.ready_bam, config_dict['GRCh38']['gtf']],
+        outputs=[count_file, count_file + ".summary"],
+        sample=name, **get_requirements('featureCounts', config_dict,
+            get_tool_threads('featureCounts', config_dict)),
+        cmd=get_featureCounts_cmd(sample, count_file, config_dict),
+        version=get_backend_version('featureCounts', docker_dict, backend),
+        cacheable=True))
+
+def add_validation_task(graph, sample, config_dict) -> str:
+    '''
+        Declare the validation of the fastq pairs of a sample, one lane
+        after the other, each one read by two processes that also leave the
+        statistics sidecar of every file in the output directory
+
+        :returns: the task name
+        :rtype: str
+    '''
+    report = get_validation_report(sample.name, sample.fastq_folder)
+    name = "validate:{}".format(sample.name)
+    graph.add(Task(name, validate_sample,
+        args=(sample.name, sample.lanes, report, config_dict['output_dir']),
+        inputs=sample.raw_fastqs,
+        outputs=[report],
+        sample=sample.name, **get_requirements('validate_fastq', config_dict, 2)))
+    return name
+
+def add_merge_lanes_tasks(graph, sample, config_dict, deps=()) -> None:
+    '''
+        Declare the concatenation of the lanes of a sample, per read, and
+        point the sample fq1/fq2 to the merged files
+    '''
+    for read in (1, 2):
+        fastq_list = [pair[read - 1] for pair in sample.lanes.values()]
+        merged_fq = get_merged_fastq(sample.name, read, sample.fastq_folder)
+        graph.add(Task("merge_lanes_R{}:{}".format(read, sample.name), merge_lanes,
+            args=(fastq_list, merged_fq),
+            inputs=fastq_list,
+            outputs=[merged_fq],
+            deps=deps,
+            sample=sample.name, cpus=1, mem_mb=0,
+            cmd=get_merge_lanes_cmd(fastq_list, merged_fq)))
+        sample.add("fq{}".format(read), merged_fq)
+
+def add_lane_tasks(graph, sample, config_dict, broker, deps=(), aligners=None) -> None:
+    '''
+        Declare the trimming and alignment of every lane of a sample on its
+        own, each lane with its own read group, and the merge of the lane
+        BAM files into the sample BAM
+    '''
+    lane_bams = []
+    for unit in get_lane_units(sample):
+        if config_dict.get('stream'):
+            add_stream_tasks(graph, unit, config_dict, broker, deps)
+        else:
+            add_fastp_hisat2_tasks(graph, unit, config_dict, broker, deps, aligners)
+        lane_bams.append(unit.raw_bam)
+
+    add_bam_files(sample)
+    threads = get_tool_threads('samtools', config_dict)
+    graph.add(Task("merge_bams:{}".format(sample.name), merge_bams,
+        args=(lane_bams, sample.raw_bam, threads),
+        inputs=lane_bams,
+        outputs=[sample.raw_bam],
+        sample=sample.name, cpus=threads, mem_mb=0,
+        cmd=get_merge_bams_cmd(lane_bams, sample.raw_bam, threads),
+        version=get_samtools_version()))
+
+def add_fastp_hisat2_tasks(graph, sample, config_dict, broker, deps=(),
+    aligners=None) -> None:
+    '''
+        Declare fastp, writing trimmed fastq files, and Hisat2 reading them.
+        sample can also be a single lane of a sample. If aligners is given,
+        the aligner is added to it, to be run in a batch
+    '''
+    if (config_dict.get('chunks') or 1) > 1:
+        add_chunked_tasks(graph, sample, config_dict, broker, deps)
+        return
+
+    threads = get_tool_threads('fastp', config_dict)
+    name = sample.name
+
+    trimmed_fq1 = get_trimmed_fastq(sample.fq1, sample.fastq_folder)
+    trimmed_fq2 = get_trimmed_fastq(sample.fq2, sample.fastq_folder)
+    sample.add("ready_fq1", trimmed_fq1)
+    sample.add("ready_fq2", trimmed_fq2)
+
+    fastp_outputs = [trimmed_fq1, trimmed_fq2, get_fastp_json(sample.fastq_folder),
+        get_fastp_html(sample.fastq_folder)]
+    graph.add(Task("fastp:{}".format(name), fastp,
+        args=(name, sample.fastq_folder, sample.fq1, sample.fq2, threads,
+            get_tool_path('fastp')),
+        inputs=[sample.fq1, sample.fq2],
+        outputs=fastp_outputs,
+        deps=deps,
+        sample=sample.sample_name, **get_requirements('fastp', config_dict, threads),
+        cmd=get_fastp_cmd(sample.fq1, sample.fq2, *fastp_outputs, threads,
+            get_tool_path('fastp')),
+        version=get_tool_version('fastp'),
+        cacheable=True))
+
+    if aligners is not None:
+        aligners.append(get_aligner(sample, config_dict))
+        return
+
+    # Hisat2 output is piped to a multithreaded samtools sort
+    hisat2_mem_mb = get_hisat2_mem_mb(config_dict)
+    sort_threads = get_tool_threads('samtools_sort', config_dict)
+    sort_mem_mb = get_sort_mem_per_thread_mb(config_dict, broker, hisat2_mem_mb,
+        sort_threads)
+    hisat2 = get_aligner(sample, config_dict, sort_mem_mb=sort_mem_mb)
+    graph.add(Task("hisat2:{}".format(name), hisat2.align,
+        inputs=[trimmed_fq1, trimmed_fq2] + get_index_inputs(config_dict),
+        outputs=[sample.raw_bam, hisat2.summary_file],
+        deps=get_aligner_deps(config_dict),
+        sample=sample.sample_name, cpus=hisat2.threads + hisat2.sort_threads,
+        mem_mb=hisat2_mem_mb + sort_mem_mb*hisat2.sort_threads,
+        cmd=hisat2.cmd,
+        version="{} / {}".format(get_tool_version('hisat2'), get_samtools_version()),
+        cacheable=True))
+
+def add_batch_tasks(graph, aligners, config_dict, broker) -> None:
+    '''
+        Declare one Hisat2 task per batch of samples, writing an unsorted BAM
+        file per sample, and the sorting of every BAM file
+    '''
+    hisat2_mem_mb = get_hisat2_mem_mb(config_dict)
+    sort_threads = get_tool_threads('samtools', config_dict)
+    sort_mem_mb = get_sort_mem_per_thread_mb(config_dict, broker, 0, sort_threads)
+    for idx, batch in enumerate(get_batches(aligners, config_dict['batch_size']), 1):
+        batch_dir = get_batch_dir(config_dict['output_dir'], idx)
+        os.makedirs(batch_dir, exist_ok=True)
+        # A single process for the samples of the batch, with their threads,
+        # as many as a single demultiplexer keeps up with
+        threads = min(broker.cpus, DEMUX_MAX_THREADS,
+            get_tool_threads('hisat2', config_dict)*len(batch))
+        outputs = get_batch_outputs(batch, batch_dir)
+        samples = list(dict.fromkeys(hisat2.sample_name for hisat2 in batch))
+        # Hisat2 piped to the demultiplexer and samtools split
+        mem_mb = hisat2_mem_mb + get_requirements('samtools_split', config_dict)['mem_mb']
+        graph.add(Task("hisat2_batch:{}".format(idx), batch_align,
+            args=(batch, batch_dir, threads),
+            inputs=[fq for hisat2 in batch for fq in hisat2.fastqs] + \
+                get_index_inputs(config_dict),
+            outputs=outputs,
+            deps=get_aligner_deps(config_dict),
+            sample=samples, cpus=threads, mem_mb=mem_mb,
+            cmd=get_batch_align_cmd(batch, batch_dir, outputs[len(batch):-1],
+                outputs[-1], threads),
+            version="{} / {}".format(get_tool_version('hisat2'), get_samtools_version()),
+            cacheable=True))
+
+        for hisat2 in batch:
+            unsorted_bam = get_unsorted_bam(hisat2, batch_dir)
+            graph.add(Task("sort:{}".format(hisat2.name), sort_bam,
+                args=(unsorted_bam, hisat2.bam, sort_threads, sort_mem_mb),
+                inputs=[unsorted_bam],
+                outputs=[hisat2.bam],
+                sample=hisat2.sample_name, cpus=sort_threads,
+                mem_mb=sort_mem_mb*sort_threads,
+                cmd=get_sort_cmd(unsorted_bam, hisat2.bam, sort_threads, sort_mem_mb),
+                version=get_samtools_version(),
+                cacheable=True))
+
+def add_chunked_tasks(graph, sample, config_dict, broker, deps=()) -> None:
+    '''
+        Declare fastp splitting the trimmed reads into chunks, one Hisat2 job
+        per chunk, and the merge of the chunk BAM files into the sample BAM
+        with aggregated alignment summaries
+    '''
+    threads = get_tool_threads('fastp', config_dict)
+    chunks = config_dict['chunks']
+    name = sample.name
+
+    units = get_chunk_units(sample, chunks)
+    fastp_outputs = [unit.ready_fq1 for unit in units] + \
+        [unit.ready_fq2 for unit in units] + \
+        [get_fastp_json(sample.fastq_folder), get_fastp_html(sample.fastq_folder)]
+    graph.add(Task("fastp:{}".format(name), fastp_split,
+        args=(name, sample.fastq_folder, sample.fq1, sample.fq2, chunks, threads,
+            get_tool_path('fastp')),
+        inputs=[sample.fq1, sample.fq2],
+        outputs=fastp_outputs,
+        deps=deps,
+        sample=sample.sample_name, **get_requirements('fastp', config_dict, threads),
+        cmd=get_fastp_cmd(sample.fq1, sample.fq2,
+            get_trimmed_fastq(sample.fq1, sample.fastq_folder),
+            get_trimmed_fastq(sample.fq2, sample.fastq_folder), *fastp_outputs[-2:],
+            threads, get_tool_path('fastp'), split=chunks),
+        version=get_tool_version('fastp'),
+        cacheable=True))
+
+    hisat2_mem_mb = get_hisat2_mem_mb(config_dict)
+    sort_mem_mb = get_sort_mem_per_thread_mb(config_dict, broker, hisat2_mem_mb,
+        get_tool_threads('samtools_sort', config_dict))
+    chunk_bams = []
+    chunk_summaries = []
+    for unit in units:
+        hisat2 = get_aligner(unit, config_dict, sort_mem_mb=sort_mem_mb)
+        graph.add(Task("hisat2:{}".format(unit.name), hisat2.align,
+            inputs=[unit.ready_fq1, unit.ready_fq2] + get_index_inputs(config_dict),
+            outputs=[unit.raw_bam, hisat2.summary_file],
+            deps=get_aligner_deps(config_dict),
+            sample=sample.sample_name, cpus=hisat2.threads + hisat2.sort_threads,
+            mem_mb=hisat2_mem_mb + sort_mem_mb*hisat2.sort_threads,
+            cmd=hisat2.cmd,
+            version="{} / {}".format(get_tool_version('hisat2'), get_samtools_version()),
+            cacheable=True))
+        chunk_bams.append(unit.raw_bam)
+        chunk_summaries.append(hisat2.summary_file)
+
+    add_bam_files(sample)
+    summary_file = get_alignment_summary(sample.raw_bam)
+    merge_threads = get_tool_threads('samtools', config_dict)
+    graph.add(Task("merge_chunks:{}".format(name), gather_chunks,
+        args=(chunk_bams, chunk_summaries, sample.raw_bam, summary_file, merge_threads),
+        inputs=chunk_bams + chunk_summaries,
+        outputs=[sample.raw_bam, summary_file],
+        sample=sample.sample_name, cpus=merge_threads, mem_mb=0,
+        cmd=get_merge_bams_cmd(chunk_bams, sample.raw_bam, merge_threads),
+        version=get_samtools_version()))
+
+def add_stream_tasks(graph, sample, config_dict, broker, deps=()) -> None:
+    '''
+        Declare a single task running fastp and Hisat2 concurrently, with
+        trimmed reads handed over through named pipes
+    '''
+    threads = get_tool_threads('fastp', config_dict)
+    keep_trimmed = config_dict.get('keep_trimmed', False)
+    name = sample.name
+
+    bam_folder = os.path.join(sample.sample_folder, "BAM_FOLDER")
+    fifo1, fifo2 = get_stream_fifos(name, bam_folder)
+    sample.add("ready_fq1", fifo1)
+    sample.add("ready_fq2", fifo2)
+
+    hisat2_mem_mb = get_hisat2_mem_mb(config_dict)
+    fastp_requirements = get_requirements('fastp', config_dict, threads)
+    sort_mem_mb = get_sort_mem_per_thread_mb(config_dict, broker,
+        hisat2_mem_mb + fastp_requirements['mem_mb'],
+        get_tool_threads('samtools_sort', config_dict))
+    hisat2 = get_aligner(sample, config_dict, sort_mem_mb=sort_mem_mb)
+
+    outputs = get_stream_outputs(sample, hisat2, keep_trimmed)
+    graph.add(Task("fastp_hisat2:{}".format(name), stream_align,
+        args=(sample, hisat2, threads, keep_trimmed),
+        inputs=[sample.fq1, sample.fq2] + get_index_inputs(config_dict),
+        outputs=outputs,
+        deps=list(deps) + get_aligner_deps(config_dict),
+        sample=sample.sample_name,
+        cpus=fastp_requirements['cpus'] + hisat2.threads + hisat2.sort_threads,
+        mem_mb=fastp_requirements['mem_mb'] + hisat2_mem_mb + sort_mem_mb*hisat2.sort_threads,
+        cmd=" & ".join(get_stream_cmds(sample, hisat2, outputs, threads, keep_trimmed)),
+        version="{} / {} / {}".format(get_tool_version('fastp'),
+            get_tool_version('hisat2'), get_samtools_version()),
+        cacheable=True))
+
+def add_fastqc_tasks(graph, sample_list, config_dict, docker_dict, broker,
+    containers=None) -> None:
+    '''
+        Declare batched FastQC tasks over the raw fastq files of all samples,
+        each one a single FastQC run with one thread per file
+    '''
+    backend = config_dict.get('backend', "auto")
+    fastq_reports = [(fq, sample.fastq_folder) for sample in sample_list
+        for fq in sample.raw_fastqs]
+
+    for idx, batch in enumerate(get_fastqc_batches(fastq_reports, broker.cpus), 1):
+        batch_fastqs, batch_dirs = [list(x) for x in zip(*batch)]
+        staging_dir = get_fastqc_staging_dir(config_dict['output_dir'], idx)
+        threads = len(batch)
+        graph.add(Task("fastqc:batch{}".format(idx), fastqc,
+            args=(batch_fastqs, batch_dirs, staging_dir, threads, docker_dict,
+                containers, backend),
+            inputs=batch_fastqs,
+            outputs=[get_fastqc_report(fq, report_dir)
+                for fq, report_dir in zip(batch_fastqs, batch_dirs)],
+            **get_requirements('fastqc', config_dict, threads),
+            cmd=get_fastqc_cmd(batch_fastqs, staging_dir, threads),
+            version=get_backend_version('fastqc', docker_dict, backend)))
+
+def add_native_qc_tasks(graph, sample_list, config_dict) -> None:
+    '''
+        Declare one built-in QC task per sample, with its raw fastq files
+        processed by two parallel processes
+    '''
+    for sample in sample_list:
+        fastq_list = sample.raw_fastqs
+        graph.add(Task("qc:{}".format(sample.name), native_qc,
+            args=(fastq_list, [sample.fastq_folder]*len(fastq_list), 2),
+            inputs=fastq_list,
+            outputs=[get_qc_report(fq, sample.fastq_folder) for fq in fastq_list],
+            sample=sample.name, **get_requirements('native_qc', config_dict, 2),
+            version=QC_VERSION))
+
+def add_subsample_task(graph, sample, config_dict) -> None:
+    '''
+        Declare the subsampling of the read pairs of a sample, and point the
+        sample to the subsampled fastq files
+    '''
+    deps = []
+    if config_dict.get('index_fastqs'):
+        deps.append(add_fastq_index_task(graph, sample, config_dict))
+    raw_fastqs = sample.raw_fastqs
+    lanes = sample.lanes
+    outputs = set_subsample_fastqs(sample, config_dict['subsample'])
+    graph.add(Task("subsample:{}".format(sample.name), subsample_sample,
+        args=(sample.name, lanes, config_dict['subsample'], *outputs,
+            config_dict.get('index_cache_dir')),
+        inputs=raw_fastqs,
+        outputs=list(outputs),
+        deps=deps,
+        sample=sample.name, cpus=1, mem_mb=0))
+
+def add_fastq_index_task(graph, sample, config_dict) -> str:
+    '''
+        Declare the indexing of the raw fastq files of a sample in the pyfastx
+        index cache. Indexes already there are reused, and a cleared cache
+        invalidates the task through its done markers
+
+        :returns: the task name
+        :rtype: str
+    '''
+    cache_dir = config_dict.get('index_cache_dir')
+    index_cache = FastqIndexCache(cache_dir)
+    raw_fastqs = sample.raw_fastqs
+    name = "index_fastq:{}".format(sample.name)
+    graph.add(Task(name, index_fastqs,
+        args=(raw_fastqs, cache_dir),
+        inputs=raw_fastqs,
+        outputs=[index_cache.get_done_marker(fq) for fq in raw_fastqs],
+        sample=sample.name, cpus=1, mem_mb=0))
+    return name
+
+def add_quicklook_tasks(graph, sample_list, config_dict, docker_dict,
+    containers=None) -> None:
+    '''
+        Declare the strandedness inference of every sample and the
+        quick-look report gathering the results of all samples
+    '''
+    backend = config_dict.get('backend', "auto")
+    report_inputs = []
+    for sample in sample_list:
+        strandedness_file = get_strandedness_file(sample)
+        graph.add(Task("strandedness:{}".format(sample.name), infer_strandedness,
+            args=(sample, config_dict, docker_dict, containers),
+            inputs=[sample.ready_bam, config_dict['GRCh38']['gtf']],
+            outputs=[strandedness_file],
+            sample=sample.name, **get_requirements('featureCounts', config_dict,
+                get_tool_threads('featureCounts', config_dict)),
+            version=get_backend_version('featureCounts', docker_dict, backend)))
+        count_file = get_count_file(sample)
+        report_inputs += [strandedness_file, count_file, sample.picard_metrics,
+            get_alignment_summary(sample.raw_bam)]
+
+    report = get_quicklook_report(config_dict['output_dir'])
+    graph.add(Task("quicklook_report", write_quicklook_report,
+        args=(sample_list, report),
+        inputs=report_inputs,
+        outputs=[report]))
+
+def build_task_graph(sample_list, config_dict, docker_dict, broker,
+    containers=None) -> TaskGraph:
+    '''
+        Build the dependency graph with the tasks of all samples
+    '''
+    graph = TaskGraph()
+    if config_dict.get('stream') and (config_dict.get('chunks') or 1) > 1:
+        msg = " WARNING: --chunks is ignored with --stream"
+        logging.warning(msg)
+    # Aligners collected from all samples, to be run in batches
+    aligners = None
+    if (config_dict.get('batch_size') or 1) > 1:
+        if config_dict.get('stream') or (config_dict.get('chunks') or 1) > 1:
+            msg = " WARNING: --batch_size is ignored with --stream and --chunks"
+            logging.warning(msg)
+        else:
+            aligners = []
+    if config_dict.get('subsample'):
+        for sample in sample_list:
+            add_subsample_task(graph, sample, config_dict)
+    if config_dict.get('shared_index'):
+        add_warm_index_task(graph, config_dict)
+    if config_dict.get('qc', "fastqc") == "native":
+        add_native_qc_tasks(graph, sample_list, config_dict)
+    else:
+        add_fastqc_tasks(graph, sample_list, config_dict, docker_dict, broker,
+            containers)
+    for sample in sample_list:
+        add_sample_tasks(graph, sample, config_dict, docker_dict, broker, containers,
+            aligners)
+    if aligners:
+        add_batch_tasks(graph, aligners, config_dict, broker)
+    if config_dict.get('subsample'):
+        add_quicklook_tasks(graph, sample_list, config_dict, docker_dict, containers)
+    return graph
+
+def get_required_images(config_dict, docker_dict) -> list:
+    '''
+        Docker images the run cannot do without: those of the containerised
+        tools it runs, unless they run natively. With the native backend a
+        missing tool is reported when its task is built
+
+        :rtype: list
+    '''
+    backend = config_dict.get('backend', "auto")
+    if backend == "native":
+        return []
+    programs = ['featureCounts']
+    if config_dict.get('qc', "fastqc") != "native":
+        programs.append('fastqc')
+    return [get_image_ref(program, docker_dict) for program in programs
+        if program in docker_dict and not use_native(program, docker_dict, backend)]
+
+def run_samples(sample_list, config_dict, docker_dict) -> list:
+    '''
+        Process all samples through the task graph. Any task whose inputs are
+        ready is started as soon as its CPU and memory needs fit the budget,
+        so that samples and independent steps of the same sample advance
+        concurrently without overcommitting the host.
+
+        :param list sample_list: list of Sample objects
+        :param dict config_dict: run configuration
+        :param dict docker_dict: docker images configuration
+        :returns: list of processed Sample objects
+        :rtype: list
+        :raises TaskFailed: if any task failed
+    '''
+    if not sample_list:
+        return sample_list
+
+    broker = ResourceBroker.from_config(config_dict)
+
+    # Threads of every tool, from those of each sample
+    config_dict = {**config_dict, 'thread_plan': get_thread_plan(config_dict,
+        broker.cpus, len(sample_list))}
+    msg = (" INFO: Threads per sample: {}").format(", ".join("{} {}".format(tool, threads)
+        for tool, threads in config_dict['thread_plan'].items()))
+    logging.info(msg)
+
+    # One long-lived container per image, with inputs and outputs mounted
+    containers = ContainerPool(get_mounts([config_dict['output_dir'],
+        config_dict['GRCh38']['gtf']] + [fq for sample in sample_list
+        for fq in sample.raw_fastqs]))
+    graph = build_task_graph(sample_list, config_dict, docker_dict, broker, containers)
+
+    # Steps recorded as up to date by a previous run are not run again
+    manifest = RunManifest(os.path.join(config_dict['output_dir'], MANIFEST_NAME),
+        hash_inputs=config_dict.get('hash_inputs', False))
+
+    # Outputs shared with other runs processing the same inputs
+    cache = None
+    if config_dict.get('cache_dir'):
+        cache = ArtifactCache(config_dict['cache_dir'],
+            max_size_gb=config_dict.get('cache_size', 500))
+
+    msg = (" INFO: Running {} tasks for {} samples within {} CPUs and {} MB")\
+        .format(len(graph), len(sample_list), broker.cpus, broker.mem_mb)
+    logging.info(msg)
+
+    # Timing and resource usage of every step and tool invocation
+    recorder = MetricsRecorder()
+    runner = get_runner()
+    runner.add_listener(recorder.on_command)
+
+    # Every task takes at least one CPU, the broker bounds concurrency
+    try:
+        graph.run(max_workers=broker.cpus, broker=broker, manifest=manifest,
+            cache=cache, recorder=recorder, on_interrupt=runner.cancel_all)
+    finally:
+        containers.close()
+        runner.remove_listener(recorder.on_command)
+        recorder.write(config_dict['output_dir'],
+            {sample.name: sample.sample_folder for sample in sample_list})
+        write_chrome_trace(recorder, config_dict['output_dir'])
+
+    return sample_list
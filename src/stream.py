@@ -0,0 +1,124 @@
+import os
+import sys
+import re
+import logging
+from src.utils import atomic_outputs, get_tmp_path
+from src.runner import run_group, get_log_prefix
+from src.tools import get_tool_path
+from src.preprocessing import TrimmingFailed, get_fastp_cmd, get_fastp_json,\
+    get_fastp_html, get_trimmed_fastq
+from src.map import InvalidBAM
+
+logger = logging.getLogger(__name__)
+
+# Folder of a sample BAM folder holding its named pipes
+STREAM_DIR = ".stream"
+
+
+def get_stream_fifos(sample_name, output_dir) -> tuple:
+    '''
+        Named pipes through which fastp hands trimmed reads to Hisat2
+    '''
+    stream_dir = os.path.join(output_dir, STREAM_DIR)
+    return (os.path.join(stream_dir, sample_name + ".R1.fq"),
+        os.path.join(stream_dir, sample_name + ".R2.fq"))
+
+def get_stream_outputs(sample, hisat2, keep_trimmed=False) -> list:
+    '''
+        Files written by the streamed fastp and Hisat2: BAM, alignment
+        summary, fastp reports and, if kept, the trimmed fastq files
+    '''
+    outputs = [hisat2.bam, hisat2.summary_file, get_fastp_json(sample.fastq_folder),
+        get_fastp_html(sample.fastq_folder)]
+    if keep_trimmed:
+        outputs += [get_trimmed_fastq(sample.fq1, sample.fastq_folder),
+            get_trimmed_fastq(sample.fq2, sample.fastq_folder)]
+    return outputs
+
+def get_stream_cmds(sample, hisat2, outputs, threads, keep_trimmed=False) -> list:
+    '''
+        Command lines of a streamed sample: fastp writing uncompressed reads
+        into named pipes, Hisat2 reading them and, if trimmed reads are kept,
+        tee processes saving a gzipped copy on the way
+
+        :param list outputs: files to write, as given by get_stream_outputs
+        :rtype: list
+    '''
+    fifo1, fifo2 = get_stream_fifos(sample.name, hisat2.output_dir)
+    bam, summary_file, output_json, output_html = outputs[:4]
+
+    if not keep_trimmed:
+        return [get_fastp_cmd(sample.fq1, sample.fq2, fifo1, fifo2, output_json,
+            output_html, threads, get_tool_path('fastp')),
+            hisat2.get_cmd(bam, summary_file)]
+
+    cmds = [get_fastp_cmd(sample.fq1, sample.fq2, fifo1 + ".fastp", fifo2 + ".fastp",
+        output_json, output_html, threads, get_tool_path('fastp')),
+        hisat2.get_cmd(bam, summary_file)]
+    for fifo, trimmed_fq in zip((fifo1, fifo2), outputs[4:]):
+        cmds.append("tee {} < {} | gzip -c > {}".format(fifo, fifo + ".fastp", trimmed_fq))
+    return cmds
+
+def make_fifos(paths) -> None:
+    '''
+        Create named pipes, replacing any left by an interrupted run
+    '''
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        os.mkfifo(path)
+
+def stream_align(sample, hisat2, threads, keep_trimmed=False) -> str:
+    '''
+        Trim and align a sample without writing trimmed fastq files: fastp
+        and Hisat2 run concurrently, connected by named pipes. If either
+        side fails the other is killed, and no output is kept
+
+        :param Sample sample: sample to be processed
+        :param Hisat2 hisat2: aligner reading the named pipes
+        :param int threads: fastp threads
+        :param bool keep_trimmed: also save gzipped trimmed fastq files
+        :returns: the output BAM
+        :rtype: str
+        :raises TrimmingFailed: if fastp failed
+        :raises InvalidBAM: if Hisat2 or samtools failed
+    '''
+    msg = (" INFO: Trimming and mapping sample {} through named pipes").format(
+        sample.name)
+    logging.info(msg)
+
+    fifos = list(get_stream_fifos(sample.name, hisat2.output_dir))
+    if keep_trimmed:
+        fifos += [fifo + ".fastp" for fifo in fifos]
+
+    outputs = get_stream_outputs(sample, hisat2, keep_trimmed)
+    with atomic_outputs(outputs) as tmp_outputs:
+        make_fifos(fifos)
+        cmds = get_stream_cmds(sample, hisat2, tmp_outputs, threads, keep_trimmed)
+        steps = ["fastp", "hisat2", "tee_R1", "tee_R2"]
+        commands = [(cmd, get_log_prefix(hisat2.output_dir, step + "." + sample.name))
+            for step, cmd in zip(steps, cmds)]
+        try:
+            results = run_group(commands, check=False)
+        finally:
+            for fifo in fifos:
+                if os.path.exists(fifo):
+                    os.remove(fifo)
+
+        # Killed commands have no result, the failed one does
+        for step, result in zip(steps, results):
+            if result is None or result.returncode == 0:
+                continue
+            if step == "hisat2":
+                raise InvalidBAM(result.stderr)
+            msg = (" ERROR: {} failed while streaming sample {}: {}").format(step,
+                sample.name, result.stderr)
+            raise TrimmingFailed(msg)
+        if re.search("error", results[0].stderr):
+            msg = (" ERROR: Something wrong happened with fastp trimming for sample {}")\
+                .format(sample.name)
+            logging.error(results[0].stderr)
+            raise TrimmingFailed(msg)
+
+    return hisat2.bam
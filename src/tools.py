@@ -0,0 +1,167 @@
+import os
+import sys
+import shutil
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+main_dir = os.path.dirname(os.path.abspath(__file__))
+binaries_dir = os.path.join(main_dir, "../binaries")
+
+# Environment variables named RNASEQ_<TOOL> override the path of a tool
+ENV_PREFIX = "RNASEQ_"
+
+
+class ToolNotFound(Exception):
+    pass
+
+
+class ToolRegistry():
+    '''
+        Lazily resolved, memoised paths and versions of the external tools.
+        Nothing is looked up when the registry is created: a tool path is
+        resolved the first time it is needed (environment override, bundled
+        binary, then PATH), and its version command is run at most once per
+        process
+    '''
+    def __init__(self):
+        self._tools = {}
+        self._paths = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, bundled=None, version_cmd="{} --version") -> None:
+        '''
+            Declare a tool
+
+            :param str name: tool name, also looked up on PATH
+            :param str bundled: path of the copy shipped on binaries/, if any
+            :param str version_cmd: command printing the tool version, with a
+                placeholder for the tool command (see command)
+        '''
+        self._tools[name] = {'bundled': bundled, 'version_cmd': version_cmd}
+
+    def _resolve(self, name) -> str:
+        '''
+        '''
+        if name not in self._tools:
+            msg = (" ERROR: unknown tool {}").format(name)
+            raise ToolNotFound(msg)
+
+        env_var = ENV_PREFIX + name.upper()
+        if os.environ.get(env_var):
+            return os.environ[env_var]
+
+        bundled = self._tools[name]['bundled']
+        if bundled and os.path.isfile(bundled):
+            return os.path.abspath(bundled)
+
+        path = shutil.which(name)
+        if path:
+            return path
+
+        msg = (" ERROR: Unable to find the PATH of {}. Install it or set {}")\
+            .format(name, env_var)
+        raise ToolNotFound(msg)
+
+    def path(self, name) -> str:
+        '''
+            Path of a tool, resolved on first use
+
+            :raises ToolNotFound: if the tool is not available
+        '''
+        with self._lock:
+            if name not in self._paths:
+                self._paths[name] = self._resolve(name)
+            return self._paths[name]
+
+    def is_available(self, name) -> bool:
+        '''
+        '''
+        try:
+            self.path(name)
+        except ToolNotFound:
+            return False
+        return True
+
+    def command(self, name, java_opts=()) -> str:
+        '''
+            Command line prefix running a tool. A .jar is run with the java of
+            the registry. Anything else is run directly, e.g. the bioconda
+            picard wrapper found on PATH, which passes JVM options on to java
+
+            :param list java_opts: JVM options, e.g. -Xmx4096m
+        '''
+        path = self.path(name)
+        if not path.endswith(".jar"):
+            return " ".join([path, *java_opts])
+        return " ".join([self.path("java"), *java_opts, "-jar", path])
+
+    def version(self, name) -> str:
+        '''
+            First line printed by the version command of a tool, e.g.
+            "samtools --version". Each tool is probed once per process
+
+            :raises ToolNotFound: if the tool is not available
+        '''
+        command = self.command(name)
+        with self._lock:
+            if name in self._versions:
+                return self._versions[name]
+
+        cmd = self._tools[name]['version_cmd'].format(command)
+        p1 = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        output = p1.stdout.decode('UTF-8') + p1.stderr.decode('UTF-8')
+        version = ""
+        for line in output.split('\n'):
+            if line.strip():
+                version = line.strip()
+                break
+
+        with self._lock:
+            self._versions[name] = version
+        return version
+
+    def reset(self) -> None:
+        '''
+            Forget resolved paths and versions, e.g. after PATH changed
+        '''
+        with self._lock:
+            self._paths.clear()
+            self._versions.clear()
+
+
+TOOLS = ToolRegistry()
+TOOLS.register("hisat2",
+    bundled=os.path.join(binaries_dir, "hisat2-2.2.1-Linux_x86_64/hisat2-2.2.1/hisat2"))
+TOOLS.register("samtools", bundled=os.path.join(binaries_dir, "samtools/bin/samtools"))
+TOOLS.register("fastp", bundled=os.path.join(binaries_dir, "fastp"))
+TOOLS.register("picard", bundled=os.path.join(binaries_dir, "picard.jar"),
+    version_cmd="{} MarkDuplicates --version")
+TOOLS.register("java", version_cmd="{} -version")
+TOOLS.register("docker")
+# Containerised tools, also run natively when installed
+TOOLS.register("fastqc")
+TOOLS.register("featureCounts", version_cmd="{} -v")
+
+
+def get_tool_path(name) -> str:
+    '''
+        Path of a registered tool. See ToolRegistry.path
+    '''
+    return TOOLS.path(name)
+
+def get_tool_command(name, java_opts=()) -> str:
+    '''
+        Command line prefix of a registered tool. See ToolRegistry.command
+    '''
+    return TOOLS.command(name, java_opts)
+
+def get_tool_version(name) -> str:
+    '''
+        Version of a registered tool. See ToolRegistry.version
+    '''
+    return TOOLS.version(name)
@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRACE_JSON = "run_trace.json"
+# Process id used for steps not bound to a sample and for counters
+RUN_PID = 0
+
+
+def _to_us(seconds) -> int:
+    return int(round(seconds * 1e6))
+
+def _assign_lanes(spans) -> list:
+    '''
+        Assign each (start, end) span the lowest lane that is free at its
+        start, so that overlapping spans never share a lane
+
+        :returns: lane of every span, in input order
+        :rtype: list
+    '''
+    lane_ends = []
+    lanes = []
+    for start, end in spans:
+        for lane, lane_end in enumerate(lane_ends):
+            if lane_end <= start:
+                lane_ends[lane] = end
+                lanes.append(lane)
+                break
+        else:
+            lane_ends.append(end)
+            lanes.append(len(lane_ends) - 1)
+    return lanes
+
+def get_trace_events(recorder) -> list:
+    '''
+        Chrome Trace Event list of a run. Every sample is a process whose
+        threads are lanes of concurrently running steps; every step is a
+        span with its tool invocations nested below it. A counter tracks the
+        number of running steps over time, so idle periods and stage
+        barriers stand out
+
+        :param MetricsRecorder recorder: metrics of the run
+        :rtype: list
+    '''
+    origin = recorder.start
+    steps = sorted([step for step in recorder.steps if step['end'] is not None],
+        key=lambda s: s['start'])
+
+    samples = sorted({sample for step in steps for sample in step['samples']})
+    pids = {sample: idx for idx, sample in enumerate(samples, 1)}
+
+    events = [{'ph': "M", 'name': "process_name", 'pid': RUN_PID,
+        'args': {'name': "run"}}]
+    for sample, pid in pids.items():
+        events.append({'ph': "M", 'name': "process_name", 'pid': pid,
+            'args': {'name': sample}})
+        events.append({'ph': "M", 'name': "process_sort_index", 'pid': pid,
+            'args': {'sort_index': pid}})
+
+    # A step run for several samples is shown in the process of each of them
+    by_pid = {}
+    for step in steps:
+        for pid in [pids[sample] for sample in step['samples']] or [RUN_PID]:
+            by_pid.setdefault(pid, []).append(step)
+
+    for pid, pid_steps in by_pid.items():
+        lanes = _assign_lanes([(s['start'], s['end']) for s in pid_steps])
+        for tid in sorted(set(lanes)):
+            events.append({'ph': "M", 'name': "thread_name", 'pid': pid,
+                'tid': tid, 'args': {'name': "lane {}".format(tid)}})
+
+        for step, tid in zip(pid_steps, lanes):
+            events.append({
+                'ph': "X", 'cat': "step", 'name': step['step'], 'pid': pid,
+                'tid': tid, 'ts': _to_us(step['start'] - origin),
+                'dur': _to_us(step['end'] - step['start']),
+                'args': {'task': step['task'], 'status': step['status'],
+                    'input_bytes': step['input_bytes'],
+                    'output_bytes': step['output_bytes']},
+            })
+            for command in step['commands']:
+                events.append({
+                    'ph': "X", 'cat': "command",
+                    'name': command['cmd'].split()[0].split("/")[-1],
+                    'pid': pid, 'tid': tid, 'ts': _to_us(command['start'] - origin),
+                    'dur': _to_us(command['end'] - command['start']),
+                    'args': {key: value for key, value in command.items()
+                        if key not in ('start', 'end')},
+                })
+
+    # Number of running steps over time
+    changes = []
+    for step in steps:
+        if step['end'] > step['start']:
+            changes.append((step['start'], 1))
+            changes.append((step['end'], -1))
+    running = 0
+    for ts, delta in sorted(changes):
+        running += delta
+        events.append({'ph': "C", 'name': "running steps", 'pid': RUN_PID,
+            'ts': _to_us(ts - origin), 'args': {'steps': running}})
+
+    return events
+
+def write_chrome_trace(recorder, output_dir) -> str:
+    '''
+        Write run_trace.json on output_dir, viewable in Perfetto or
+        chrome://tracing
+
+        :returns: path of the trace file
+        :rtype: str
+    '''
+    trace_path = os.path.join(output_dir, TRACE_JSON)
+    with open(trace_path, "w") as f:
+        json.dump({'traceEvents': get_trace_events(recorder),
+            'displayTimeUnit': "ms"}, f)
+
+    msg = (" INFO: Run timeline written to {}").format(trace_path)
+    logging.info(msg)
+    return trace_path
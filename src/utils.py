@@ -1,66 +1,74 @@
 import os
 import sys
 from pathlib import Path
-import glob
 import subprocess
 import logging
-from src.config import NGSbinaries, DOCKER
+import shutil
+from contextlib import contextmanager
+from src.tools import get_tool_path
+from src.runner import run_cmd, get_log_prefix
 
 logger = logging.getLogger(__name__)
 
-def run_multiqc(output_dir, docker_config):
+class MissingOutput(Exception):
+    pass
+
+# Lines of the stderr of a failed tool shown in the log
+STDERR_TAIL_LINES = 20
+
+def run_multiqc(output_dir, docker_config) -> bool:
     '''
+        Gather the reports of a run with MultiQC. A failed MultiQC run is
+        logged, without stopping the pipeline
+
+        :returns: True if MultiQC ended successfully
+        :rtype: bool
     '''
-    cmd = ('{} run -v {}:/run_dir/ -it {}'
+    cmd = ('{} run -v {}:/run_dir/ {}'
         ' /run_dir/. --outdir /run_dir/')\
-        .format(DOCKER, docker_dict['multiqc']['image'], output_dir)
-    p1 = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    output = p1.stdout.decode('UTF-8')
-    error  = p1.stderr.decode('UTF-8')
-
-def get_fastq_files(input_dir, avoid_trimmed=False):
-  '''
-    Get fastq files from input directory
-  '''
-  fastq_list = []
-  fastq_list = glob.glob(input_dir +  "/*.fastq.gz")
-  if not fastq_list:
-    fastq_list = glob.glob(input_dir +  "/*.fa.gz")
-  if not fastq_list:
-    msg = " ERROR: No input fastq files were detected"
-    logging.error(msg)
-    sys.exit()
-
-  filtered_list = []
-  for fastq in sorted(fastq_list):
-    if avoid_trimmed == True:
-        if 'trimmed' in fastq:
-            continue
-    if 'Undetermined' in fastq:
-      continue
-    else:
-      filtered_list.append(fastq)
+        .format(get_tool_path('docker'), output_dir, docker_config['multiqc']['image'])
+    result = run_cmd(cmd, log_prefix=get_log_prefix(output_dir, "multiqc"),
+        check=False)
+    if result.returncode != 0:
+        msg = (" ERROR: MultiQC failed with exit code {}: {}").format(result.returncode,
+            "\n".join(result.stderr.splitlines()[-STDERR_TAIL_LINES:]))
+        logging.error(msg)
+        return False
+    return True
 
-  return filtered_list
+def get_tmp_path(path) -> str:
+    '''
+        Temporary name used while an output is being written. It lives in the
+        same directory so that it can be renamed atomically, and it keeps the
+        file extension since some tools infer the output format from it
+    '''
+    return os.path.join(os.path.dirname(path), ".tmp." + os.path.basename(path))
 
-def get_bin_path(program) -> str:
+@contextmanager
+def atomic_outputs(outputs):
     '''
-        Get the PATH of a program
+        Yield temporary names for outputs and rename them to their final
+        name only if the block ends successfully, so that an interrupted step
+        never leaves a truncated output behind
+
+        :param list outputs: final output files
+        :raises MissingOutput: if any temporary output was not written
     '''
-    path = ""
-    cmd = ('which {}').format(program)
-    p1 = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    output = p1.stdout.decode('UTF-8')
-    error  = p1.stderr.decode('UTF-8')
-    if not error:
-        if output:
-            path = output.rstrip('\n')
-            return path
-        else:
-            msg = (" ERROR: Unable to find the PATH of {}").format(program)
-            logging.error(msg)
-    else:
-        msg = (" ERROR: Unable to find the PATH of {}").format(program)
-        logging.error(msg)
+    tmp_outputs = [get_tmp_path(output) for output in outputs]
+    for tmp_output in tmp_outputs:
+        if os.path.isdir(tmp_output):
+            shutil.rmtree(tmp_output)
+        elif os.path.exists(tmp_output):
+            os.remove(tmp_output)
+    try:
+        yield tmp_outputs
+        for tmp_output in tmp_outputs:
+            if not os.path.exists(tmp_output):
+                msg = (" ERROR: expected output {} was not written").format(tmp_output)
+                raise MissingOutput(msg)
+        for tmp_output, output in zip(tmp_outputs, outputs):
+            os.replace(tmp_output, output)
+    finally:
+        for tmp_output in tmp_outputs:
+            if os.path.isfile(tmp_output):
+                os.remove(tmp_output)
@@ -0,0 +1,99 @@
+import subprocess
+from src.batch import DEMUX_AWK, FEEDER_AWK
+
+SEQ = "ACGTACGTAC"
+QUAL = "IIIIIIIIII"
+
+
+def sam_record(name, flag, *tags) -> str:
+    mapped = not flag & 4
+    fields = [name, str(flag), "chr1" if mapped else "*", "100" if mapped else "0",
+        "60" if mapped else "0", "10M" if mapped else "*", "=" if mapped else "*",
+        "200" if mapped else "0", "0", SEQ, QUAL] + list(tags)
+    return "\t".join(fields)
+
+def run_demux(tmp_path, sam_lines):
+    summaries = [str(tmp_path / "s{}.summary.txt".format(idx)) for idx in (1, 2)]
+    result = subprocess.run(["awk", "-v", "ids=rg1,rg2", "-v",
+        "summaries=" + ",".join(summaries), "-v",
+        "rgs=@RG\\tID:rg1\\tSM:A\\n@RG\\tID:rg2\\tSM:B", DEMUX_AWK],
+        input="\n".join(sam_lines) + "\n", capture_output=True, text=True, check=True)
+    return result.stdout.splitlines(), [open(summary).read() for summary in summaries]
+
+SAM = [
+    "@HD\tVN:1.6\tSO:unsorted",
+    "@SQ\tSN:chr1\tLN:1000",
+    # Sample 1: one concordant unique pair, one concordant multi-mapped
+    # pair (with a secondary alignment) and one discordant pair
+    sam_record("0_p1", 99, "NH:i:1"),
+    sam_record("0_p1", 147, "NH:i:1"),
+    sam_record("0_p2", 99, "NH:i:2"),
+    sam_record("0_p2", 147, "NH:i:2"),
+    sam_record("0_p2", 355, "NH:i:2"),
+    sam_record("0_p3", 97, "NH:i:1"),
+    sam_record("0_p3", 145, "NH:i:1"),
+    # Sample 2: one pair with a single aligned mate, one unaligned pair
+    sam_record("1_p4", 73, "NH:i:1"),
+    sam_record("1_p4", 133),
+    sam_record("1_p5", 77),
+    sam_record("1_p5", 141),
+]
+
+
+def test_demux_tags_records_with_their_read_group(tmp_path):
+    lines, summaries = run_demux(tmp_path, SAM)
+    assert lines[:4] == ["@HD\tVN:1.6\tSO:unsorted", "@SQ\tSN:chr1\tLN:1000",
+        "@RG\tID:rg1\tSM:A", "@RG\tID:rg2\tSM:B"]
+    records = [line.split("\t") for line in lines[4:]]
+    assert len(records) == len(SAM) - 2
+    assert [record[0] for record in records] == \
+        ["p1", "p1", "p2", "p2", "p2", "p3", "p3", "p4", "p4", "p5", "p5"]
+    assert [record[-1] for record in records] == ["RG:Z:rg1"]*7 + ["RG:Z:rg2"]*4
+
+def test_demux_writes_hisat2_summary_of_every_sample(tmp_path):
+    lines, summaries = run_demux(tmp_path, SAM)
+    assert summaries[0] == '''3 reads; of these:
+  3 (100.00%) were paired; of these:
+    1 (33.33%) aligned concordantly 0 times
+    1 (33.33%) aligned concordantly exactly 1 time
+    1 (33.33%) aligned concordantly >1 times
+    ----
+    1 pairs aligned concordantly 0 times; of these:
+      1 (100.00%) aligned discordantly 1 time
+    ----
+    0 pairs aligned 0 times concordantly or discordantly; of these:
+      0 mates make up the pairs; of these:
+        0 (0.00%) aligned 0 times
+        0 (0.00%) aligned exactly 1 time
+        0 (0.00%) aligned >1 times
+100.00% overall alignment rate
+'''
+    assert summaries[1] == '''2 reads; of these:
+  2 (100.00%) were paired; of these:
+    2 (100.00%) aligned concordantly 0 times
+    0 (0.00%) aligned concordantly exactly 1 time
+    0 (0.00%) aligned concordantly >1 times
+    ----
+    2 pairs aligned concordantly 0 times; of these:
+      0 (0.00%) aligned discordantly 1 time
+    ----
+    2 pairs aligned 0 times concordantly or discordantly; of these:
+      4 mates make up the pairs; of these:
+        3 (75.00%) aligned 0 times
+        1 (25.00%) aligned exactly 1 time
+        0 (0.00%) aligned >1 times
+25.00% overall alignment rate
+'''
+
+def test_demux_without_records_writes_header_and_empty_summaries(tmp_path):
+    lines, summaries = run_demux(tmp_path, SAM[:2])
+    assert lines == SAM[:2] + ["@RG\tID:rg1\tSM:A", "@RG\tID:rg2\tSM:B"]
+    for summary in summaries:
+        assert summary.startswith("0 reads; of these:\n")
+        assert summary.endswith("0.00% overall alignment rate\n")
+
+def test_feeder_prefixes_read_names():
+    fastq = "@r1 1:N:0:ACGT\nACGT\n+\n@III\n@r2\nACGT\n+\nIIII\n"
+    result = subprocess.run(["awk", "-v", "p=3_", FEEDER_AWK], input=fastq,
+        capture_output=True, text=True, check=True)
+    assert result.stdout == "@3_r1 1:N:0:ACGT\nACGT\n+\n@III\n@3_r2\nACGT\n+\nIIII\n"
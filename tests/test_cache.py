@@ -0,0 +1,119 @@
+import os
+from src.dag import Task
+from src.cache import ArtifactCache
+
+
+def noop():
+    pass
+
+def make_run(root, content="reads", version="1.0"):
+    '''
+        A run folder with an input and the task producing its output
+    '''
+    os.makedirs(root, exist_ok=True)
+    fq = os.path.join(root, "A.fastq")
+    with open(fq, "w") as f:
+        f.write(content)
+    bam = os.path.join(root, "out", "A.bam")
+    os.makedirs(os.path.dirname(bam), exist_ok=True)
+    cmd = "aligner -U {} -o {}".format(fq, bam)
+    return Task("hisat2:A", noop, inputs=[fq], outputs=[bam], cmd=cmd,
+        version=version, cacheable=True)
+
+
+def test_key_does_not_depend_on_run_paths(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    first = cache.key(make_run(str(tmp_path / "run1")))
+    assert first is not None
+    assert cache.key(make_run(str(tmp_path / "run2"))) == first
+
+def test_key_depends_on_inputs_cmd_and_version(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    key = cache.key(make_run(str(tmp_path / "run1")))
+    assert cache.key(make_run(str(tmp_path / "run2"), content="other")) != key
+    assert cache.key(make_run(str(tmp_path / "run3"), version="2.0")) != key
+
+    task = make_run(str(tmp_path / "run4"))
+    other_cmd = Task(task.name, noop, inputs=task.inputs, outputs=task.outputs,
+        cmd=task.cmd + " --fast", version=task.version)
+    assert cache.key(other_cmd) != key
+
+def test_key_of_a_missing_input_is_none(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    task = make_run(str(tmp_path / "run1"))
+    os.remove(task.inputs[0])
+    assert cache.key(task) is None
+
+def test_digests_are_persisted(tmp_path):
+    task = make_run(str(tmp_path / "run1"))
+    key = ArtifactCache(str(tmp_path / "cache")).key(task)
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    assert len(cache._digests) == 1
+    assert cache.key(task) == key
+
+def test_store_then_fetch_into_another_run(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    first = make_run(str(tmp_path / "run1"))
+    key = cache.key(first)
+    assert not cache.fetch(key, first.outputs)
+
+    with open(first.outputs[0], "w") as f:
+        f.write("alignments")
+    cache.store(key, first.outputs)
+
+    second = make_run(str(tmp_path / "run2"))
+    assert cache.key(second) == key
+    assert cache.fetch(key, second.outputs)
+    with open(second.outputs[0]) as f:
+        assert f.read() == "alignments"
+    assert not os.path.exists(os.path.join(os.path.dirname(second.outputs[0]),
+        ".tmp.A.bam"))
+
+def test_fetch_of_an_incomplete_entry_misses(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    task = make_run(str(tmp_path / "run1"))
+    key = cache.key(task)
+    with open(task.outputs[0], "w") as f:
+        f.write("alignments")
+    cache.store(key, task.outputs)
+    summary = os.path.join(os.path.dirname(task.outputs[0]), "A.summary.txt")
+    assert not cache.fetch(key, task.outputs + [summary])
+    assert not os.path.exists(summary)
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"), max_size_gb=15 / 1024**3)
+    keys = []
+    for idx in range(3):
+        task = make_run(str(tmp_path / "run{}".format(idx)), content=str(idx))
+        with open(task.outputs[0], "w") as f:
+            f.write("0123456789")
+        key = cache.key(task)
+        cache.store(key, task.outputs)
+        keys.append((key, task))
+        # Entries are ordered on their mtime
+        entry = cache._entry_dir(key)
+        os.utime(entry, (idx, idx))
+
+    # Only the last stored entry fits 15 bytes
+    assert not cache.fetch(keys[0][0], keys[0][1].outputs)
+    assert not cache.fetch(keys[1][0], keys[1][1].outputs)
+    assert cache.fetch(keys[2][0], keys[2][1].outputs)
+
+def test_key_does_not_depend_on_host_resources(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    keys = set()
+    for idx, (heap, threads) in enumerate([(6144, 2), (30720, 16)]):
+        task = make_run(str(tmp_path / "run{}".format(idx)))
+        cmd = "java -Xmx{}m -XX:ParallelGCThreads={} -jar picard.jar {} -p {}".format(
+            heap, threads, task.cmd, threads)
+        keys.add(cache.key(Task(task.name, noop, inputs=task.inputs,
+            outputs=task.outputs, cmd=cmd, version=task.version)))
+    assert len(keys) == 1
+
+def test_strip_resource_options():
+    from src.cache import strip_resource_options
+    assert strip_resource_options("samtools sort -@ 4 -m 768M -T /tmp/A -o A.bam") == \
+        "samtools sort {resources} {resources} -T /tmp/A -o A.bam"
+    # Flags without a number are kept
+    assert strip_resource_options("samtools merge -f -c -p -@ 4 out.bam") == \
+        "samtools merge -f -c -p {resources} out.bam"
@@ -0,0 +1,82 @@
+from src.chunking import aggregate_alignment_summaries
+
+CHUNK_SUMMARIES = ['''100 reads; of these:
+  100 (100.00%) were paired; of these:
+    10 (10.00%) aligned concordantly 0 times
+    80 (80.00%) aligned concordantly exactly 1 time
+    10 (10.00%) aligned concordantly >1 times
+    ----
+    10 pairs aligned concordantly 0 times; of these:
+      2 (20.00%) aligned discordantly 1 time
+    ----
+    8 pairs aligned 0 times concordantly or discordantly; of these:
+      16 mates make up the pairs; of these:
+        8 (50.00%) aligned 0 times
+        6 (37.50%) aligned exactly 1 time
+        2 (12.50%) aligned >1 times
+96.00% overall alignment rate
+''', '''300 reads; of these:
+  300 (100.00%) were paired; of these:
+    30 (10.00%) aligned concordantly 0 times
+    240 (80.00%) aligned concordantly exactly 1 time
+    30 (10.00%) aligned concordantly >1 times
+    ----
+    30 pairs aligned concordantly 0 times; of these:
+      0 (0.00%) aligned discordantly 1 time
+    ----
+    30 pairs aligned 0 times concordantly or discordantly; of these:
+      60 mates make up the pairs; of these:
+        60 (100.00%) aligned 0 times
+        0 (0.00%) aligned exactly 1 time
+        0 (0.00%) aligned >1 times
+90.00% overall alignment rate
+''']
+
+EXPECTED = '''400 reads; of these:
+  400 (100.00%) were paired; of these:
+    40 (10.00%) aligned concordantly 0 times
+    320 (80.00%) aligned concordantly exactly 1 time
+    40 (10.00%) aligned concordantly >1 times
+    ----
+    40 pairs aligned concordantly 0 times; of these:
+      2 (5.00%) aligned discordantly 1 time
+    ----
+    38 pairs aligned 0 times concordantly or discordantly; of these:
+      76 mates make up the pairs; of these:
+        68 (89.47%) aligned 0 times
+        6 (7.89%) aligned exactly 1 time
+        2 (2.63%) aligned >1 times
+91.50% overall alignment rate
+'''
+
+
+def write_summaries(tmp_path, summaries) -> list:
+    files = []
+    for idx, summary in enumerate(summaries):
+        summary_file = tmp_path / "chunk{}.summary.txt".format(idx)
+        summary_file.write_text(summary)
+        files.append(str(summary_file))
+    return files
+
+def test_aggregate_adds_counts_and_recomputes_percentages(tmp_path):
+    output = tmp_path / "sample.summary.txt"
+    files = write_summaries(tmp_path, CHUNK_SUMMARIES)
+    assert aggregate_alignment_summaries(files, str(output)) == str(output)
+    assert output.read_text() == EXPECTED
+    assert not list(tmp_path.glob(".tmp.*"))
+
+def test_aggregate_single_chunk_is_unchanged(tmp_path):
+    output = tmp_path / "sample.summary.txt"
+    files = write_summaries(tmp_path, CHUNK_SUMMARIES[:1])
+    aggregate_alignment_summaries(files, str(output))
+    assert output.read_text() == CHUNK_SUMMARIES[0]
+
+def test_aggregate_chunks_without_reads(tmp_path):
+    empty = CHUNK_SUMMARIES[0].replace("100 ", "0 ").replace("96.00%", "0.00%")
+    output = tmp_path / "sample.summary.txt"
+    aggregate_alignment_summaries(write_summaries(tmp_path, [empty, empty]),
+        str(output))
+    lines = output.read_text().splitlines()
+    assert lines[0] == "0 reads; of these:"
+    assert lines[1] == "  0 (0.00%) were paired; of these:"
+    assert lines[-1] == "0.00% overall alignment rate"
@@ -0,0 +1,38 @@
+import json
+from src import config
+
+
+def use_docker_images(monkeypatch, tmp_path, local_images):
+    calls = []
+    def list_docker_images():
+        calls.append(1)
+        return dict(local_images)
+    monkeypatch.setattr(config, "IMAGE_CACHE", str(tmp_path / "docker_images.json"))
+    monkeypatch.setattr(config, "list_docker_images", list_docker_images)
+    return calls
+
+
+def test_unchanged_images_skip_docker(monkeypatch, tmp_path):
+    calls = use_docker_images(monkeypatch, tmp_path, {"a:1": "sha256:aaa"})
+    assert config.validate_images(["a:1"]) == []
+    assert config.validate_images(["a:1"]) == []
+    assert len(calls) == 1
+
+def test_stale_images_are_listed_again(monkeypatch, tmp_path):
+    calls = use_docker_images(monkeypatch, tmp_path, {"a:1": "sha256:aaa"})
+    config.validate_images(["a:1"])
+    with open(config.IMAGE_CACHE) as f:
+        image_cache = json.load(f)
+    image_cache["a:1"]["checked"] -= config.IMAGE_CACHE_TTL
+    with open(config.IMAGE_CACHE, "w") as f:
+        json.dump(image_cache, f)
+    assert config.validate_images(["a:1"]) == []
+    assert len(calls) == 2
+
+def test_missing_images_are_not_cached(monkeypatch, tmp_path):
+    calls = use_docker_images(monkeypatch, tmp_path, {"a:1": "sha256:aaa"})
+    assert config.validate_images(["a:1", "b:1"]) == ["b:1"]
+    assert config.validate_images(["a:1", "b:1"]) == ["b:1"]
+    assert len(calls) == 2
+    assert config.validate_images(["a:1"]) == []
+    assert len(calls) == 2
@@ -0,0 +1,105 @@
+import os
+import stat
+import pytest
+from src.tools import TOOLS
+from src.runner import run_cmd
+from src.container import ContainerPool, ContainerSession, get_mounts
+
+# Stand-in docker: logs its arguments, prints a container id on run -d and
+# runs exec commands on the host
+FAKE_DOCKER = '''#!/bin/sh
+echo "$*" >> "{calls}"
+case "$1" in
+  run) [ "$2" = "-d" ] && echo 0123456789ab ;;
+  exec) shift 2; exec "$@" ;;
+esac
+exit 0
+'''
+
+
+@pytest.fixture
+def docker_calls(tmp_path, monkeypatch):
+    '''
+        Puts the stand-in docker first on PATH and returns its call log
+    '''
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls = tmp_path / "docker_calls"
+    docker = bin_dir / "docker"
+    docker.write_text(FAKE_DOCKER.format(calls=calls))
+    docker.chmod(docker.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.delenv("RNASEQ_DOCKER", raising=False)
+    monkeypatch.setenv("PATH", "{}{}{}".format(bin_dir, os.pathsep, os.environ["PATH"]))
+    TOOLS.reset()
+    yield calls
+    TOOLS.reset()
+
+def read_calls(calls) -> list:
+    return calls.read_text().splitlines() if calls.exists() else []
+
+
+def test_get_mounts_drops_nested_folders(tmp_path):
+    nested = tmp_path / "a" / "b"
+    nested.mkdir(parents=True)
+    fq = nested / "x.fastq.gz"
+    fq.write_text("")
+    assert get_mounts([str(fq), str(tmp_path / "a"), str(nested)]) == \
+        [str((tmp_path / "a").resolve())]
+
+def test_pool_starts_one_container_per_image(docker_calls, tmp_path):
+    with ContainerPool([str(tmp_path)]) as pool:
+        for cmd in ("true", "true", "true"):
+            pool.exec_cmd("biocontainers/fastqc:0.11.9", cmd)
+        pool.exec_cmd("dsaha0295/featurecounts:latest", "true")
+
+    starts = [call for call in read_calls(docker_calls) if call.startswith("run -d")]
+    assert len(starts) == 2
+    assert any("biocontainers/fastqc:0.11.9" in call for call in starts)
+    assert any("dsaha0295/featurecounts:latest" in call for call in starts)
+    for call in starts:
+        assert "-v {0}:{0}".format(tmp_path) in call
+        assert call.endswith("sleep {} infinity".format(call.split()[-2]))
+
+def test_exec_dispatches_to_the_session(docker_calls, tmp_path):
+    out = tmp_path / "out.txt"
+    with ContainerPool([str(tmp_path)]) as pool:
+        session = pool.session("biocontainers/fastqc:0.11.9")
+        result = run_cmd(pool.exec_cmd("biocontainers/fastqc:0.11.9",
+            "echo dispatched > {}".format(out)), check=False)
+
+    assert result.returncode == 0
+    assert out.read_text() == "dispatched\n"
+    execs = [call for call in read_calls(docker_calls) if call.startswith("exec")]
+    assert execs == ["exec {} sh -c echo dispatched > {}".format(session.name, out)]
+
+def test_close_removes_every_container(docker_calls, tmp_path):
+    pool = ContainerPool([str(tmp_path)])
+    sessions = [pool.session(image) for image in ("img/a:1", "img/b:2")]
+    assert all(session.running for session in sessions)
+    pool.close()
+
+    assert not any(session.running for session in sessions)
+    removals = [call for call in read_calls(docker_calls) if call.startswith("rm -f")]
+    assert sorted(removals) == sorted("rm -f {}".format(session.name)
+        for session in sessions)
+
+    # Stopping twice does not call docker again
+    pool.close()
+    sessions[0].stop()
+    assert len([call for call in read_calls(docker_calls)
+        if call.startswith("rm -f")]) == 2
+
+def test_session_is_restarted_after_stop(docker_calls, tmp_path):
+    pool = ContainerPool([str(tmp_path)])
+    first = pool.session("img/a:1")
+    first.stop()
+    second = pool.session("img/a:1")
+    pool.close()
+
+    assert first.name != second.name
+    starts = [call for call in read_calls(docker_calls) if call.startswith("run -d")]
+    assert len(starts) == 2
+
+def test_container_name_is_docker_safe():
+    session = ContainerSession("registry:5000/tools/fastqc:0.11.9", [])
+    assert all(c.isalnum() or c in "_.-" for c in session.name)
@@ -0,0 +1,81 @@
+import threading
+import pytest
+from src.dag import Task, TaskGraph, TaskFailed, InvalidTaskGraph
+
+
+def record(calls, name):
+    calls.append(name)
+    return name
+
+def fail():
+    raise RuntimeError("boom")
+
+
+def test_tasks_run_after_the_producers_of_their_inputs():
+    calls = []
+    graph = TaskGraph()
+    # Declared out of order: the order comes from inputs and outputs
+    graph.add(Task("count", record, args=(calls, "count"), inputs=["s.bam"],
+        outputs=["s.counts"]))
+    graph.add(Task("align", record, args=(calls, "align"), inputs=["s.trim.fq"],
+        outputs=["s.bam"]))
+    graph.add(Task("trim", record, args=(calls, "trim"), inputs=["s.fq"],
+        outputs=["s.trim.fq"]))
+    graph.add(Task("report", record, args=(calls, "report"), deps=["count"]))
+
+    assert graph.topological_order() == ["trim", "align", "count", "report"]
+    results = graph.run(max_workers=4)
+    assert calls == ["trim", "align", "count", "report"]
+    assert results == {name: name for name in calls}
+
+def test_independent_tasks_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    graph = TaskGraph()
+    for name in ("a", "b"):
+        graph.add(Task(name, barrier.wait))
+    # Deadlocks, then times out, unless both tasks run at the same time
+    graph.run(max_workers=2)
+
+def test_failure_skips_downstream_tasks_only():
+    calls = []
+    graph = TaskGraph()
+    graph.add(Task("align:A", fail, outputs=["A.bam"]))
+    graph.add(Task("count:A", record, args=(calls, "count:A"), inputs=["A.bam"],
+        outputs=["A.counts"]))
+    graph.add(Task("report:A", record, args=(calls, "report:A"), inputs=["A.counts"]))
+    graph.add(Task("align:B", record, args=(calls, "align:B"), outputs=["B.bam"]))
+    graph.add(Task("count:B", record, args=(calls, "count:B"), inputs=["B.bam"]))
+
+    with pytest.raises(TaskFailed, match="align:A"):
+        graph.run(max_workers=2)
+    assert sorted(calls) == ["align:B", "count:B"]
+
+def test_cycles_are_detected():
+    graph = TaskGraph()
+    graph.add(Task("a", record, inputs=["b.out"], outputs=["a.out"]))
+    graph.add(Task("b", record, inputs=["a.out"], outputs=["b.out"]))
+    graph.add(Task("c", record, outputs=["c.out"]))
+    with pytest.raises(InvalidTaskGraph, match="cyclic dependencies between tasks: a, b"):
+        graph.topological_order()
+    with pytest.raises(InvalidTaskGraph):
+        graph.run()
+
+def test_duplicated_tasks_and_outputs_are_rejected():
+    graph = TaskGraph()
+    graph.add(Task("a", record, outputs=["x"]))
+    with pytest.raises(InvalidTaskGraph, match="duplicated task a"):
+        graph.add(Task("a", record))
+    with pytest.raises(InvalidTaskGraph, match="produced by both a and b"):
+        graph.add(Task("b", record, outputs=["x"]))
+    assert len(graph) == 1
+
+def test_unknown_dependencies_are_rejected():
+    graph = TaskGraph()
+    graph.add(Task("a", record, deps=["missing"]))
+    with pytest.raises(InvalidTaskGraph, match="unknown task missing"):
+        graph.topological_order()
+
+def test_task_samples():
+    assert Task("a", record).samples == []
+    assert Task("a", record, sample="A").samples == ["A"]
+    assert Task("a", record, sample=["A", "B"]).samples == ["A", "B"]
@@ -0,0 +1,67 @@
+import os
+import pytest
+from src.discovery import ILLUMINA_FASTQ, OTHER_FASTQ, DEFAULT_LANE, parse_fastq_name,\
+    scan_fastq_files
+
+
+@pytest.mark.parametrize("name, groups", [
+    ("A_S1_L001_R1_001.fastq.gz", ("A", "1", "001", "1", "001")),
+    ("A_S1_L001_R2_001.fq.gz", ("A", "1", "001", "2", "001")),
+    ("Sample_X_S12_L004_R1_002.fastq", ("Sample_X", "12", "004", "1", "002")),
+    ("A_S_1_S3_L001_R1_001.fa.gz", ("A_S_1", "3", "001", "1", "001")),
+])
+def test_illumina_names(name, groups):
+    match = ILLUMINA_FASTQ.match(name)
+    assert match is not None
+    assert match.group('sample', 'number', 'lane', 'read', 'chunk') == groups
+
+@pytest.mark.parametrize("name", [
+    "A_S1_L001_R3_001.fastq.gz",
+    "A_S1_L001_R1.fastq.gz",
+    "A_S1_L001_R1_001.bam",
+    "A_L001_R1_001.fastq.gz",
+])
+def test_not_illumina_names(name):
+    assert ILLUMINA_FASTQ.match(name) is None
+
+@pytest.mark.parametrize("name, groups", [
+    ("B_R1.fastq.gz", ("B", "1")),
+    ("B_R2.fq", ("B", "2")),
+    ("B_lib3_R1_trim.fastq.gz", ("B", "1")),
+    ("B_R2", ("B", "2")),
+])
+def test_other_names(name, groups):
+    match = OTHER_FASTQ.match(name)
+    assert match is not None
+    assert match.group('sample', 'read') == groups
+
+@pytest.mark.parametrize("name", [
+    "B_1.fastq.gz",
+    "BR1.fastq.gz",
+    "B_R3.fastq.gz",
+    "B_R12.fastq.gz",
+])
+def test_not_other_names(name):
+    assert OTHER_FASTQ.match(name) is None
+
+@pytest.mark.parametrize("fq, parsed", [
+    ("/runs/x/A_S1_L002_R1_001.fastq.gz", ("A", "002", 1)),
+    ("A_S1_L002_R2_003.fastq.gz", ("A", "002.003", 2)),
+    ("B_R2.fastq.gz", ("B", DEFAULT_LANE, 2)),
+    ("undetermined.fastq.gz", None),
+])
+def test_parse_fastq_name(fq, parsed):
+    assert parse_fastq_name(fq) == parsed
+
+def test_scan_follows_each_folder_once(tmp_path):
+    run = tmp_path / "run"
+    (run / "lane1").mkdir(parents=True)
+    (run / "lane1" / "A_S1_L001_R1_001.fastq.gz").write_text("")
+    (run / "A_S1_L002_R1_001.fastq.gz").write_text("")
+    # A link loop and a second link to a folder already scanned
+    (run / "lane1" / "loop").symlink_to(run)
+    (run / "again").symlink_to(run / "lane1")
+    fastq_files = scan_fastq_files(str(run), recursive=True)
+    assert sorted(os.path.basename(fq) for fq in fastq_files) == \
+        ["A_S1_L001_R1_001.fastq.gz", "A_S1_L002_R1_001.fastq.gz"]
+    assert scan_fastq_files(str(run)) == [str(run / "A_S1_L002_R1_001.fastq.gz")]
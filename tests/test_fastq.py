@@ -0,0 +1,117 @@
+import gzip
+import json
+import pytest
+from src.fastq import validate_fastq_pair, validate_sample, InvalidFastqFile,\
+    FastqIndexCache, index_fastqs, stream_subsample_fastq_pairs, SUBSAMPLE_POOL_FACTOR
+
+
+def write_fastq(path, names, seq="ACGTACGTAC", qual="IIIIIIIIII"):
+    with gzip.open(str(path), "wt") as f:
+        for name in names:
+            f.write("@{}\n{}\n+\n{}\n".format(name, seq, qual))
+    return str(path)
+
+def write_pair(tmp_path, names1, names2=None, **kwargs):
+    fq1 = write_fastq(tmp_path / "A_S1_L001_R1_001.fastq.gz", names1, **kwargs)
+    fq2 = write_fastq(tmp_path / "A_S1_L001_R2_001.fastq.gz",
+        names1 if names2 is None else names2)
+    return fq1, fq2
+
+
+def test_consistent_pair(tmp_path):
+    names = ["read{}".format(idx) for idx in range(250)]
+    fq1, fq2 = write_pair(tmp_path, [name + "/1" for name in names],
+        [name + "/2" for name in names])
+    # Small batches, so that mates are compared over several of them
+    result = validate_fastq_pair(fq1, fq2, batch_size=100)
+    assert result['is_consistent']
+    assert result['reads_fq1'] == result['reads_fq2'] == 250
+    assert result['length_histogram_fq1'] == {10: 250}
+    assert result['name_mismatches'] == 0
+
+def test_mate_name_mismatches(tmp_path):
+    names = ["read{}".format(idx) for idx in range(250)]
+    other = list(names)
+    other[120] = "other120"
+    other[200] = "other200"
+    fq1, fq2 = write_pair(tmp_path, names, other)
+    result = validate_fastq_pair(fq1, fq2, batch_size=100)
+    assert not result['is_consistent']
+    assert result['name_mismatches'] == 2
+    assert result['first_name_mismatch'] == 121
+
+def test_unequal_read_counts(tmp_path):
+    names = ["read{}".format(idx) for idx in range(150)]
+    fq1, fq2 = write_pair(tmp_path, names, names[:120])
+    result = validate_fastq_pair(fq1, fq2, batch_size=100)
+    assert not result['is_consistent']
+    assert (result['reads_fq1'], result['reads_fq2']) == (150, 120)
+    assert result['name_mismatches'] == 0
+
+def test_malformed_record(tmp_path):
+    names = ["read{}".format(idx) for idx in range(10)]
+    fq1, fq2 = write_pair(tmp_path, names, names + ["bad"] + names)
+    with gzip.open(fq1, "at") as f:
+        f.write("@bad\nACGTACGTAC\n+\nIIIII\n")
+        for name in names:
+            f.write("@{}\nACGTACGTAC\n+\nIIIIIIIIII\n".format(name))
+    result = validate_fastq_pair(fq1, fq2)
+    # pyfastx either stops at the malformed record or returns it, counted
+    # as a SEQ and QUAL mismatch: the pair is not consistent either way
+    assert not result['is_consistent']
+    assert result['reads_fq1'] != result['reads_fq2'] or \
+        result['qual_length_mismatches_fq1'] == 1
+
+def test_unreadable_file(tmp_path):
+    fq1, fq2 = write_pair(tmp_path, ["read1"])
+    with open(fq2, "wb") as f:
+        f.write(b"\x1f\x8bnot really gzip")
+    with pytest.raises(InvalidFastqFile):
+        validate_fastq_pair(fq1, fq2)
+
+def test_validate_sample_report(tmp_path):
+    names = ["read{}".format(idx) for idx in range(20)]
+    fq1, fq2 = write_pair(tmp_path, names)
+    report = str(tmp_path / "A.validation.json")
+    assert validate_sample("A", {"001": (fq1, fq2)}, report) == report
+    with open(report) as f:
+        assert json.load(f)['lanes']['001']['reads_fq1'] == 20
+
+    fq1, fq2 = write_pair(tmp_path, names, names[:10])
+    with pytest.raises(InvalidFastqFile):
+        validate_sample("A", {"001": (fq1, fq2)}, report)
+
+def test_index_fastqs(tmp_path):
+    names = ["read{}".format(idx) for idx in range(50)]
+    fq1, fq2 = write_pair(tmp_path, names)
+    cache_dir = str(tmp_path / "index")
+    index_cache = FastqIndexCache(cache_dir)
+    assert not index_cache.is_indexed(fq1)
+    markers = index_fastqs([fq1, fq2], cache_dir)
+    assert markers == [index_cache.get_done_marker(fq) for fq in (fq1, fq2)]
+    assert index_cache.is_indexed(fq1) and index_cache.is_indexed(fq2)
+    assert index_cache.read_count(fq1) == 50
+
+def test_index_cache_created_on_first_index(tmp_path):
+    cache_dir = tmp_path / "index"
+    fq1, fq2 = write_pair(tmp_path, ["read0"])
+    index_cache = FastqIndexCache(str(cache_dir))
+    assert not index_cache.is_indexed(fq1)
+    assert not cache_dir.exists()
+
+def test_stream_subsample_stops_early(tmp_path):
+    names = ["read{}".format(idx) for idx in range(1000)]
+    fq1, fq2 = write_pair(tmp_path, names)
+    out_fq1, out_fq2 = str(tmp_path / "sub_R1.fastq.gz"), str(tmp_path / "sub_R2.fastq.gz")
+    reads = 5
+    assert stream_subsample_fastq_pairs([(fq1, fq2)], reads, out_fq1, out_fq2) == reads
+    with gzip.open(out_fq1, "rt") as f:
+        kept = [int(line[5:]) for line in f if line.startswith("@read")]
+    assert kept == sorted(kept)
+    assert len(kept) == reads
+    assert max(kept) < reads * SUBSAMPLE_POOL_FACTOR
+    # The same subset is drawn for a seed
+    assert stream_subsample_fastq_pairs([(fq1, fq2)], reads, out_fq1 + ".2",
+        out_fq2 + ".2") == reads
+    with gzip.open(out_fq1 + ".2", "rt") as f:
+        assert [int(line[5:]) for line in f if line.startswith("@read")] == kept
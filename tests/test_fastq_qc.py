@@ -0,0 +1,89 @@
+import os
+import gzip
+import json
+import pytest
+from src.fastq_qc import FastqQC, write_qc_report, native_qc, get_qc_folder,\
+    get_qc_report
+
+
+def write_fastq(path, reads):
+    with gzip.open(str(path), "wt") as f:
+        for idx, (seq, qual) in enumerate(reads):
+            f.write("@read{}\n{}\n+\n{}\n".format(idx, seq, qual))
+    return str(path)
+
+def read_modules(report):
+    '''
+        fastqc_data.txt as module name to (status, rows)
+    '''
+    modules = {}
+    with open(report) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith(">>") and line != ">>END_MODULE":
+                name, status = line[2:].split("\t")
+                modules[name] = (status, [])
+                current = modules[name][1]
+            elif line and not line.startswith("#") and not line.startswith(">>"):
+                current.append(line.split("\t"))
+    return modules
+
+
+def test_report_files_and_statistics(tmp_path):
+    fq = write_fastq(tmp_path / "A_R1.fastq.gz",
+        [("GGCCAATT", "IIIIIIII"), ("ACGTN", "II#I#"), ("GGGGCCCC", "IIIIIIII")])
+    report = write_qc_report(fq, str(tmp_path / "qc"))
+    folder = get_qc_folder(fq, str(tmp_path / "qc"))
+    assert report == get_qc_report(fq, str(tmp_path / "qc"))
+    assert folder.endswith("A_R1_fastqc")
+    assert sorted(os.listdir(folder)) == ["fastqc_data.json", "fastqc_data.txt",
+        "summary.txt"]
+
+    modules = read_modules(report)
+    basic = dict(modules['Basic Statistics'][1])
+    assert basic['Total Sequences'] == "3"
+    assert basic['Sequence length'] == "5-8"
+    # 12 G/C out of 21 bases
+    assert basic['%GC'] == "67"
+    assert modules['Sequence Length Distribution'][1] == [["5", "1"], ["8", "2"]]
+    # Read 2 has its N on position 5, one of the three reads covering it
+    n_content = dict((row[0], float(row[1])) for row in modules['Per base N content'][1])
+    assert n_content["5"] == pytest.approx(100 / 3, abs=1e-3)
+    assert n_content["1"] == 0
+    quality = modules['Per base sequence quality'][1]
+    # Position 3: qualities 40, 2 and 40
+    assert quality[2][2] == "40"
+
+    with open(os.path.join(folder, "fastqc_data.json")) as f:
+        data = json.load(f)
+    assert data['basic_statistics']['Total Sequences'] == 3
+    with open(os.path.join(folder, "summary.txt")) as f:
+        summary = [line.split("\t") for line in f.read().splitlines()]
+    assert [row[1] for row in summary][0] == "Basic Statistics"
+    assert all(row[2] == "A_R1.fastq.gz" for row in summary)
+
+def test_batches_add_up():
+    reads = [("ACGT"*(idx % 5 + 1), "I"*4*(idx % 5 + 1)) for idx in range(20)]
+    whole = FastqQC("x.fastq")
+    whole.add_batch([seq for seq, qual in reads], [qual for seq, qual in reads])
+    batched = FastqQC("x.fastq")
+    for start in range(0, 20, 7):
+        batch = reads[start:start + 7]
+        batched.add_batch([seq for seq, qual in batch], [qual for seq, qual in batch])
+    assert whole.to_dict() == batched.to_dict()
+
+def test_failed_report_leaves_no_partial_files(tmp_path, monkeypatch):
+    fq = write_fastq(tmp_path / "A_R1.fastq.gz", [("ACGT", "IIII")])
+    monkeypatch.setattr(FastqQC, "to_summary", lambda self: 1/0)
+    with pytest.raises(ZeroDivisionError):
+        write_qc_report(fq, str(tmp_path / "qc"))
+    folder = get_qc_folder(fq, str(tmp_path / "qc"))
+    assert not os.path.exists(folder) or os.listdir(folder) == []
+
+def test_native_qc_of_several_files(tmp_path):
+    fqs = [write_fastq(tmp_path / "A_R{}.fastq.gz".format(read), [("ACGT", "IIII")])
+        for read in (1, 2)]
+    output_dirs = [str(tmp_path / "qc")] * 2
+    reports = native_qc(fqs, output_dirs, processes=2)
+    assert reports == [get_qc_report(fq, str(tmp_path / "qc")) for fq in fqs]
+    assert all(os.path.isfile(report) for report in reports)
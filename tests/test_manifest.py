@@ -0,0 +1,105 @@
+import os
+from src.dag import Task
+from src.manifest import RunManifest, MANIFEST_NAME
+
+
+def noop():
+    pass
+
+def make_task(tmp_path, cmd="tool -i in.txt -o out.txt", version="1.0"):
+    return Task("step:A", noop, inputs=[str(tmp_path / "in.txt")],
+        outputs=[str(tmp_path / "out.txt")], cmd=cmd, version=version)
+
+def setup_files(tmp_path):
+    (tmp_path / "in.txt").write_text("input")
+    (tmp_path / "out.txt").write_text("output")
+
+def touch_later(path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def test_recorded_task_is_up_to_date_after_reload(tmp_path):
+    setup_files(tmp_path)
+    path = str(tmp_path / MANIFEST_NAME)
+    manifest = RunManifest(path)
+    task = make_task(tmp_path)
+    assert not manifest.is_up_to_date(task)
+    manifest.record(task)
+    assert manifest.is_up_to_date(task)
+    # A resumed run reads the manifest back
+    assert RunManifest(path).is_up_to_date(task)
+
+def test_changed_input_or_output_invalidates(tmp_path):
+    setup_files(tmp_path)
+    manifest = RunManifest(str(tmp_path / MANIFEST_NAME))
+    task = make_task(tmp_path)
+    manifest.record(task)
+
+    (tmp_path / "in.txt").write_text("other input")
+    assert not manifest.is_up_to_date(task)
+    manifest.record(task)
+    os.remove(tmp_path / "out.txt")
+    assert not manifest.is_up_to_date(task)
+
+def test_changed_cmd_or_version_invalidates(tmp_path):
+    setup_files(tmp_path)
+    manifest = RunManifest(str(tmp_path / MANIFEST_NAME))
+    manifest.record(make_task(tmp_path))
+    assert not manifest.is_up_to_date(make_task(tmp_path, cmd="tool --fast"))
+    assert not manifest.is_up_to_date(make_task(tmp_path, version="2.0"))
+    assert manifest.is_up_to_date(make_task(tmp_path))
+
+def test_touched_input_is_up_to_date_only_with_hashes(tmp_path):
+    setup_files(tmp_path)
+    task = make_task(tmp_path)
+    plain = RunManifest(str(tmp_path / "plain.json"))
+    hashed = RunManifest(str(tmp_path / "hashed.json"), hash_inputs=True)
+    plain.record(task)
+    hashed.record(task)
+
+    touch_later(tmp_path / "in.txt")
+    assert not plain.is_up_to_date(task)
+    assert hashed.is_up_to_date(task)
+
+def test_invalidate_forgets_the_task(tmp_path):
+    setup_files(tmp_path)
+    path = str(tmp_path / MANIFEST_NAME)
+    manifest = RunManifest(path)
+    task = make_task(tmp_path)
+    manifest.record(task)
+    manifest.invalidate(task)
+    assert not manifest.is_up_to_date(task)
+    assert not RunManifest(path).is_up_to_date(task)
+
+def test_unreadable_manifest_runs_everything(tmp_path):
+    setup_files(tmp_path)
+    path = tmp_path / MANIFEST_NAME
+    path.write_text("{not json")
+    assert not RunManifest(str(path)).is_up_to_date(make_task(tmp_path))
+
+def test_resumed_graph_only_runs_invalidated_tasks(tmp_path):
+    from src.dag import TaskGraph, TaskSkipped
+    calls = []
+
+    def write(name, output):
+        calls.append(name)
+        with open(output, "w") as f:
+            f.write(name)
+
+    (tmp_path / "in.txt").write_text("input")
+    path = str(tmp_path / MANIFEST_NAME)
+    graph = TaskGraph()
+    graph.add(Task("a", write, args=("a", str(tmp_path / "a.txt")),
+        inputs=[str(tmp_path / "in.txt")], outputs=[str(tmp_path / "a.txt")]))
+    graph.add(Task("b", write, args=("b", str(tmp_path / "b.txt")),
+        inputs=[str(tmp_path / "a.txt")], outputs=[str(tmp_path / "b.txt")]))
+
+    graph.run(manifest=RunManifest(path))
+    results = graph.run(manifest=RunManifest(path))
+    assert calls == ["a", "b"]
+    assert all(isinstance(result, TaskSkipped) for result in results.values())
+
+    os.remove(tmp_path / "b.txt")
+    graph.run(manifest=RunManifest(path))
+    assert calls == ["a", "b", "b"]
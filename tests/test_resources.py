@@ -0,0 +1,75 @@
+import time
+import threading
+from src.resources import ResourceBroker, get_requirements, get_jvm_heap_mb,\
+    JVM_OVERHEAD_MB
+from src import resources
+
+
+def test_oversized_requests_are_clamped_to_the_budget():
+    broker = ResourceBroker(4, 8000)
+    assert broker.fit(16, 64000) == (4, 8000)
+    assert broker.fit(-1, -5) == (0, 0)
+    with broker.reserve(16, 64000) as reserved:
+        assert reserved == (4, 8000)
+    # Everything is given back
+    assert broker.acquire(4, 8000) == (4, 8000)
+
+def test_jobs_wait_until_they_fit():
+    broker = ResourceBroker(4, 8000)
+    started = []
+
+    def job(name, cpus, mem_mb):
+        with broker.reserve(cpus, mem_mb):
+            started.append(name)
+            time.sleep(0.2)
+
+    first = threading.Thread(target=job, args=("first", 3, 1000))
+    first.start()
+    time.sleep(0.05)
+    # Fits the free CPU: starts at once
+    small = threading.Thread(target=job, args=("small", 1, 1000))
+    # Needs 2 CPUs: waits for the first job
+    second = threading.Thread(target=job, args=("second", 2, 1000))
+    small.start()
+    time.sleep(0.05)
+    second.start()
+    time.sleep(0.05)
+    assert started == ["first", "small"]
+    for thread in (first, small, second):
+        thread.join(timeout=5)
+    assert started == ["first", "small", "second"]
+
+def test_memory_is_admitted_as_well():
+    broker = ResourceBroker(8, 1000)
+    broker.acquire(1, 800)
+    admitted = threading.Event()
+
+    def job():
+        with broker.reserve(1, 400):
+            admitted.set()
+
+    thread = threading.Thread(target=job)
+    thread.start()
+    assert not admitted.wait(0.1)
+    broker.release(1, 800)
+    assert admitted.wait(5)
+    thread.join(timeout=5)
+
+def test_budget_from_config_is_capped_by_the_host(monkeypatch):
+    monkeypatch.setattr(resources, "get_usable_cpus", lambda: 8)
+    monkeypatch.setattr(resources, "get_usable_memory_mb", lambda: 16000)
+    broker = ResourceBroker.from_config({'threads': 32, 'max_memory': 64000})
+    assert (broker.cpus, broker.mem_mb) == (8, 16000)
+    broker = ResourceBroker.from_config({'threads': 2, 'max_memory': 4000})
+    assert (broker.cpus, broker.mem_mb) == (2, 4000)
+
+def test_requirements_scale_with_threads_and_config():
+    assert get_requirements('samtools_sort', {}, 4) == {'cpus': 4, 'mem_mb': 4*768}
+    config_dict = {'resources': {'hisat2': {'mem_mb': 4000}}}
+    assert get_requirements('hisat2', config_dict, 8) == {'cpus': 8, 'mem_mb': 4000}
+
+def test_jvm_heap_fits_the_budget():
+    assert get_jvm_heap_mb('picard', {}, ResourceBroker(4, 64000)) == 4096
+    assert get_jvm_heap_mb('picard', {}, ResourceBroker(4, 3000)) == \
+        3000 - JVM_OVERHEAD_MB
+    assert get_jvm_heap_mb('picard', {}, ResourceBroker(4, 500)) == 256
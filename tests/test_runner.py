@@ -0,0 +1,82 @@
+import time
+import pytest
+from src.runner import CommandRunner, CommandFailed, CommandTimeout, TAIL_LINES
+
+
+@pytest.fixture
+def runner():
+    runner = CommandRunner()
+    yield runner
+    runner.close()
+
+
+def test_exit_code_and_stderr_tail(runner):
+    result = runner.run("echo out; echo err1 >&2; echo err2 >&2; exit 3", check=False)
+    assert result.returncode == 3
+    assert result.stderr == "err1\nerr2"
+    with pytest.raises(CommandFailed, match="exited with code 3"):
+        runner.run("exit 3")
+
+def test_pipeline_failures_are_not_masked(runner):
+    # bash runs with pipefail: a failed producer fails the pipeline
+    assert runner.run("false | cat", check=False).returncode == 1
+
+def test_killed_command_has_a_negative_code(runner):
+    assert runner.run("kill -9 $$", check=False).returncode == -9
+
+def test_logs_and_tail_are_bounded(runner, tmp_path):
+    prefix = str(tmp_path / "step")
+    result = runner.run("seq 1 1000; seq 1 1000 >&2", log_prefix=prefix)
+    with open(prefix + ".stdout.log") as f:
+        assert f.read().split() == [str(n) for n in range(1, 1001)]
+    with open(prefix + ".stderr.log") as f:
+        assert len(f.read().split()) == 1000
+    tail = result.stderr.split("\n")
+    assert len(tail) == TAIL_LINES
+    assert tail[-1] == "1000"
+
+def test_resource_usage_is_collected(runner, tmp_path):
+    result = runner.run("head -c 3000000 /dev/zero > {}; "
+        "python3 -c 'x = bytearray(50 * 2**20)'".format(tmp_path / "zeros"))
+    assert result.wall > 0
+    assert result.utime + result.stime > 0
+    # The python child allocated 50 MB
+    assert result.maxrss_kb > 50 * 1024
+    if result.io:
+        assert result.write_bytes >= 3000000
+
+def test_listeners_receive_every_result(runner):
+    results = []
+    runner.add_listener(results.append)
+    runner.run("true")
+    runner.run("exit 1", check=False)
+    runner.remove_listener(results.append)
+    runner.run("true")
+    assert [result.returncode for result in results] == [0, 1]
+
+def test_timeout_kills_the_process_group(runner, tmp_path):
+    start = time.time()
+    with pytest.raises(CommandTimeout):
+        runner.run("sleep 30 | cat", timeout=0.5)
+    assert time.time() - start < 10
+
+def test_kill_sweeps_processes_left_by_the_shell(runner):
+    # The shell dies on SIGTERM, the sleep ignores it and holds its pipes
+    start = time.time()
+    with pytest.raises(CommandTimeout):
+        runner.run("(trap '' TERM; sleep 30) & wait", timeout=0.5)
+    assert time.time() - start < 5
+
+def test_group_kills_the_others_on_failure(runner):
+    start = time.time()
+    results = runner.run_group([("sleep 30", None), ("exit 2", None)], check=False)
+    assert time.time() - start < 10
+    assert results[0] is None
+    assert results[1].returncode == 2
+    with pytest.raises(CommandFailed, match="exited with code 2"):
+        runner.run_group([("sleep 30", None), ("exit 2", None)])
+
+def test_group_results_on_success(runner):
+    results = runner.run_group([("true", None), ("echo x >&2", None)])
+    assert [result.returncode for result in results] == [0, 0]
+    assert results[1].stderr == "x"
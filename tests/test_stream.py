@@ -0,0 +1,104 @@
+import os
+import gzip
+import stat
+import pytest
+from src.tools import TOOLS
+from src.sample import Sample
+from src.map import Hisat2, InvalidBAM
+from src.preprocessing import TrimmingFailed, get_trimmed_fastq
+from src.stream import stream_align, get_stream_fifos, STREAM_DIR
+
+# Stand-in fastp: copies the reads of both mates to their outputs at once
+FAKE_FASTP = '''#!/bin/bash
+while [ $# -gt 0 ]; do case $1 in -i) i=$2;; -I) I=$2;; -o) o=$2;; -O) O=$2;;
+  -j) j=$2;; -h) h=$2;; esac; shift; done
+[ -n "$FAIL_FASTP" ] && { echo "fastp crashed" >&2; exit 2; }
+zcat $i > $o & zcat $I > $O & wait
+echo '{}' > $j; echo html > $h
+'''
+# Stand-in Hisat2: one "alignment" per read pair, read from both mates
+FAKE_HISAT2 = '''#!/bin/bash
+while [ $# -gt 0 ]; do case $1 in -1) a=$2;; -2) b=$2;; --summary-file) s=$2;;
+  esac; shift; done
+[ -n "$FAIL_HISAT2" ] && { echo "hisat2 crashed" >&2; exit 1; }
+paste <(awk 'NR % 4 == 1' $a) <(awk 'NR % 4 == 1' $b)
+echo "100.00% overall alignment rate" > $s
+'''
+# Stand-in samtools: view passes records through, sort writes them to -o
+FAKE_SAMTOOLS = '''#!/bin/bash
+case $1 in
+  view) cat ;;
+  sort) while [ $# -gt 0 ]; do [ "$1" = "-o" ] && o=$2; shift; done; cat > $o ;;
+esac
+'''
+
+
+@pytest.fixture
+def tools(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, script in (("fastp", FAKE_FASTP), ("hisat2", FAKE_HISAT2),
+        ("samtools", FAKE_SAMTOOLS)):
+        path = bin_dir / name
+        path.write_text(script)
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+        monkeypatch.setenv("RNASEQ_" + name.upper(), str(path))
+    TOOLS.reset()
+    yield
+    TOOLS.reset()
+
+def make_sample(tmp_path, pairs=1000):
+    fastq_folder = tmp_path / "A" / "FASTQ_FOLDER"
+    bam_folder = tmp_path / "A" / "BAM_FOLDER"
+    fastq_folder.mkdir(parents=True)
+    bam_folder.mkdir()
+    sample = Sample("A")
+    sample.add("fastq_folder", str(fastq_folder))
+    for read in (1, 2):
+        fq = str(tmp_path / "A_R{}.fastq.gz".format(read))
+        with gzip.open(fq, "wt") as f:
+            for idx in range(pairs):
+                f.write("@read{}\nACGT\n+\nIIII\n".format(idx))
+        sample.add("fq{}".format(read), fq)
+    fifo1, fifo2 = get_stream_fifos("A", str(bam_folder))
+    hisat2 = Hisat2("A", fifo1, fifo2, "index", str(bam_folder))
+    return sample, hisat2
+
+
+def test_reads_flow_through_the_pipes(tools, tmp_path):
+    sample, hisat2 = make_sample(tmp_path)
+    assert stream_align(sample, hisat2, 2) == hisat2.bam
+    with open(hisat2.bam) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 1000
+    assert lines[0] == "@read0\t@read0"
+    assert os.path.isfile(hisat2.summary_file)
+    assert os.path.isfile(os.path.join(sample.fastq_folder, "fastp.json"))
+    # No trimmed fastq is written and no pipe is left behind
+    assert not os.path.exists(get_trimmed_fastq(sample.fq1, sample.fastq_folder))
+    assert os.listdir(os.path.join(hisat2.output_dir, STREAM_DIR)) == []
+
+def test_trimmed_reads_are_kept_on_request(tools, tmp_path):
+    sample, hisat2 = make_sample(tmp_path)
+    stream_align(sample, hisat2, 2, keep_trimmed=True)
+    for fq in (sample.fq1, sample.fq2):
+        trimmed = get_trimmed_fastq(fq, sample.fastq_folder)
+        with gzip.open(trimmed, "rt") as f, gzip.open(fq, "rt") as raw:
+            assert f.read() == raw.read()
+    with open(hisat2.bam) as f:
+        assert len(f.read().splitlines()) == 1000
+
+@pytest.mark.parametrize("variable, error", [
+    ("FAIL_FASTP", TrimmingFailed),
+    ("FAIL_HISAT2", InvalidBAM),
+])
+def test_a_failure_kills_the_other_side(tools, tmp_path, monkeypatch, variable, error):
+    # Large enough to fill the pipes, so that the other side would block
+    sample, hisat2 = make_sample(tmp_path, pairs=100000)
+    monkeypatch.setenv(variable, "1")
+    with pytest.raises(error):
+        stream_align(sample, hisat2, 2)
+    assert not os.path.exists(hisat2.bam)
+    assert not os.path.exists(hisat2.summary_file)
+    assert not [name for name in os.listdir(hisat2.output_dir) if name.startswith(".tmp.")]
+    assert os.listdir(os.path.join(hisat2.output_dir, STREAM_DIR)) == []
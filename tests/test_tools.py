@@ -0,0 +1,31 @@
+import stat
+from src.tools import ToolRegistry
+
+
+def make_registry(monkeypatch, picard):
+    monkeypatch.setenv("RNASEQ_PICARD", picard)
+    monkeypatch.setenv("RNASEQ_JAVA", "/opt/jdk/bin/java")
+    tools = ToolRegistry()
+    tools.register("picard", version_cmd="{} MarkDuplicates --version")
+    tools.register("java", version_cmd="{} -version")
+    return tools
+
+
+def test_jar_runs_with_registry_java(monkeypatch):
+    tools = make_registry(monkeypatch, "/opt/picard/picard.jar")
+    assert tools.command("picard", ["-Xmx4096m"]) == \
+        "/opt/jdk/bin/java -Xmx4096m -jar /opt/picard/picard.jar"
+
+def test_wrapper_runs_directly(monkeypatch):
+    tools = make_registry(monkeypatch, "/opt/conda/bin/picard")
+    assert tools.command("picard", ["-Xmx4096m"]) == "/opt/conda/bin/picard -Xmx4096m"
+    assert tools.command("picard") == "/opt/conda/bin/picard"
+
+def test_version_uses_registry_java(monkeypatch, tmp_path):
+    java = tmp_path / "java"
+    java.write_text('#!/bin/sh\necho "java $*"\n')
+    java.chmod(java.stat().st_mode | stat.S_IEXEC)
+    tools = make_registry(monkeypatch, "/opt/picard/picard.jar")
+    monkeypatch.setenv("RNASEQ_JAVA", str(java))
+    assert tools.version("picard") == \
+        "java -jar /opt/picard/picard.jar MarkDuplicates --version"